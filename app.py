@@ -1,162 +1,78 @@
 import flask_socketio, socketio, engineio
 from flask import Flask, render_template, request, session, redirect, url_for, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import sqlite3
 import uuid
 from datetime import datetime
 import json
 import mimetypes
 import logging, os
-from PIL import Image
+import atexit
+from broker import queue_options
+from serving import ASYNC_MODE, COMPRESSION_THRESHOLD, run_options
 import math
+import media
+import metrics
+from communities import community_tree, group_activity, invalidate_communities
+from conversations import (record_announcement, advance_watermark, get_watermarks, get_unread,
+                           message_status, forget_conversation)
+from db import get_db
+from connections import connection_registry
+from fanout import Fanout
+from presence import Presence
+from typing_state import TypingState
+from migrations import migrate
+from profiles import PROFILE_COLUMNS, get_profile
+from response_cache import cached_response, touch
+from search import (search_messages, search_users as search_user_directory, invalidate_user_search,
+                    SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+from writer import message_writer
+import storage
+import uploads
+import voice
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'nimasa-docktalk-secret-key-2024'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB per request; larger files go through /api/uploads in chunks
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static/uploads/images', exist_ok=True)
 os.makedirs('static/uploads/files', exist_ok=True)
 os.makedirs('static/uploads/voice', exist_ok=True)
-os.environ["EVENTLET_NO_GREENDNS"] = "yes"   # avoid dnspython headaches
-#socketio = SocketIO(app,async_mode="eventlet",cors_allowed_origins="*",logger=False,engineio_logger=False,)
-socketio = SocketIO(app,async_mode="threading",cors_allowed_origins="*",logger=False,engineio_logger=False,)
-#socketio = SocketIO(app, cors_allowed_origins="*")
+# The async mode is picked with DOCKTALK_ASYNC_MODE (see serving.py). Set
+# DOCKTALK_MESSAGE_QUEUE to run several workers behind a sticky load
+# balancer; emits then reach sockets held by any of them (see broker.py)
+socketio = SocketIO(app,async_mode=ASYNC_MODE,cors_allowed_origins="*",logger=False,engineio_logger=False,
+                    compression_threshold=COMPRESSION_THRESHOLD,
+                    **queue_options(os.environ.get('DOCKTALK_MESSAGE_QUEUE')))
+metrics.register_gauge('server', lambda: {'async_mode': socketio.async_mode})
+fanout = Fanout(socketio)
+presence = Presence(socketio, fanout)
+typing_state = TypingState(socketio, fanout, presence.worker_id)
+metrics.register_gauge('typing', lambda: typing_state.stats())
+atexit.register(presence.retire)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Store active users and their socket IDs
-active_users = {}
-# Store active calls
-active_calls = {}
+PRESENCE_BATCH = 200
 
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            full_name TEXT NOT NULL,
-            department TEXT,
-            location TEXT,
-            phone TEXT,
-            bio TEXT,
-            avatar_url TEXT,
-            is_online BOOLEAN DEFAULT FALSE,
-            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Communities table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS communities (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT,
-            avatar_url TEXT,
-            created_by INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (created_by) REFERENCES users (id)
-        )
-    ''')
-    
-    # Groups table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT,
-            avatar_url TEXT,
-            community_id INTEGER,
-            created_by INTEGER,
-            expires_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (community_id) REFERENCES communities (id),
-            FOREIGN KEY (created_by) REFERENCES users (id)
-        )
-    ''')
-    
-    # Messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT NOT NULL,
-            message_type TEXT DEFAULT 'text',
-            sender_id INTEGER NOT NULL,
-            chat_type TEXT NOT NULL,
-            chat_id INTEGER NOT NULL,
-            file_url TEXT,
-            file_name TEXT,
-            file_size TEXT,
-            voice_duration INTEGER,
-            is_announcement BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (sender_id) REFERENCES users (id)
-                   
-        )
-    ''')
-    
-    # Group members table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS group_members (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            group_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            role TEXT DEFAULT 'member',
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (group_id) REFERENCES groups (id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(group_id, user_id)
-        )
-    ''')
-    
-    # Community members table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS community_members (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            community_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            role TEXT DEFAULT 'member',
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (community_id) REFERENCES communities (id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(community_id, user_id)
-        )
-    ''')
-    
-    # Calls table for call history
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS calls (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            call_id TEXT UNIQUE NOT NULL,
-            caller_id INTEGER NOT NULL,
-            target_type TEXT NOT NULL,
-            target_id INTEGER NOT NULL,
-            call_type TEXT NOT NULL,
-            status TEXT DEFAULT 'initiated',
-            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            ended_at TIMESTAMP,
-            duration INTEGER DEFAULT 0,
-            FOREIGN KEY (caller_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# User class for Flask-Login
-class User(UserMixin):
+    """Bring the schema up to date; all DDL lives in migrations.py"""
+    migrate()
+
+# User class for Flask-Login. A plain slotted record rather than UserMixin
+# (which would give every instance a __dict__); one is built per request
+# from the cached profile row.
+class User:
+    __slots__ = PROFILE_COLUMNS
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
     def __init__(self, id, username, email, full_name, department=None, location=None, phone=None, bio=None, avatar_url=None, is_online=False, last_seen=None):
         self.id = id
         self.username = username
@@ -170,29 +86,21 @@ class User(UserMixin):
         self.is_online = is_online
         self.last_seen = last_seen
 
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user_data = cursor.fetchone()
-    conn.close()
-    
-    if user_data:
-        return User(
-            id=user_data[0],
-            username=user_data[1],
-            email=user_data[2],
-            full_name=user_data[4],
-            department=user_data[5],
-            location=user_data[6],
-            phone=user_data[7],
-            bio=user_data[8],
-            avatar_url=user_data[9],
-            is_online=user_data[10],
-            last_seen=user_data[11]
-        )
-    return None
+    row = get_profile(user_id)
+    return User(*row) if row else None
 
 # Routes
 @app.route('/')
@@ -207,11 +115,10 @@ def login():
         username = data.get('username')
         password = data.get('password')
         
-        conn = sqlite3.connect('docktalk.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
-        user_data = cursor.fetchone()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
+            user_data = cursor.fetchone()
         
         if user_data and check_password_hash(user_data[3], password):
             user = User(
@@ -227,13 +134,6 @@ def login():
             )
             login_user(user)
             
-            # Update user online status
-            conn = sqlite3.connect('docktalk.db')
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET is_online = TRUE WHERE id = ?', (user.id,))
-            conn.commit()
-            conn.close()
-            
             return jsonify({'success': True, 'redirect': url_for('index')})
         else:
             return jsonify({'success': False, 'error': 'Invalid credentials'})
@@ -253,25 +153,25 @@ def register():
         phone = data.get('phone', '')
         
         # Check if user already exists
-        conn = sqlite3.connect('docktalk.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
-        existing_user = cursor.fetchone()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
+            existing_user = cursor.fetchone()
         
-        if existing_user:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Username or email already exists'})
+            if existing_user:
+                return jsonify({'success': False, 'error': 'Username or email already exists'})
         
-        # Create new user
-        password_hash = generate_password_hash(password)
-        cursor.execute('''
-            INSERT INTO users (username, email, password_hash, full_name, department, location, phone)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (username, email, password_hash, full_name, department, location, phone))
+            # Create new user
+            password_hash = generate_password_hash(password)
+            cursor.execute('''
+                INSERT INTO users (username, email, password_hash, full_name, department, location, phone)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (username, email, password_hash, full_name, department, location, phone))
         
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+            user_id = cursor.lastrowid
+            touch(cursor, 'users')
+            conn.commit()
+        invalidate_user_search()
         
         # Auto-join NIMASA community
         add_user_to_nimasa_community(user_id)
@@ -283,13 +183,7 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
-    # Update user offline status
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_online = FALSE, last_seen = CURRENT_TIMESTAMP WHERE id = ?', (current_user.id,))
-    conn.commit()
-    conn.close()
-    
+    # Presence marks the user offline once their sockets close
     logout_user()
     return redirect(url_for('login'))
 
@@ -297,27 +191,36 @@ def logout():
 @app.route('/api/chats')
 @login_required
 def get_chats():
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        individual_chats = _chat_list(conn.cursor(), current_user.id)
     
-    # Get individual chats (users the current user has messaged)
+    return jsonify(individual_chats)
+
+def _chat_list(cursor, user_id):
+    """Direct chats of user_id (users they have messaged), newest first"""
     cursor.execute('''
-        SELECT DISTINCT u.id, u.username, u.full_name, u.department, u.location, 
+        SELECT u.id, u.username, u.full_name, u.department, u.location, 
                u.phone, u.email, u.bio, u.avatar_url, u.is_online, u.last_seen,
-               m.content as last_message, m.created_at as last_message_time
-        FROM users u
-        LEFT JOIN messages m ON (
-            (m.sender_id = u.id AND m.chat_type = 'user' AND m.chat_id = ?) OR
-            (m.sender_id = ? AND m.chat_type = 'user' AND m.chat_id = u.id)
-        )
-        WHERE u.id != ? AND m.id IN (
-            SELECT MAX(m2.id) FROM messages m2 
-            WHERE m2.chat_type = 'user' AND 
-            ((m2.sender_id = u.id AND m2.chat_id = ?) OR (m2.sender_id = ? AND m2.chat_id = u.id))
-        )
-        ORDER BY m.created_at DESC
-    ''', (current_user.id, current_user.id, current_user.id, current_user.id, current_user.id))
-    
+               cs.last_message_preview as last_message, cs.last_message_at as last_message_time,
+               COALESCE(uc.unread, 0) as unread
+        FROM (
+            SELECT peer_id AS other_id, chat_id, peer_id, last_message_id,
+                   last_message_preview, last_message_at
+            FROM conversation_summaries
+            WHERE chat_type = 'user' AND chat_id = ?
+            UNION ALL
+            SELECT chat_id AS other_id, chat_id, peer_id, last_message_id,
+                   last_message_preview, last_message_at
+            FROM conversation_summaries
+            WHERE chat_type = 'user' AND peer_id = ?
+        ) cs
+        JOIN users u ON u.id = cs.other_id
+        LEFT JOIN unread_counts uc
+            ON uc.user_id = ? AND uc.chat_type = 'user' AND uc.chat_id = cs.chat_id AND uc.peer_id = cs.peer_id
+        WHERE u.id != ?
+        ORDER BY cs.last_message_id DESC
+    ''', (user_id, user_id, user_id, user_id))
+
     individual_chats = []
     for row in cursor.fetchall():
         individual_chats.append({
@@ -327,9 +230,9 @@ def get_chats():
             'avatar': row[8] or '/static/default-avatar.png',
             'lastMessage': row[11] or 'No messages yet',
             'timestamp': row[12] or datetime.now().isoformat(),
-            'unread': 0,  # TODO: implement unread count
+            'unread': row[13],
             'type': 'individual',
-            'isOnline': bool(row[9]),
+            'isOnline': presence.is_online(row[0], bool(row[9])),
             'department': row[3],
             'location': row[4],
             'phone': row[5],
@@ -337,33 +240,35 @@ def get_chats():
             'bio': row[7],
             'lastSeen': row[10]
         })
-    
-    conn.close()
-    return jsonify(individual_chats)
+    return individual_chats
 
 @app.route('/api/groups')
 @login_required
 def get_groups():
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        groups = _group_list(conn.cursor(), current_user.id)
     
-    # Get groups the user is a member of
+    return jsonify(groups)
+
+def _group_list(cursor, user_id):
+    """Groups user_id is a member of, most recently active first"""
     cursor.execute('''
         SELECT g.id, g.name, g.description, g.avatar_url, g.expires_at, g.created_at,
                c.name as community_name, c.id as community_id,
                (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
-               m.content as last_message, m.created_at as last_message_time
+               cs.last_message_preview as last_message, cs.last_message_at as last_message_time,
+               COALESCE(uc.unread, 0) as unread
         FROM groups g
         JOIN group_members gm ON g.id = gm.group_id
         JOIN communities c ON g.community_id = c.id
-        LEFT JOIN messages m ON m.chat_type = 'group' AND m.chat_id = g.id
-        WHERE gm.user_id = ? AND (m.id IS NULL OR m.id IN (
-            SELECT MAX(m2.id) FROM messages m2 
-            WHERE m2.chat_type = 'group' AND m2.chat_id = g.id
-        ))
-        ORDER BY COALESCE(m.created_at, g.created_at) DESC
-    ''', (current_user.id,))
-    
+        LEFT JOIN conversation_summaries cs
+            ON cs.chat_type = 'group' AND cs.chat_id = g.id AND cs.peer_id = 0
+        LEFT JOIN unread_counts uc
+            ON uc.user_id = gm.user_id AND uc.chat_type = 'group' AND uc.chat_id = g.id AND uc.peer_id = 0
+        WHERE gm.user_id = ?
+        ORDER BY COALESCE(cs.last_message_at, g.created_at) DESC
+    ''', (user_id,))
+
     groups = []
     for row in cursor.fetchall():
         groups.append({
@@ -380,20 +285,9 @@ def get_groups():
             'members': row[8],
             'lastMessage': row[9] or 'No messages yet',
             'timestamp': row[10] or row[5],
-            'unread': 0  # TODO: implement unread count
+            'unread': row[11]
         })
-
-    for row in cursor.fetchall():
-        group_id, name, desc, expiry = row
-        if expiry:
-            expiry_dt = datetime.datetime.fromisoformat(expiry)
-            if expiry_dt < row:
-                continue  # skip expired
-        groups.append({"id": group_id, "name": name, "description": desc})
-
-    
-    conn.close()
-    return jsonify(groups)
+    return groups
 
 
 
@@ -401,11 +295,10 @@ def get_groups():
 @login_required
 def check_group_status():
     group_id = request.args.get("group_id")
-    conn = sqlite3.connect("docktalk.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT expires_at FROM groups WHERE id = ?", (group_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT expires_at FROM groups WHERE id = ?", (group_id,))
+        row = cursor.fetchone()
     if row and row[0]:
         expiry_dt = datetime.datetime.fromisoformat(row[0])
         if datetime.datetime.utcnow() > expiry_dt:
@@ -416,65 +309,40 @@ def check_group_status():
 @app.route('/api/communities')
 @login_required
 def get_communities():
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    
-    # Get communities the user is a member of
-    cursor.execute('''
-        SELECT c.id, c.name, c.description, c.avatar_url, c.created_at,
-               (SELECT COUNT(*) FROM community_members WHERE community_id = c.id) as member_count
-        FROM communities c
-        JOIN community_members cm ON c.id = cm.community_id
-        WHERE cm.user_id = ?
-        ORDER BY c.created_at DESC
-    ''', (current_user.id,))
-    
-    communities = []
-    for row in cursor.fetchall():
-        community_id = row[0]
-        
-        # Get groups in this community that the user is a member of
-        cursor.execute('''
-            SELECT g.id, g.name, g.description, g.avatar_url, g.expires_at, g.created_at,
-                   (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
-                   m.content as last_message, m.created_at as last_message_time
-            FROM groups g
-            JOIN group_members gm ON g.id = gm.group_id
-            LEFT JOIN messages m ON m.chat_type = 'group' AND m.chat_id = g.id
-            WHERE g.community_id = ? AND gm.user_id = ? AND (m.id IS NULL OR m.id IN (
-                SELECT MAX(m2.id) FROM messages m2 
-                WHERE m2.chat_type = 'group' AND m2.chat_id = g.id
-            ))
-            ORDER BY COALESCE(m.created_at, g.created_at) DESC
-        ''', (community_id, current_user.id))
-        
-        groups = []
-        for group_row in cursor.fetchall():
-            groups.append({
-                'id': str(group_row[0]),
-                'name': group_row[1],
-                'description': group_row[2],
-                'avatar': group_row[3] or '/static/default-group.png',
-                'expiresAt': group_row[4],
-                'createdAt': group_row[5],
-                'members': group_row[6],
-                'lastMessage': group_row[7] or 'No messages yet',
-                'timestamp': group_row[8] or group_row[5],
-                'unread': 0
-            })
-        
-        communities.append({
-            'id': str(row[0]),
-            'name': row[1],
-            'description': row[2],
-            'avatar': row[3] or '/static/default-community.png',
-            'createdAt': row[4],
-            'members': row[5],
-            'groups': groups
-        })
-    
-    conn.close()
-    return jsonify(communities)
+    with get_db() as conn:
+        activity = group_activity(conn.cursor(), current_user.id)
+    return jsonify(community_tree(current_user.id, activity))
+
+# Everything the sidebar needs on page load in one response, instead of
+# /api/chats, /api/groups, /api/communities and /api/presence in turn. The
+# community tree comes from the cache with activity from the group list.
+# The strong ETag lets a reload with unchanged state end in a 304.
+@app.route('/api/bootstrap')
+@login_required
+def get_bootstrap():
+    with get_db() as conn:
+        cursor = conn.cursor()
+        chats = _chat_list(cursor, current_user.id)
+        groups = _group_list(cursor, current_user.id)
+
+    activity = {int(group['id']): (group['lastMessage'], group['timestamp'], group['unread']) for group in groups}
+    communities = community_tree(current_user.id, activity)
+
+    chat_unread = sum(chat['unread'] for chat in chats)
+    group_unread = sum(group['unread'] for group in groups)
+    response = jsonify({
+        'chats': chats,
+        'groups': groups,
+        'communities': communities,
+        'unread': {'chats': chat_unread, 'groups': group_unread, 'total': chat_unread + group_unread},
+        'presence': _presence_map([int(chat['id']) for chat in chats][:PRESENCE_BATCH])
+    })
+    response.add_etag()
+    # Always revalidate; the ETag makes that cheap when nothing changed
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response = response.make_conditional(request)
+    metrics.incr('bootstrap.not_modified' if response.status_code == 304 else 'bootstrap.full')
+    return response
 
 # @app.route('/api/messages')
 # @login_required
@@ -541,25 +409,26 @@ def create_community():
     if not name:
         return jsonify({'error': 'Community name is required'}), 400
     
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    # Create community
-    cursor.execute('''
-        INSERT INTO communities (name, description, created_by)
-        VALUES (?, ?, ?)
-    ''', (name, description, current_user.id))
+        # Create community
+        cursor.execute('''
+            INSERT INTO communities (name, description, created_by)
+            VALUES (?, ?, ?)
+        ''', (name, description, current_user.id))
     
-    community_id = cursor.lastrowid
+        community_id = cursor.lastrowid
     
-    # Add creator as admin
-    cursor.execute('''
-        INSERT INTO community_members (community_id, user_id, role)
-        VALUES (?, ?, 'admin')
-    ''', (community_id, current_user.id))
+        # Add creator as admin
+        cursor.execute('''
+            INSERT INTO community_members (community_id, user_id, role)
+            VALUES (?, ?, 'admin')
+        ''', (community_id, current_user.id))
     
-    conn.commit()
-    conn.close()
+        touch(cursor, 'communities', 'community_members')
+        conn.commit()
+    invalidate_communities()
     
     return jsonify({'success': True, 'community_id': community_id})
 
@@ -576,34 +445,34 @@ def create_group():
         return jsonify({'error': 'Group name and community ID are required'}), 400
     
     # Check if user is member of the community
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT role FROM community_members 
-        WHERE community_id = ? AND user_id = ?
-    ''', (community_id, current_user.id))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT role FROM community_members 
+            WHERE community_id = ? AND user_id = ?
+        ''', (community_id, current_user.id))
     
-    membership = cursor.fetchone()
-    if not membership:
-        conn.close()
-        return jsonify({'error': 'You must be a member of the community to create groups'}), 403
+        membership = cursor.fetchone()
+        if not membership:
+            return jsonify({'error': 'You must be a member of the community to create groups'}), 403
     
-    # Create group
-    cursor.execute('''
-        INSERT INTO groups (name, description, community_id, created_by, expires_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (name, description, community_id, current_user.id, expires_at))
+        # Create group
+        cursor.execute('''
+            INSERT INTO groups (name, description, community_id, created_by, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (name, description, community_id, current_user.id, expires_at))
     
-    group_id = cursor.lastrowid
+        group_id = cursor.lastrowid
     
-    # Add creator as admin
-    cursor.execute('''
-        INSERT INTO group_members (group_id, user_id, role)
-        VALUES (?, ?, 'admin')
-    ''', (group_id, current_user.id))
+        # Add creator as admin
+        cursor.execute('''
+            INSERT INTO group_members (group_id, user_id, role)
+            VALUES (?, ?, 'admin')
+        ''', (group_id, current_user.id))
     
-    conn.commit()
-    conn.close()
+        touch(cursor, 'groups', 'group_members')
+        conn.commit()
+    invalidate_communities()
     
     return jsonify({'success': True, 'group_id': group_id})
 
@@ -616,58 +485,61 @@ def join_community():
     if not community_id:
         return jsonify({'error': 'Community ID is required'}), 400
     
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    # Add user to community
-    cursor.execute('''
-        INSERT OR IGNORE INTO community_members (community_id, user_id, role)
-        VALUES (?, ?, 'member')
-    ''', (community_id, current_user.id))
+        # Add user to community
+        cursor.execute('''
+            INSERT OR IGNORE INTO community_members (community_id, user_id, role)
+            VALUES (?, ?, 'member')
+        ''', (community_id, current_user.id))
     
-    conn.commit()
-    conn.close()
+        touch(cursor, 'community_members')
+        conn.commit()
+    invalidate_communities()
+    # Announcements to the community reach its members from now on
+    _enter_rooms(current_user.id, f"community_{community_id}")
     
     return jsonify({'success': True})
 
 @app.route('/api/groups/all')
 @login_required
+@cached_response(('communities', 'community_members', 'groups', 'group_members'), per_user=True)
 def get_all_groups():
     """Get all groups in communities the user is a member of"""
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT g.id, g.name, g.description, g.avatar_url, g.expires_at, g.created_at,
-               c.name as community_name, c.id as community_id,
-               (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
-               CASE WHEN gm.user_id IS NOT NULL THEN 1 ELSE 0 END as is_member
-        FROM groups g
-        JOIN communities c ON g.community_id = c.id
-        JOIN community_members cm ON c.id = cm.community_id
-        LEFT JOIN group_members gm ON g.id = gm.group_id AND gm.user_id = ?
-        WHERE cm.user_id = ?
-        ORDER BY c.name, g.name
-    ''', (current_user.id, current_user.id))
+        cursor.execute('''
+            SELECT g.id, g.name, g.description, g.avatar_url, g.expires_at, g.created_at,
+                   c.name as community_name, c.id as community_id,
+                   (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
+                   CASE WHEN gm.user_id IS NOT NULL THEN 1 ELSE 0 END as is_member
+            FROM groups g
+            JOIN communities c ON g.community_id = c.id
+            JOIN community_members cm ON c.id = cm.community_id
+            LEFT JOIN group_members gm ON g.id = gm.group_id AND gm.user_id = ?
+            WHERE cm.user_id = ?
+            ORDER BY c.name, g.name
+        ''', (current_user.id, current_user.id))
     
-    groups = []
-    for row in cursor.fetchall():
-        groups.append({
-            'id': str(row[0]),
-            'name': row[1],
-            'description': row[2],
-            'avatar': row[3] or '/static/default-group.png',
-            'expiresAt': row[4],
-            'createdAt': row[5],
-            'community': {
-                'id': str(row[7]),
-                'name': row[6]
-            },
-            'members': row[8],
-            'is_member': bool(row[9])
-        })
+        groups = []
+        for row in cursor.fetchall():
+            groups.append({
+                'id': str(row[0]),
+                'name': row[1],
+                'description': row[2],
+                'avatar': row[3] or '/static/default-group.png',
+                'expiresAt': row[4],
+                'createdAt': row[5],
+                'community': {
+                    'id': str(row[7]),
+                    'name': row[6]
+                },
+                'members': row[8],
+                'is_member': bool(row[9])
+            })
     
-    conn.close()
     return jsonify(groups)
 
 @app.route('/api/join_group', methods=['POST'])
@@ -680,26 +552,28 @@ def join_group():
         return jsonify({'error': 'Group ID is required'}), 400
     
     # Check if user is member of the group's community
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT g.community_id FROM groups g
-        JOIN community_members cm ON g.community_id = cm.community_id
-        WHERE g.id = ? AND cm.user_id = ?
-    ''', (group_id, current_user.id))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT g.community_id FROM groups g
+            JOIN community_members cm ON g.community_id = cm.community_id
+            WHERE g.id = ? AND cm.user_id = ?
+        ''', (group_id, current_user.id))
     
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'You must be a member of the community to join this group'}), 403
+        community = cursor.fetchone()
+        if not community:
+            return jsonify({'error': 'You must be a member of the community to join this group'}), 403
     
-    # Add user to group
-    cursor.execute('''
-        INSERT OR IGNORE INTO group_members (group_id, user_id, role)
-        VALUES (?, ?, 'member')
-    ''', (group_id, current_user.id))
+        # Add user to group
+        cursor.execute('''
+            INSERT OR IGNORE INTO group_members (group_id, user_id, role)
+            VALUES (?, ?, 'member')
+        ''', (group_id, current_user.id))
     
-    conn.commit()
-    conn.close()
+        touch(cursor, 'group_members')
+        conn.commit()
+    invalidate_communities()
+    _enter_rooms(current_user.id, f"group_{group_id}", f"community_{community[0]}")
     
     return jsonify({'success': True})
 
@@ -710,18 +584,12 @@ def search_users():
     if not query:
         return jsonify([])
     
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, username, full_name, department, location, avatar_url, is_online
-        FROM users
-        WHERE (full_name LIKE ? OR username LIKE ? OR department LIKE ?) AND id != ?
-        LIMIT 20
-    ''', (f'%{query}%', f'%{query}%', f'%{query}%', current_user.id))
+    with metrics.timer('search.users'), get_db() as conn:
+        rows = search_user_directory(conn.cursor(), query, exclude_id=current_user.id,
+                                     is_online=presence.is_online)
     
     users = []
-    for row in cursor.fetchall():
+    for row in rows:
         users.append({
             'id': row[0],
             'username': row[1],
@@ -732,38 +600,79 @@ def search_users():
             'is_online': row[6]
         })
     
-    conn.close()
     return jsonify(users)
 
+@app.route('/api/presence')
+@login_required
+def get_presence():
+    """Online state and last seen time for ?ids=1,2,3 (at most PRESENCE_BATCH)"""
+    ids = []
+    for value in request.args.get('ids', '').split(','):
+        if value.strip().isdigit():
+            ids.append(int(value))
+    ids = list(dict.fromkeys(ids))[:PRESENCE_BATCH]
+    return jsonify(_presence_map(ids))
+
+def _presence_map(ids):
+    """{str(id): {'online', 'last_seen'}} from live presence, falling back to
+    the stored flags for users no worker has seen"""
+    if not ids:
+        return {}
+    known = presence.lookup(ids)
+    missing = [user_id for user_id in ids if user_id not in known]
+    stored = {}
+    if missing:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, is_online, last_seen FROM users
+                WHERE id IN ({','.join('?' * len(missing))})
+            ''', missing)
+            stored = {row[0]: row for row in cursor.fetchall()}
+    
+    result = {}
+    for user_id in ids:
+        if user_id in known:
+            online, last_seen = known[user_id]
+        elif user_id in stored:
+            online, last_seen = bool(stored[user_id][1]), stored[user_id][2]
+        else:
+            continue
+        result[str(user_id)] = {
+            'online': online,
+            'last_seen': last_seen.replace(' ', 'T') + 'Z' if last_seen else None
+        }
+    return result
+
 @app.route('/api/communities/all')
 @login_required
+@cached_response(('communities', 'community_members'), per_user=True)
 def get_all_communities():
     """Get all communities for joining"""
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT c.id, c.name, c.description, c.avatar_url, c.created_at,
-               (SELECT COUNT(*) FROM community_members WHERE community_id = c.id) as member_count,
-               CASE WHEN cm.user_id IS NOT NULL THEN 1 ELSE 0 END as is_member
-        FROM communities c
-        LEFT JOIN community_members cm ON c.id = cm.community_id AND cm.user_id = ?
-        ORDER BY c.created_at DESC
-    ''', (current_user.id,))
-    
-    communities = []
-    for row in cursor.fetchall():
-        communities.append({
-            'id': str(row[0]),
-            'name': row[1],
-            'description': row[2],
-            'avatar': row[3] or '/static/default-community.png',
-            'createdAt': row[4],
-            'members': row[5],
-            'is_member': bool(row[6])
-        })
+        cursor.execute('''
+            SELECT c.id, c.name, c.description, c.avatar_url, c.created_at,
+                   (SELECT COUNT(*) FROM community_members WHERE community_id = c.id) as member_count,
+                   CASE WHEN cm.user_id IS NOT NULL THEN 1 ELSE 0 END as is_member
+            FROM communities c
+            LEFT JOIN community_members cm ON c.id = cm.community_id AND cm.user_id = ?
+            ORDER BY c.created_at DESC
+        ''', (current_user.id,))
+    
+        communities = []
+        for row in cursor.fetchall():
+            communities.append({
+                'id': str(row[0]),
+                'name': row[1],
+                'description': row[2],
+                'avatar': row[3] or '/static/default-community.png',
+                'createdAt': row[4],
+                'members': row[5],
+                'is_member': bool(row[6])
+            })
     
-    conn.close()
     return jsonify(communities)
 
 @app.route('/api/start_chat', methods=['POST'])
@@ -777,35 +686,26 @@ def start_chat():
         return jsonify({'error': 'User ID is required'}), 400
     
     # Get target user info
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, username, full_name, department, location, phone, email, bio, avatar_url, is_online
-        FROM users WHERE id = ?
-    ''', (target_user_id,))
-    
-    user_data = cursor.fetchone()
-    if not user_data:
-        conn.close()
+    row = get_profile(target_user_id)
+    if not row:
         return jsonify({'error': 'User not found'}), 404
-    
-    conn.close()
+    target = User(*row)
     
     chat_info = {
-        'id': str(user_data[0]),
-        'name': user_data[2],
-        'username': user_data[1],
-        'avatar': user_data[8] or '/static/default-avatar.png',
+        'id': str(target.id),
+        'name': target.full_name,
+        'username': target.username,
+        'avatar': target.avatar_url or '/static/default-avatar.png',
         'lastMessage': 'Start a conversation',
         'timestamp': datetime.now().isoformat(),
         'unread': 0,
         'type': 'individual',
-        'isOnline': bool(user_data[9]),
-        'department': user_data[3],
-        'location': user_data[4],
-        'phone': user_data[5],
-        'email': user_data[6],
-        'bio': user_data[7]
+        'isOnline': presence.is_online(target.id, bool(target.is_online)),
+        'department': target.department,
+        'location': target.location,
+        'phone': target.phone,
+        'email': target.email,
+        'bio': target.bio
     }
     
     return jsonify({'success': True, 'chat': chat_info})
@@ -832,6 +732,58 @@ def format_file_size(size_bytes):
     s = round(size_bytes / p, 2)
     return f"{s} {size_names[i]}"
 
+def _upload_result(stored, file_name, file_type):
+    return {
+        'success': True,
+        'file_url': stored['url'],
+        'file_name': file_name,
+        'file_size': format_file_size(stored['size']),
+        'file_type': file_type,
+        'mime_type': mimetypes.guess_type(file_name)[0],
+        'media': stored['media']
+    }
+
+def _voice_processed(url, media):
+    """Record a voice note's real duration and waveform (voice.py) on its
+    attachment and on the messages already sent with it, and tell their
+    chats"""
+    # One transaction: a message queued before this commit either gets
+    # updated here or picks the media up from attachments when inserted
+    with get_db() as conn:
+        conn.execute('UPDATE attachments SET media = ? WHERE url = ?', (json.dumps(media), url))
+        sent = conn.execute('''
+            UPDATE messages SET media = ?, voice_duration = ?
+            WHERE file_url = ? AND media IS NULL
+            RETURNING id, sender_id, chat_type, chat_id
+        ''', (json.dumps(media), _voice_duration(media, None), url)).fetchall()
+        conn.commit()
+    for message_id, sender_id, chat_type, chat_id in sent:
+        update = {'id': message_id, 'chat_type': chat_type, 'chat_id': chat_id, 'media': media}
+        if chat_type == 'user':
+            fanout.emit('message_media', update, room=f"user_{sender_id}")
+            fanout.emit('message_media', update, room=f"user_{chat_id}")
+        else:
+            fanout.emit('message_media', update, room=f"group_{chat_id}")
+
+def _analyze_voice(stored, file_type):
+    """Queue a voice note that has no duration and waveform yet"""
+    if file_type == 'voice' and stored['media'] is None:
+        url = stored['url']
+        voice.submit(storage.path_for(url), lambda media: _voice_processed(url, media))
+
+def _store_upload(temp_path, file_name, file_type, sha256):
+    """Store a fully received upload by its content (storage.py); returns
+    the upload result"""
+    file_extension = file_name.rsplit('.', 1)[1].lower()
+    try:
+        stored = storage.store(temp_path, sha256, file_extension, file_type, current_user.id)
+    finally:
+        # Left behind when the same content was stored already
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    _analyze_voice(stored, file_type)
+    return _upload_result(stored, file_name, file_type)
+
 @app.route('/api/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -845,136 +797,174 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     
     if file and allowed_file(file.filename, file_type):
-        # Generate unique filename
-        file_extension = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        
-        # Determine upload path based on file type
-        if file_type == 'image':
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images')
-        elif file_type == 'voice':
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], 'voice')
-        else:
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], 'files')
-        
-        os.makedirs(upload_path, exist_ok=True)
-        file_path = os.path.join(upload_path, unique_filename)
-        file.save(file_path)
-        
-        # Process image files
-        if file_type == 'image':
-            try:
-                # Create thumbnail
-                with Image.open(file_path) as img:
-                    img.thumbnail((800, 600), Image.Resampling.LANCZOS)
-                    img.save(file_path, optimize=True, quality=85)
-            except Exception as e:
-                print(f"Error processing image: {e}")
-        
-        # Get file size
-        file_size = os.path.getsize(file_path)
-        file_size_str = format_file_size(file_size)
-        
-        # Generate file URL - Fix the path issue
-        if file_type == 'image':
-            file_url = f"/static/uploads/images/{unique_filename}"
-        elif file_type == 'voice':
-            file_url = f"/static/uploads/voice/{unique_filename}"
-        else:
-            file_url = f"/static/uploads/files/{unique_filename}"
-        
-        return jsonify({
-            'success': True,
-            'file_url': file_url,
-            'file_name': file.filename,
-            'file_size': file_size_str,
-            'file_type': file_type,
-            'mime_type': mimetypes.guess_type(file.filename)[0]
-        })
+        temp_path, _, sha256 = uploads.save_stream(file.stream)
+        return jsonify(_store_upload(temp_path, file.filename, file_type, sha256))
     
     return jsonify({'error': 'File type not allowed'}), 400
 
+# Uploaded files, in place of the static view for this prefix: ranges,
+# immutable caching and sendfile (see media.py)
+@app.route('/static/uploads/<path:filename>')
+def uploaded_media(filename):
+    return media.send(filename)
+
+# Resumable chunked uploads for large attachments and flaky links; the
+# protocol is described in uploads.py
+def _upload_error(error):
+    body = {'error': str(error)}
+    if error.offset is not None:
+        body['offset'] = error.offset
+    return jsonify(body), error.status
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def start_upload():
+    data = request.get_json() or {}
+    file_name = data.get('file_name') or ''
+    file_type = data.get('file_type', 'file')
+    if not allowed_file(file_name, file_type):
+        return jsonify({'error': 'File type not allowed'}), 400
+    # A file this user uploaded before is not sent again; other content is
+    # only matched once its bytes have arrived and been hashed (storage.py)
+    if data.get('sha256'):
+        stored = storage.lookup(data['sha256'], file_type, uploader_id=current_user.id)
+        if stored is not None and stored['size'] == data.get('size'):
+            _analyze_voice(stored, file_type)
+            return jsonify(_upload_result(stored, file_name, file_type))
+    try:
+        return jsonify(uploads.create_session(current_user.id, file_name, file_type, data.get('size'),
+                                              data.get('sha256')))
+    except uploads.UploadError as e:
+        return _upload_error(e)
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    try:
+        upload = uploads.get_session(upload_id, current_user.id)
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    return jsonify({'upload_id': upload_id, 'offset': upload['received'], 'size': upload['size'],
+                    'status': upload['status']})
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({'error': 'offset is required'}), 400
+    try:
+        offset = uploads.write_chunk(upload_id, current_user.id, offset, request.stream,
+                                     request.content_length, request.headers.get('X-Chunk-SHA256'))
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    return jsonify({'offset': offset})
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(uploads.finalize(upload_id, current_user.id, data.get('sha256'), _store_upload))
+    except uploads.UploadError as e:
+        return _upload_error(e)
+
 def add_user_to_nimasa_community(user_id):
     """Add new user to NIMASA community automatically"""
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    # Check if NIMASA community exists, create if not
-    cursor.execute('SELECT id FROM communities WHERE name = ?', ('NIMASA Maritime Community',))
-    community = cursor.fetchone()
+        # Check if NIMASA community exists, create if not
+        cursor.execute('SELECT id FROM communities WHERE name = ?', ('NIMASA Maritime Community',))
+        community = cursor.fetchone()
     
-    if not community:
+        if not community:
+            cursor.execute('''
+                INSERT INTO communities (name, description, created_by)
+                VALUES (?, ?, ?)
+            ''', ('NIMASA Maritime Community', 'Official NIMASA community for maritime professionals across Nigeria', user_id))
+            community_id = cursor.lastrowid
+        else:
+            community_id = community[0]
+    
+        # Add user to community
         cursor.execute('''
-            INSERT INTO communities (name, description, created_by)
+            INSERT OR IGNORE INTO community_members (community_id, user_id, role)
             VALUES (?, ?, ?)
-        ''', ('NIMASA Maritime Community', 'Official NIMASA community for maritime professionals across Nigeria', user_id))
-        community_id = cursor.lastrowid
-    else:
-        community_id = community[0]
+        ''', (community_id, user_id, 'member'))
+
+        # Add userto group
+        cursor.execute('''
+            INSERT INTO group_members (group_id, user_id, role)
+            VALUES (?, ?, ?)
+        ''', (0, user_id, 'membe'))
     
-    # Add user to community
-    cursor.execute('''
-        INSERT OR IGNORE INTO community_members (community_id, user_id, role)
-        VALUES (?, ?, ?)
-    ''', (community_id, user_id, 'member'))
+        touch(cursor, 'communities', 'community_members', 'group_members')
+        conn.commit()
+    invalidate_communities()
+    _enter_rooms(user_id, f"community_{community_id}", "group_0")
 
-    # Add userto group
+def _member_rooms(cursor, user_id):
+    """Group and community rooms a user's sockets belong in"""
     cursor.execute('''
-        INSERT INTO group_members (group_id, user_id, role)
-        VALUES (?, ?, ?)
-    ''', (0, user_id, 'membe'))
-    
-    conn.commit()
-    conn.close()
+        SELECT 'group_' || group_id FROM group_members WHERE user_id = ?
+        UNION
+        SELECT 'community_' || community_id FROM community_members WHERE user_id = ?
+        UNION
+        SELECT 'community_' || g.community_id FROM groups g
+        JOIN group_members gm ON g.id = gm.group_id
+        WHERE gm.user_id = ? AND g.community_id IS NOT NULL
+    ''', (user_id, user_id, user_id))
+    return [row[0] for row in cursor.fetchall()]
+
+def _enter_rooms(user_id, *rooms):
+    """Add a user's sockets to rooms after they join a group or community
+    over HTTP. Only sockets held by this worker are known; with sticky
+    sessions that includes the browser that made the request, and sockets
+    elsewhere pick the rooms up when they reconnect."""
+    for sid in connection_registry.sids(user_id):
+        for room in rooms:
+            socketio.server.enter_room(sid, room, namespace='/')
+
+def _leave_rooms(user_id, *rooms):
+    """Take a user's sockets out of rooms after they leave a group (see
+    _enter_rooms for which sockets are reached)"""
+    for sid in connection_registry.sids(user_id):
+        for room in rooms:
+            socketio.server.leave_room(sid, room, namespace='/')
 
 # WebSocket event handlers
 @socketio.on('connect')
 def on_connect():
     if current_user.is_authenticated:
-        active_users[current_user.id] = request.sid
-        
-        # Update user online status
-        conn = sqlite3.connect('docktalk.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_online = TRUE WHERE id = ?', (current_user.id,))
-        conn.commit()
-        conn.close()
+        # A user can have several tabs or devices connected; only the first
+        # one changes their online state
+        try:
+            transport = socketio.server.transport(request.sid, namespace='/')
+        except (KeyError, ValueError):
+            transport = None
+        if connection_registry.add(current_user.id, request.sid, transport):
+            presence.set_online(current_user.id, True)
         
         # Join user to their personal room
         join_room(f"user_{current_user.id}")
         
-        # Join user to all their group rooms
-        conn = sqlite3.connect('docktalk.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT g.id FROM groups g
-            JOIN group_members gm ON g.id = gm.group_id
-            WHERE gm.user_id = ?
-        ''', (current_user.id,))
+        # Join user to all their group rooms, and to the community rooms
+        # for announcements
+        with get_db() as conn:
+            for room in _member_rooms(conn.cursor(), current_user.id):
+                join_room(room)
         
-        for (group_id,) in cursor.fetchall():
-            join_room(f"group_{group_id}")
-        
-        conn.close()
-        
-        emit('user_status', {'user_id': current_user.id, 'status': 'online'}, broadcast=True)
         print(f"User {current_user.username} connected")
 
 @socketio.on('disconnect')
 def on_disconnect():
     if current_user.is_authenticated:
-        # Remove from active users
-        if current_user.id in active_users:
-            del active_users[current_user.id]
-        
-        # Update user offline status
-        conn = sqlite3.connect('docktalk.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_online = FALSE, last_seen = CURRENT_TIMESTAMP WHERE id = ?', (current_user.id,))
-        conn.commit()
-        conn.close()
-        
-        emit('user_status', {'user_id': current_user.id, 'status': 'offline'}, broadcast=True)
+        user_id, last_session = connection_registry.remove(request.sid)
+        if last_session:
+            presence.set_online(user_id, False)
+            typing_state.clear_user(user_id)
         print(f"User {current_user.username} disconnected")
 
 @socketio.on('join_chat')
@@ -985,9 +975,9 @@ def on_join_chat(data):
     chat_type = data.get('type')  # 'user' or 'group'
     chat_id = data.get('id')
     
-    if chat_type == 'user':
-        join_room(f"user_{chat_id}")
-    elif chat_type == 'group':
+    # Direct messages reach each user through their personal room, joined on
+    # connect; joining the other user's room would leak their events
+    if chat_type == 'group':
         join_room(f"group_{chat_id}")
     
     print(f"User {current_user.username} joined {chat_type}_{chat_id}")
@@ -1000,11 +990,32 @@ def on_leave_chat(data):
     chat_type = data.get('type')
     chat_id = data.get('id')
     
-    if chat_type == 'user':
-        leave_room(f"user_{chat_id}")
-    elif chat_type == 'group':
+    if chat_type == 'group':
         leave_room(f"group_{chat_id}")
 
+def _chat_target(data):
+    """(chat_type, chat_id) named by a socket payload, or None if it is
+    malformed"""
+    chat_type = data.get('chat_type')
+    try:
+        chat_id = int(data.get('chat_id'))
+    except (TypeError, ValueError):
+        return None
+    return (chat_type, chat_id) if chat_type in ('user', 'group') else None
+
+def _voice_duration(media, fallback):
+    """Whole seconds of a voice note from its analysis, else fallback"""
+    if media and media.get('duration') is not None:
+        return max(1, round(media['duration']))
+    return fallback
+
+def _attachment_media(url):
+    if not url:
+        return None
+    with get_db() as conn:
+        row = conn.execute('SELECT media FROM attachments WHERE url = ?', (url,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
 @socketio.on('send_message')
 def on_send_message(data):
     if not current_user.is_authenticated:
@@ -1019,14 +1030,21 @@ def on_send_message(data):
     if not message_content and message_type == 'text':
         return
     
-    # Save message to database
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    target = _chat_target(data)
+    if target is None:
+        emit('message_error', {'message': 'Message could not be sent'})
+        return
+    chat_type, chat_id = target
     
-    cursor.execute('''
-        INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, file_url, file_name, file_size, voice_duration)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    # Rendition URLs and sizes, or a voice note's duration and waveform,
+    # recorded when the file was uploaded
+    media = _attachment_media(file_data.get('url')) if message_type != 'text' else None
+    if message_type == 'voice':
+        file_data = dict(file_data, duration=_voice_duration(media, file_data.get('duration')))
+    
+    # Queue the message for the batched writer; the summary and unread
+    # counters are updated in the same transaction
+    pending = message_writer.submit(
         message_content,
         message_type,
         current_user.id,
@@ -1035,12 +1053,22 @@ def on_send_message(data):
         file_data.get('url'),
         file_data.get('name'),
         file_data.get('size'),
-        file_data.get('duration')
-    ))
+        file_data.get('duration'),
+        json.dumps(media) if media else None
+    )
+    try:
+        message_id = pending.wait()
+    except Exception as e:
+        print(f"Failed to save message from {current_user.username}: {e}")
+        emit('message_error', {'message': 'Message could not be sent'})
+        return
     
-    message_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    if message_type == 'voice' and media is None:
+        # Analysis may have finished while the message was queued, and the
+        # writer stored it with the message; if not, _voice_processed
+        # updates the message and its chat later
+        media = _attachment_media(file_data.get('url'))
+        file_data['duration'] = _voice_duration(media, file_data.get('duration'))
     
     # Prepare message data for broadcast
     message_data = {
@@ -1056,16 +1084,30 @@ def on_send_message(data):
         'timestamp': datetime.now().isoformat(),
         'chat_type': chat_type,
         'chat_id': chat_id,
-        'file_data': file_data
+        'file_data': file_data,
+        'media': media
     }
     
     # Broadcast message to appropriate room
     if chat_type == 'user':
         # Send to both sender and receiver
-        emit('new_message', message_data, room=f"user_{current_user.id}")
-        emit('new_message', message_data, room=f"user_{chat_id}")
+        fanout.emit('new_message', message_data, room=f"user_{current_user.id}")
+        fanout.emit('new_message', message_data, room=f"user_{chat_id}")
+        fanout.emit('unread_update', {
+            'user_id': int(chat_id),
+            'chat_type': 'user',
+            'chat_id': current_user.id,
+            'sender_id': current_user.id,
+            'delta': 1
+        }, room=f"user_{chat_id}")
     elif chat_type == 'group':
-        emit('new_message', message_data, room=f"group_{chat_id}")
+        fanout.emit('new_message', message_data, room=f"group_{chat_id}")
+        fanout.emit('unread_update', {
+            'chat_type': 'group',
+            'chat_id': chat_id,
+            'sender_id': current_user.id,
+            'delta': 1
+        }, room=f"group_{chat_id}")
     
     print(f"Message sent by {current_user.username} to {chat_type}_{chat_id}")
 
@@ -1080,87 +1122,66 @@ def on_send_announcement(data):
     if not content:
         return
     
-    # Get all groups in the community
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM groups WHERE community_id = ?', (community_id,))
-    group_ids = [row[0] for row in cursor.fetchall()]
-    
-    # Send announcement to all groups
-    for group_id in group_ids:
+    # Store the announcement once, then link it to every group in the
+    # community with a single INSERT ... SELECT
+    with metrics.timer('announcement.store'), get_db() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, is_announcement)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (content, 'announcement', current_user.id, 'group', group_id, True))
-        
-        message_id = cursor.lastrowid
-        
-        # Broadcast announcement
-        announcement_data = {
-            'id': message_id,
-            'content': content,
-            'type': 'announcement',
-            'sender': {
-                'id': current_user.id,
-                'name': current_user.full_name,
-                'username': current_user.username
-            },
-            'timestamp': datetime.now().isoformat(),
-            'chat_type': 'group',
-            'chat_id': group_id,
-            'is_announcement': True
-        }
-        
-        emit('new_message', announcement_data, room=f"group_{group_id}")
+            INSERT INTO announcements (community_id, sender_id, content) VALUES (?, ?, ?)
+        ''', (community_id, current_user.id, content))
+        announcement_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, is_announcement, announcement_id)
+            SELECT ?, 'announcement', ?, 'group', id, TRUE, ?
+            FROM groups WHERE community_id = ?
+            ORDER BY id
+        ''', (content, current_user.id, announcement_id, community_id))
+        record_announcement(cursor, announcement_id, current_user.id)
+        cursor.execute('SELECT chat_id, id FROM messages WHERE announcement_id = ?', (announcement_id,))
+        group_messages = cursor.fetchall()
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    if not group_messages:
+        return
+    
+    # One emit to the community room; clients pick out the groups they are
+    # in from the (group_id, message_id) pairs
+    fanout.emit('new_announcement', {
+        'announcement_id': announcement_id,
+        'community_id': community_id,
+        'content': content,
+        'type': 'announcement',
+        'sender': {
+            'id': current_user.id,
+            'name': current_user.full_name,
+            'username': current_user.username
+        },
+        'timestamp': datetime.now().isoformat(),
+        'is_announcement': True,
+        'groups': group_messages
+    }, room=f"community_{community_id}")
     
     print(f"Announcement sent by {current_user.username} to community {community_id}")
 
+# Typing is kept per conversation and sent out as coalesced snapshots (see
+# typing_state.py) rather than relaying every client event
 @socketio.on('typing_start')
 def on_typing_start(data):
     if not current_user.is_authenticated:
         return
     
-    chat_type = data.get('chat_type')
-    chat_id = data.get('chat_id')
-    
-    typing_data = {
-        'user': {
-            'id': current_user.id,
-            'name': current_user.full_name
-        },
-        'chat_type': chat_type,
-        'chat_id': chat_id
-    }
-    
-    if chat_type == 'user':
-        emit('user_typing', typing_data, room=f"user_{chat_id}")
-    elif chat_type == 'group':
-        emit('user_typing', typing_data, room=f"group_{chat_id}")
+    target = _chat_target(data)
+    if target:
+        typing_state.start(current_user.id, current_user.full_name, *target)
 
 @socketio.on('typing_stop')
 def on_typing_stop(data):
     if not current_user.is_authenticated:
         return
     
-    chat_type = data.get('chat_type')
-    chat_id = data.get('chat_id')
-    
-    typing_data = {
-        'user': {
-            'id': current_user.id,
-            'name': current_user.full_name
-        },
-        'chat_type': chat_type,
-        'chat_id': chat_id
-    }
-    
-    if chat_type == 'user':
-        emit('user_stop_typing', typing_data, room=f"user_{chat_id}")
-    elif chat_type == 'group':
-        emit('user_stop_typing', typing_data, room=f"group_{chat_id}")
+    target = _chat_target(data)
+    if target:
+        typing_state.stop(current_user.id, *target)
 
 # WebRTC Call handling
 @socketio.on('start_call')
@@ -1172,27 +1193,22 @@ def on_start_call(data):
     target_type = data.get('target_type')  # 'user' or 'group'
     target_id = data.get('target_id')
     
+    if target_type == 'user' and not presence.is_online(target_id):
+        emit('call_error', {'message': 'User is not online'})
+        return
+    
     call_id = f"call_{uuid.uuid4()}"
     
-    # Store call in database
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO calls (call_id, caller_id, target_type, target_id, call_type, status)
-        VALUES (?, ?, ?, ?, ?, 'initiated')
-    ''', (call_id, current_user.id, target_type, target_id, call_type))
-    conn.commit()
-    conn.close()
-    
-    # Store active call
-    active_calls[call_id] = {
-        'caller_id': current_user.id,
-        'target_type': target_type,
-        'target_id': target_id,
-        'call_type': call_type,
-        'status': 'initiated',
-        'participants': [current_user.id]
-    }
+    # Call state lives in the database so any worker can answer or end it
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO calls (call_id, caller_id, target_type, target_id, call_type, status)
+            VALUES (?, ?, ?, ?, ?, 'initiated')
+        ''', (call_id, current_user.id, target_type, target_id, call_type))
+        cursor.execute('INSERT INTO call_participants (call_id, user_id) VALUES (?, ?)',
+                       (call_id, current_user.id))
+        conn.commit()
     
     call_data = {
         'call_id': call_id,
@@ -1220,26 +1236,22 @@ def on_answer_call(data):
     
     call_id = data.get('call_id')
     
-    if call_id not in active_calls:
-        emit('call_error', {'message': 'Call not found'})
-        return
-    
-    call = active_calls[call_id]
-    
-    # Add answerer to participants
-    if current_user.id not in call['participants']:
-        call['participants'].append(current_user.id)
-    
-    call['status'] = 'connected'
-    
-    # Update database
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE calls SET status = 'connected' WHERE call_id = ?
-    ''', (call_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE calls SET status = 'connected'
+            WHERE call_id = ? AND status IN ('initiated', 'connected')
+            RETURNING caller_id
+        ''', (call_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            emit('call_error', {'message': 'Call not found'})
+            return
+        # Add answerer to participants
+        cursor.execute('INSERT OR IGNORE INTO call_participants (call_id, user_id) VALUES (?, ?)',
+                       (call_id, current_user.id))
+        conn.commit()
     
     answer_data = {
         'call_id': call_id,
@@ -1251,7 +1263,7 @@ def on_answer_call(data):
     }
     
     # Notify caller
-    caller_id = call['caller_id']
+    caller_id = rows[0][0]
     emit('call_answered', answer_data, room=f"user_{caller_id}")
     
     # Join call room
@@ -1333,19 +1345,16 @@ def on_end_call(data):
     
     call_id = data.get('call_id')
     
-    if call_id in active_calls:
-        call = active_calls[call_id]
-        
-        # Update database
-        conn = sqlite3.connect('docktalk.db')
+    with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE calls SET status = 'ended', ended_at = CURRENT_TIMESTAMP 
-            WHERE call_id = ?
+            WHERE call_id = ? AND status IN ('initiated', 'connected')
         ''', (call_id,))
+        ended = cursor.rowcount > 0
         conn.commit()
-        conn.close()
-        
+    
+    if ended:
         end_data = {
             'call_id': call_id,
             'ended_by': current_user.id
@@ -1353,120 +1362,127 @@ def on_end_call(data):
         
         # Notify all participants
         emit('call_ended', end_data, room=f"call_{call_id}")
-        
-        # Clean up
-        del active_calls[call_id]
     
     # Leave call room
     leave_room(f"call_{call_id}")
 
 
-# PATCH FOR app.py — Add support for delivery and read receipts
+# Delivery and read receipts are per-conversation watermarks: the client
+# reports "delivered/seen up to message id X" once per conversation and the
+# per-message status is derived from those positions.
+@socketio.on('read_receipt')
+def handle_read_receipt(data):
+    if not current_user.is_authenticated:
+        return
 
-from flask_socketio import SocketIO, emit
-# (Make sure `socketio` is already initialized as it is in your current file)
+    target = _chat_target(data)
+    if target is None:
+        return
+    chat_type, chat_id = target
+    try:
+        delivered_id = int(data.get('delivered_up_to') or 0)
+        seen_id = int(data.get('seen_up_to') or 0)
+    except (TypeError, ValueError):
+        return
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+        advanced = advance_watermark(cursor, current_user.id, chat_type, chat_id,
+                                     delivered_id=delivered_id, seen_id=seen_id)
+        unread = get_unread(cursor, current_user.id, chat_type, chat_id)
+        conn.commit()
+
+    fanout.emit('unread_update', {
+        'user_id': current_user.id,
+        'chat_type': chat_type,
+        'chat_id': chat_id,
+        'unread': unread
+    }, room=f"user_{current_user.id}")
+
+    # Ticks only matter to the senders of the messages they are on; bursts
+    # are merged before they go out
+    for sender_id, status, up_to in advanced:
+        # The other participant of a direct chat sees it under our id
+        status_data = {'user_id': sender_id, 'chat_type': chat_type,
+                       'chat_id': current_user.id if chat_type == 'user' else chat_id,
+                       'status': status, 'up_to': up_to}
+        fanout.emit_status(f"user_{sender_id}", status_data)
+
+# Messages are paged by primary key: the default window is the newest
+# page, before_id walks back through history and after_id catches up.
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
 
-# --- NEW: Create message_status table if not already created
-def create_status_table():
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_status (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(message_id, user_id),
-            FOREIGN KEY (message_id) REFERENCES messages(id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-
-# --- NEW: Socket event for delivery
-@socketio.on('message_delivered')
-def handle_message_delivered(data):
-    message_id = data['message_id']
-    user_id = data['user_id']
-    
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO message_status (message_id, user_id, status)
-        VALUES (?, ?, 'delivered')
-    ''', (message_id, user_id))
-    conn.commit()
-    conn.close()
-
-    emit('message_status_update', {
-        'message_id': message_id,
-        'user_id': user_id,
-        'status': 'delivered'
-    }, broadcast=True)
-
-# --- NEW: Socket event for seen
-@socketio.on('message_seen')
-def handle_message_seen(data):
-    message_id = data['message_id']
-    user_id = data['user_id']
-
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO message_status (message_id, user_id, status)
-        VALUES (?, ?, 'seen')
-    ''', (message_id, user_id))
-    conn.commit()
-    conn.close()
-
-    emit('message_status_update', {
-        'message_id': message_id,
-        'user_id': user_id,
-        'status': 'seen'
-    }, broadcast=True)
-
-# PATCH /api/messages to return status
 @app.route('/api/messages')
 @login_required
 def get_messages():
     chat_type = request.args.get('chat_type')  # 'user' or 'group'
-    chat_id = request.args.get('chat_id')
-    limit = request.args.get('limit', 50)
+    chat_id = request.args.get('chat_id', type=int)
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+
+    if chat_id is None:
+        return jsonify({'error': 'chat_id is required'}), 400
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+
+    # Walk forwards from after_id, otherwise backwards from before_id (or the end)
+    if after_id is not None:
+        cursor_clause, order, cursor_value = 'id > ?', 'ASC', after_id
+    else:
+        cursor_clause, order, cursor_value = 'id < ?', 'DESC', before_id if before_id is not None else 2 ** 63 - 1
 
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
+    # One extra row tells us whether there is another page
+    fetch = limit + 1
 
-    if chat_type == 'user':
-        cursor.execute('''
-            SELECT m.id, m.content, m.message_type, m.sender_id, m.created_at, 
-                   m.file_url, m.file_name, m.file_size, m.voice_duration, m.is_announcement,
-                   u.full_name as sender_name,
-                   (SELECT status FROM message_status WHERE message_id = m.id AND user_id = ?) as status
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE m.chat_type = 'user' AND 
-                  ((m.sender_id = ? AND m.chat_id = ?) OR (m.sender_id = ? AND m.chat_id = ?))
-            ORDER BY m.created_at ASC
-            LIMIT ?
-        ''', (current_user.id, current_user.id, chat_id, chat_id, current_user.id, limit))
-    else:
-        cursor.execute('''
+    with get_db() as conn:
+        cursor = conn.cursor()
+
+        if chat_type == 'user':
+            # Each direction of the conversation is its own index range
+            page_sql = f'''
+                SELECT id FROM (
+                    SELECT id FROM messages
+                    WHERE sender_id = ? AND chat_type = 'user' AND chat_id = ? AND {cursor_clause}
+                    ORDER BY id {order} LIMIT ?
+                )
+                UNION
+                SELECT id FROM (
+                    SELECT id FROM messages
+                    WHERE sender_id = ? AND chat_type = 'user' AND chat_id = ? AND {cursor_clause}
+                    ORDER BY id {order} LIMIT ?
+                )
+            '''
+            page_params = (current_user.id, chat_id, cursor_value, fetch,
+                           chat_id, current_user.id, cursor_value, fetch)
+        else:
+            page_sql = f'''
+                SELECT id FROM messages
+                WHERE chat_type = 'group' AND chat_id = ? AND {cursor_clause}
+                ORDER BY id {order} LIMIT ?
+            '''
+            page_params = (chat_id, cursor_value, fetch)
+
+        cursor.execute(f'''
             SELECT m.id, m.content, m.message_type, m.sender_id, m.created_at,
                    m.file_url, m.file_name, m.file_size, m.voice_duration, m.is_announcement,
-                   u.full_name as sender_name,
-                   (SELECT status FROM message_status WHERE message_id = m.id AND user_id = ?) as status
-            FROM messages m
+                   u.full_name as sender_name, m.media
+            FROM ({page_sql}) page
+            JOIN messages m ON m.id = page.id
             JOIN users u ON m.sender_id = u.id
-            WHERE m.chat_type = 'group' AND m.chat_id = ?
-            ORDER BY m.created_at ASC
+            ORDER BY m.id {order}
             LIMIT ?
-        ''', (current_user.id, chat_id, limit))
+        ''', page_params + (fetch,))
+        rows = cursor.fetchall()
+        watermarks = get_watermarks(cursor, current_user.id, chat_type, chat_id)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'DESC':
+        rows.reverse()
 
     messages = []
-    for row in cursor.fetchall():
+    for row in rows:
         messages.append({
             'id': row[0],
             'content': row[1],
@@ -1479,29 +1495,69 @@ def get_messages():
             'voice_duration': row[8],
             'is_announcement': row[9],
             'sender_name': row[10],
-            'status': row[11] or 'sent'
+            'media': json.loads(row[11]) if row[11] else None,
+            'status': message_status(row[0], row[3], current_user.id, watermarks)
+        })
+
+    next_cursor = None
+    if has_more and messages:
+        # Oldest id when paging back, newest id when catching up
+        next_cursor = messages[-1]['id'] if order == 'ASC' else messages[0]['id']
+
+    return jsonify({
+        'messages': messages,
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    })
+
+@app.route('/api/messages/search')
+@login_required
+def search_message_history():
+    """Ranked full-text search over the caller's conversations"""
+    query = request.args.get('q', '').strip()
+    chat_type = request.args.get('chat_type')
+    chat_id = request.args.get('chat_id', type=int)
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, offset)
+
+    with metrics.timer('search.messages'), get_db() as conn:
+        rows = search_messages(conn.cursor(), current_user.id, query, chat_type, chat_id, limit, offset)
+
+    has_more = len(rows) > limit
+    results = []
+    for row in rows[:limit]:
+        results.append({
+            'id': row[0],
+            'chat_type': row[1],
+            # Direct chats are identified by the other participant, as in /api/chats
+            'chat_id': row[3] if row[1] == 'user' and row[3] != current_user.id else row[2],
+            'sender_id': row[3],
+            'sender_name': row[4],
+            'created_at': row[5],
+            'message_type': row[6],
+            'file_name': row[7],
+            'snippet': row[8],
+            'file_snippet': row[9] if row[7] else None
         })
 
-    conn.close()
-    return jsonify(messages)
+    return jsonify({
+        'results': results,
+        'next_offset': offset + limit if has_more else None,
+        'has_more': has_more
+    })
 
 @app.route("/api/block_user", methods=["POST"])
 @login_required
 def block_user():
     data = request.get_json()
     user_id = data["user_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_blocks (
-            blocker_id INTEGER,
-            blocked_id INTEGER,
-            PRIMARY KEY (blocker_id, blocked_id)
-        )
-    ''')
-    cursor.execute("INSERT OR IGNORE INTO user_blocks (blocker_id, blocked_id) VALUES (?, ?)", (current_user.id, user_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO user_blocks (blocker_id, blocked_id) VALUES (?, ?)", (current_user.id, user_id))
+        conn.commit()
     return jsonify(success=True)
 
 # === REPORT USER ===
@@ -1510,20 +1566,11 @@ def block_user():
 def report_user():
     data = request.get_json()
     user_id = data["user_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_reports (
-            reporter_id INTEGER,
-            reported_id INTEGER,
-            reason TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute("INSERT INTO user_reports (reporter_id, reported_id, reason) VALUES (?, ?, ?)",
-                   (current_user.id, user_id, data.get("reason", "")))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO user_reports (reporter_id, reported_id, reason) VALUES (?, ?, ?)",
+                       (current_user.id, user_id, data.get("reason", "")))
+        conn.commit()
     return jsonify(success=True)
 
 # === LEAVE GROUP ===
@@ -1532,11 +1579,14 @@ def report_user():
 def leave_group():
     data = request.get_json()
     group_id = data["group_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM group_members WHERE user_id = ? AND group_id = ?", (current_user.id, group_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM group_members WHERE user_id = ? AND group_id = ?", (current_user.id, group_id))
+        forget_conversation(cursor, current_user.id, 'group', group_id)
+        touch(cursor, 'group_members')
+        conn.commit()
+    invalidate_communities()
+    _leave_rooms(current_user.id, f"group_{group_id}")
     return jsonify(success=True)
 
 # === JOIN REQUEST ===
@@ -1545,19 +1595,10 @@ def leave_group():
 def request_join_group():
     data = request.get_json()
     group_id = data["group_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS group_join_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            group_id INTEGER,
-            user_id INTEGER,
-            status TEXT DEFAULT 'pending'
-        )
-    ''')
-    cursor.execute("INSERT INTO group_join_requests (group_id, user_id) VALUES (?, ?)", (group_id, current_user.id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO group_join_requests (group_id, user_id) VALUES (?, ?)", (group_id, current_user.id))
+        conn.commit()
     return jsonify(success=True)
 
 # === ACCEPT REQUEST ===
@@ -1566,17 +1607,18 @@ def request_join_group():
 def accept_join_request():
     data = request.get_json()
     request_id = data["request_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT group_id, user_id FROM group_join_requests WHERE id = ?", (request_id,))
-    row = cursor.fetchone()
-    if not row:
-        return jsonify(error="Request not found"), 404
-    group_id, user_id = row
-    cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
-    cursor.execute("UPDATE group_join_requests SET status = 'accepted' WHERE id = ?", (request_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT group_id, user_id FROM group_join_requests WHERE id = ?", (request_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify(error="Request not found"), 404
+        group_id, user_id = row
+        cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
+        cursor.execute("UPDATE group_join_requests SET status = 'accepted' WHERE id = ?", (request_id,))
+        touch(cursor, 'group_members')
+        conn.commit()
+    invalidate_communities()
     return jsonify(success=True)
 
 # === PROMOTE TO ADMIN ===
@@ -1586,11 +1628,11 @@ def promote_to_admin():
     data = request.get_json()
     group_id = data["group_id"]
     user_id = data["user_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE group_members SET is_admin = 1 WHERE group_id = ? AND user_id = ?", (group_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE group_members SET is_admin = 1 WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+        touch(cursor, 'group_members')
+        conn.commit()
     return jsonify(success=True)
 
 # === ADD MEMBER DIRECTLY ===
@@ -1600,11 +1642,12 @@ def add_member():
     data = request.get_json()
     group_id = data["group_id"]
     user_id = data["user_id"]
-    conn = sqlite3.connect('docktalk.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", (group_id, user_id))
+        touch(cursor, 'group_members')
+        conn.commit()
+    invalidate_communities()
     return jsonify(success=True)
 
 
@@ -1613,16 +1656,16 @@ def add_member():
 
 @app.route("/api/lookup_user")
 @login_required
+@cached_response(('users',), params=('username',))
 def lookup_user():
     username = request.args.get("username")
     if not username:
         return jsonify(error="Username required"), 400
 
-    conn = sqlite3.connect("docktalk.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, full_name FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username, full_name FROM users WHERE username = ?", (username,))
+        row = cursor.fetchone()
 
     if row:
         return jsonify({"id": row[0], "username": row[1], "full_name": row[2]})
@@ -1631,18 +1674,18 @@ def lookup_user():
 
 @app.route("/api/group_members")
 @login_required
+@cached_response(('group_members', 'users'), params=('group_id',))
 def group_members():
     group_id = request.args.get("group_id")
-    conn = sqlite3.connect("docktalk.db")
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT u.id, u.full_name, u.username, gm.is_admin
-        FROM group_members gm
-        JOIN users u ON gm.user_id = u.id
-        WHERE gm.group_id = ?
-    ''', (group_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.id, u.full_name, u.username, gm.is_admin
+            FROM group_members gm
+            JOIN users u ON gm.user_id = u.id
+            WHERE gm.group_id = ?
+        ''', (group_id,))
+        rows = cursor.fetchall()
     return jsonify([
         {"id": r[0], "full_name": r[1], "username": r[2], "is_admin": bool(r[3])} for r in rows
     ])
@@ -1650,30 +1693,22 @@ def group_members():
 
 @app.route("/api/feed")
 @login_required
+@cached_response(('feed', 'users'), params=('page',))
 def get_feed():
     page = int(request.args.get("page", 1))
     per_page = 10
     offset = (page - 1) * per_page
 
-    conn = sqlite3.connect("docktalk.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS feed (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            content TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    cursor.execute("""
-        SELECT f.id, f.content, f.created_at, u.full_name
-        FROM feed f
-        JOIN users u ON u.id = f.user_id
-        ORDER BY f.created_at DESC
-        LIMIT ? OFFSET ?
-    """, (per_page, offset))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT f.id, f.content, f.created_at, u.full_name
+            FROM feed f
+            JOIN users u ON u.id = f.user_id
+            ORDER BY f.created_at DESC
+            LIMIT ? OFFSET ?
+        """, (per_page, offset))
+        rows = cursor.fetchall()
     return jsonify([
         {"id": r[0], "content": r[1], "created_at": r[2], "author": r[3]} for r in rows
     ])
@@ -1689,11 +1724,11 @@ def post_to_feed():
     if not content:
         return jsonify({"error": "No content"}), 400
 
-    conn = sqlite3.connect("docktalk.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO feed (user_id, content) VALUES (?, ?)", (current_user.id, content))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO feed (user_id, content) VALUES (?, ?)", (current_user.id, content))
+        touch(cursor, 'feed')
+        conn.commit()
     return jsonify({"success": True})
 
 
@@ -1706,6 +1741,13 @@ def show_feed():
     return render_template("feed.html")
 
 
+@app.route("/api/metrics")
+@login_required
+def get_metrics():
+    """Connection pool usage, timings and counters for this process"""
+    return jsonify(metrics.snapshot())
+
+
 if __name__ == '__main__':
     init_db()
-    socketio.run(app, host="0.0.0.0", port=600, debug=False, use_reloader=False,allow_unsafe_werkzeug=True)
+    socketio.run(app, host="0.0.0.0", port=600, debug=False, use_reloader=False, **run_options())
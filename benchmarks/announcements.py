@@ -0,0 +1,95 @@
+"""Announcement fanout cost: one INSERT per group vs one set-based insert.
+
+    python benchmarks/announcements.py [--groups 2000] [--members 5]
+
+Only the database side is measured; the old path also built and emitted
+one event per group, the new one emits once to the community room.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from conversations import record_message, record_announcement, increment_unread
+from migrations import migrate
+
+
+def setup(path, groups, members):
+    db.configure(path)
+    migrate()
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO users (username, email, password_hash, full_name) VALUES (?, ?, ?, ?)',
+                           [(f'bench{i}', f'bench{i}@example.com', '-', f'Bench {i}') for i in range(members * 10)])
+        cursor.execute("INSERT INTO communities (name, created_by) VALUES ('bench', 1)")
+        community_id = cursor.lastrowid
+        cursor.executemany('INSERT INTO groups (name, community_id, created_by) VALUES (?, ?, 1)',
+                           [(f'group {i}', community_id) for i in range(groups)])
+        cursor.execute('SELECT id FROM groups WHERE community_id = ?', (community_id,))
+        group_ids = [row[0] for row in cursor.fetchall()]
+        cursor.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                           [(group_id, (n + m) % (members * 10) + 1)
+                            for n, group_id in enumerate(group_ids) for m in range(members)])
+        conn.commit()
+    return community_id
+
+
+def per_group(community_id, sender_id, content):
+    """The previous handler: one INSERT and bookkeeping round per group"""
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM groups WHERE community_id = ?', (community_id,))
+        for (group_id,) in cursor.fetchall():
+            cursor.execute('''
+                INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, is_announcement)
+                VALUES (?, 'announcement', ?, 'group', ?, TRUE)
+            ''', (content, sender_id, group_id))
+            record_message(cursor, cursor.lastrowid, sender_id, 'group', group_id, content)
+            increment_unread(cursor, sender_id, 'group', group_id)
+        conn.commit()
+
+
+def set_based(community_id, sender_id, content):
+    """Same statements as on_send_announcement"""
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO announcements (community_id, sender_id, content) VALUES (?, ?, ?)',
+                       (community_id, sender_id, content))
+        announcement_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, is_announcement, announcement_id)
+            SELECT ?, 'announcement', ?, 'group', id, TRUE, ?
+            FROM groups WHERE community_id = ?
+            ORDER BY id
+        ''', (content, sender_id, announcement_id, community_id))
+        record_announcement(cursor, announcement_id, sender_id)
+        cursor.execute('SELECT chat_id, id FROM messages WHERE announcement_id = ?', (announcement_id,))
+        cursor.fetchall()
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{args.groups} groups, {args.members} members each')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, send in (('per group', per_group), ('set based', set_based)):
+            community_id = setup(os.path.join(tmp, name.replace(' ', '_') + '.db'), args.groups, args.members)
+            timings = []
+            for i in range(args.rounds):
+                started = time.perf_counter()
+                send(community_id, 1, f'announcement {i}')
+                timings.append(time.perf_counter() - started)
+            print(f'{name:<10} best {min(timings) * 1000:8.1f} ms  avg {sum(timings) / len(timings) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Sidebar load: /api/chats + /api/groups + /api/communities + /api/presence
+vs one /api/bootstrap, and a bootstrap revalidation that ends in a 304.
+Also /api/communities alone, with the community tree cached and cold.
+
+    python benchmarks/bootstrap.py [--communities 20] [--groups 5] [--chats 200] [--loads 50]
+
+Runs the Flask app in-process against a throwaway database; SQL statements
+are counted with a trace callback on every pooled connection.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# SQL statements run since the last reset
+statements = [0]
+
+
+def _trace(sql):
+    statements[0] += 1
+
+
+def count_statements(connect):
+    def traced(pool):
+        conn = connect(pool)
+        conn.set_trace_callback(_trace)
+        return conn
+    return traced
+
+
+def setup(communities, groups, chats):
+    import db
+    from conversations import record_message
+    from migrations import migrate
+    from werkzeug.security import generate_password_hash
+    migrate()
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO users (username, email, password_hash, full_name) VALUES (?, ?, ?, ?)',
+                           [(f'bench{i}', f'bench{i}@example.com',
+                             generate_password_hash('bench', method='pbkdf2:sha256:1'), f'Bench {i}')
+                            for i in range(chats + 1)])
+        user_id = cursor.execute("SELECT id FROM users WHERE username = 'bench0'").fetchone()[0]
+        peers = [row[0] for row in cursor.execute("SELECT id FROM users WHERE username LIKE 'bench%' AND id != ?",
+                                                  (user_id,))]
+        for c in range(communities):
+            cursor.execute('INSERT INTO communities (name, created_by) VALUES (?, ?)', (f'community {c}', user_id))
+            community_id = cursor.lastrowid
+            cursor.execute('INSERT INTO community_members (community_id, user_id) VALUES (?, ?)',
+                           (community_id, user_id))
+            for g in range(groups):
+                cursor.execute('INSERT INTO groups (name, community_id, created_by) VALUES (?, ?, ?)',
+                               (f'group {c}.{g}', community_id, user_id))
+                group_id = cursor.lastrowid
+                cursor.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                                   [(group_id, user_id)] + [(group_id, peer) for peer in peers[g::groups][:20]])
+                cursor.execute("INSERT INTO messages (content, sender_id, chat_type, chat_id) VALUES ('hi', ?, 'group', ?)",
+                               (peers[g], group_id))
+                record_message(cursor, cursor.lastrowid, peers[g], 'group', group_id, 'hi')
+        for peer in peers:
+            cursor.execute("INSERT INTO messages (content, sender_id, chat_type, chat_id) VALUES ('hi', ?, 'user', ?)",
+                           (peer, user_id))
+            record_message(cursor, cursor.lastrowid, peer, 'user', user_id, 'hi')
+        conn.commit()
+
+
+def measure(name, load, loads):
+    load()
+    statements[0] = 0
+    started = time.perf_counter()
+    for _ in range(loads):
+        nbytes = load()
+    elapsed = (time.perf_counter() - started) / loads
+    print(f'{name:<28} {elapsed * 1000:7.2f} ms/load  {statements[0] / loads:6.1f} statements  {nbytes:>8} bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--communities', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=5, help='groups per community')
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--loads', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DOCKTALK_DB'] = os.path.join(tmp, 'bootstrap.db')
+        os.chdir(ROOT)
+        import db
+        db.ConnectionPool._connect = count_statements(db.ConnectionPool._connect)
+        import app as A
+        from communities import invalidate_communities
+        setup(args.communities, args.groups, args.chats)
+        client = A.app.test_client()
+        client.post('/login', json={'username': 'bench0', 'password': 'bench'})
+
+        def separate():
+            total = 0
+            chats = client.get('/api/chats')
+            total += len(chats.data) + len(client.get('/api/groups').data)
+            total += len(client.get('/api/communities').data)
+            ids = ','.join(chat['id'] for chat in chats.json)
+            return total + len(client.get(f'/api/presence?ids={ids}').data)
+
+        def communities():
+            return len(client.get('/api/communities').data)
+
+        def communities_cold():
+            invalidate_communities()
+            return communities()
+
+        def bootstrap():
+            return len(client.get('/api/bootstrap').data)
+
+        etag = client.get('/api/bootstrap').headers['ETag']
+
+        def revalidate():
+            response = client.get('/api/bootstrap', headers={'If-None-Match': etag})
+            assert response.status_code == 304, response.status_code
+            return len(response.data)
+
+        print(f'{args.communities} communities x {args.groups} groups, {args.chats} direct chats')
+        measure('4 separate requests', separate, args.loads)
+        measure('/api/bootstrap', bootstrap, args.loads)
+        measure('/api/bootstrap (304)', revalidate, args.loads)
+        measure('/api/communities', communities, args.loads)
+        measure('/api/communities (cold)', communities_cold, args.loads)
+
+
+if __name__ == '__main__':
+    main()
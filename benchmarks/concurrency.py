@@ -0,0 +1,134 @@
+"""How many idle and active websocket clients one gunicorn process holds in
+each async mode.
+
+    python benchmarks/concurrency.py [--modes threading,eventlet,gevent] [--clients 100,500,1000]
+
+For every mode whose package is installed, starts `gunicorn -c
+gunicorn.conf.py wsgi:app` on a throwaway database and opens websocket
+clients in steps. After each step it reports the worker's memory and
+thread count. It then has --active of the connected clients send
+messages, each waiting for its echo, and reports throughput and echo
+latency while the other clients sit idle.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scale_out import ROOT, Client, free_port, setup, wait_for_port
+
+
+def worker_pid(master_pid, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+                children = f.read().split()
+            if children:
+                return int(children[0])
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('gunicorn worker did not start')
+
+
+def process_status(pid):
+    """(resident MB, threads) of a process"""
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return int(status['VmRSS'][0]) / 1024, int(status['Threads'][0])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def active_round(clients, active, messages):
+    latencies = []
+    lock = threading.Lock()
+
+    def send(i):
+        peer = clients[(i + 1) % len(clients)]
+        mine = []
+        for n in range(messages):
+            started = time.perf_counter()
+            clients[i].send_message(peer.user_id, f'message {n}')
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(min(active, len(clients)))]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000
+
+
+def run(mode, levels, active, messages):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'concurrency.db')
+        user_ids = setup(path, max(levels))
+        port = free_port()
+        server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  env=dict(os.environ, DOCKTALK_DB=path, DOCKTALK_PORT=str(port),
+                                           DOCKTALK_ASYNC_MODE=mode, DOCKTALK_THREADS=str(max(levels) + 100)))
+        clients = []
+        try:
+            wait_for_port(port)
+            # The worker imports the app lazily; wait until it serves
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login').close()
+            pid = worker_pid(server.pid)
+            rss, threads = process_status(pid)
+            print(f'  {0:>6} clients  {rss:7.1f} MB  {threads:>5} threads')
+            for level in levels:
+                started = time.perf_counter()
+                while len(clients) < level:
+                    clients.append(Client(port, f'bench{len(clients)}', user_ids[len(clients)]))
+                connect_time = time.perf_counter() - started
+                time.sleep(1)
+                rss, threads = process_status(pid)
+                rate, p50, p99 = active_round(clients, active, messages)
+                print(f'  {level:>6} clients  {rss:7.1f} MB  {threads:>5} threads  '
+                      f'connected in {connect_time:5.1f}s  {active} active: {rate:6.0f} msgs/sec  '
+                      f'p50 {p50:5.1f}ms  p99 {p99:6.1f}ms')
+        finally:
+            for client in clients:
+                client.close()
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='threading,eventlet,gevent')
+    parser.add_argument('--clients', default='100,500,1000', help='comma separated client counts')
+    parser.add_argument('--active', type=int, default=20, help='clients sending during each step')
+    parser.add_argument('--messages', type=int, default=20, help='messages per active client')
+    args = parser.parse_args()
+    levels = sorted(map(int, args.clients.split(',')))
+    print(f'{os.cpu_count()} CPUs')
+    for mode in args.modes.split(','):
+        if mode != 'threading' and importlib.util.find_spec(mode) is None:
+            print(f'{mode}: skipped, {mode} is not installed')
+            continue
+        print(f'{mode}:')
+        run(mode, levels, args.active, args.messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Photo uploads: inline resizing vs renditions rendered by the image pool.
+
+    python benchmarks/images.py [--burst 16] [--width 4000] [--height 3000]
+
+First decodes and resizes one camera-sized JPEG both ways in this
+process: the old inline thumbnail (full decode, LANCZOS, optimize) and
+images.render() (draft-mode decode, preview and thumbnail). Then starts a
+`run.py` worker and uploads --burst copies at once, reporting upload
+request latency and how long the pool took to write every rendition.
+"""
+import argparse
+import concurrent.futures
+import http.client
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageFilter
+
+from scale_out import ROOT, free_port, login, setup, wait_for_port
+
+sys.path.insert(0, ROOT)
+
+import images
+
+
+def photo(width, height):
+    """A JPEG with enough detail to compress like a photo"""
+    small = Image.frombytes('RGB', (width // 16, height // 16), random.randbytes(width // 16 * (height // 16) * 3))
+    img = small.resize((width, height), Image.Resampling.BICUBIC).filter(ImageFilter.DETAIL)
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def inline(path, out):
+    with Image.open(path) as img:
+        img.thumbnail((800, 600), Image.Resampling.LANCZOS)
+        img.save(out, 'JPEG', optimize=True, quality=85)
+
+
+def upload(port, cookie, data):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="type"\r\n\r\nimage\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="photo.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    started = time.perf_counter()
+    conn.request('POST', '/api/upload', body, {'Cookie': cookie,
+                                               'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    response = conn.getresponse()
+    result = response.read()
+    conn.close()
+    return time.perf_counter() - started, json.loads(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--burst', type=int, default=16)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    args = parser.parse_args()
+
+    data = photo(args.width, args.height)
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'photo.jpg')
+        with open(source, 'wb') as f:
+            f.write(data)
+        media = images.plan(source, '/static/photo.jpg')
+        outputs = [(os.path.join(tmp, f'out.{name}.jpg'), r['width'], r['height'])
+                   for name, r in media['renditions'].items() if name != 'original']
+        for name, work in (('inline thumbnail (old)', lambda: inline(source, os.path.join(tmp, 'inline.jpg'))),
+                           ('images.render (draft)', lambda: images.render(source, outputs))):
+            work()
+            started = time.perf_counter()
+            for _ in range(5):
+                work()
+            print(f'{name:<24} {(time.perf_counter() - started) / 5 * 1000:7.1f} ms per photo '
+                  f'({args.width}x{args.height}, {len(data) // 1024} KB)')
+
+        path = os.path.join(tmp, 'images.db')
+        setup(path, 1)
+        port = free_port()
+        server = subprocess.Popen([sys.executable, 'run.py'], cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  env=dict(os.environ, DOCKTALK_DB=path, DOCKTALK_PORT=str(port),
+                                           DOCKTALK_UPLOAD_PARTIAL_DIR=os.path.join(tmp, 'partial')))
+        stored = []
+        try:
+            wait_for_port(port)
+            cookie = login(port, 'bench0')
+            # Warm the pool so the burst does not include spawning it
+            stored.append(upload(port, cookie, data)[1])
+            time.sleep(3)
+
+            started = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(args.burst) as pool:
+                results = list(pool.map(lambda _: upload(port, cookie, data), range(args.burst)))
+            uploaded = time.perf_counter() - started
+            stored += [result for _, result in results]
+            latencies = sorted(latency for latency, _ in results)
+            pending = [os.path.join(ROOT, r['url'].lstrip('/')) for result in stored
+                       for r in result['media']['renditions'].values()]
+            while not all(os.path.exists(p) for p in pending):
+                time.sleep(0.01)
+            rendered = time.perf_counter() - started
+            print(f'burst of {args.burst}: uploads answered in {uploaded:5.2f}s '
+                  f'(p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms, max {latencies[-1] * 1000:6.1f} ms), '
+                  f'all renditions written after {rendered:5.2f}s, {images.IMAGE_WORKERS} image workers')
+        finally:
+            server.terminate()
+            server.wait()
+            for result in stored:
+                for r in result['media']['renditions'].values():
+                    path = os.path.join(ROOT, r['url'].lstrip('/'))
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
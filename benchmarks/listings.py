@@ -0,0 +1,65 @@
+"""Listing endpoints behind the response cache, served from the cache and
+recomputed after every request.
+
+    python benchmarks/listings.py [--communities 20] [--groups 5] [--users 200] [--loads 200]
+
+Runs the Flask app in-process against a throwaway database built by
+benchmarks/bootstrap.py. "cold" empties the cache before each request.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bootstrap import ROOT, setup
+
+ENDPOINTS = (
+    '/api/communities/all',
+    '/api/groups/all',
+    '/api/group_members?group_id=1',
+    '/api/lookup_user?username=bench7',
+    '/api/feed?page=1',
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--communities', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=5, help='groups per community')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--loads', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DOCKTALK_DB'] = os.path.join(tmp, 'listings.db')
+        os.chdir(ROOT)
+        import app as A
+        from db import get_db
+        import response_cache
+        setup(args.communities, args.groups, args.users)
+        with get_db() as conn:
+            conn.executemany('INSERT INTO feed (user_id, content) VALUES (?, ?)',
+                             [(1 + i % args.users, f'post {i}') for i in range(100)])
+            conn.commit()
+        client = A.app.test_client()
+        client.post('/login', json={'username': 'bench0', 'password': 'bench'})
+
+        print(f'{args.communities} communities x {args.groups} groups, {args.users} users')
+        for url in ENDPOINTS:
+            timings = {}
+            for mode in ('cached', 'cold'):
+                client.get(url)
+                started = time.perf_counter()
+                for _ in range(args.loads):
+                    if mode == 'cold':
+                        response_cache._cache.clear()
+                    client.get(url)
+                timings[mode] = (time.perf_counter() - started) / args.loads * 1000
+            print(f'{url:<36} cached {timings["cached"]:6.2f} ms   cold {timings["cold"]:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Concurrent media downloads from one gunicorn worker, with and without
+sendfile.
+
+    python benchmarks/media.py [--size-mb 20] [--clients 16] [--requests 8]
+
+Stores a voice-note sized object and a file sized object through
+storage.py, starts `gunicorn -c gunicorn.conf.py wsgi:app` (one gthread
+worker) and has --clients threads download them: whole files, then
+random 256 KB ranges as a player seeking through a recording would.
+Each mode is run with gunicorn's sendfile on and off (--no-sendfile);
+the worker's CPU seconds per GB is the number sendfile moves.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import http.client
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scale_out import ROOT, free_port, setup, wait_for_port
+
+import storage
+
+RANGE_SIZE = 256 * 1024
+
+
+def worker_cpu(master):
+    """CPU seconds used so far by the gunicorn worker(s) under master"""
+    total = 0.0
+    with open(f'/proc/{master}/task/{master}/children') as f:
+        children = f.read().split()
+    for pid in children:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return total
+
+
+def fetch(port, url, size, requests, ranged):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    try:
+        for _ in range(requests):
+            headers = {}
+            if ranged:
+                start = random.randrange(0, size - RANGE_SIZE)
+                headers['Range'] = f'bytes={start}-{start + RANGE_SIZE - 1}'
+            conn.request('GET', url, headers=headers)
+            response = conn.getresponse()
+            assert response.status == (206 if ranged else 200), response.status
+            while True:
+                count = response.readinto(buffer)
+                if not count:
+                    break
+                received += count
+    finally:
+        conn.close()
+    return received
+
+
+def measure(port, master, url, size, clients, requests, ranged):
+    cpu = worker_cpu(master)
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(clients) as pool:
+        received = sum(pool.map(lambda _: fetch(port, url, size, requests, ranged), range(clients)))
+    elapsed = time.perf_counter() - started
+    cpu = worker_cpu(master) - cpu
+    return clients * requests / elapsed, received / elapsed / 1024 / 1024, cpu / (received / 1024 ** 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=8, help='downloads per client')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    stored = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'media.db')
+        setup(path, 1)
+        for name, size in (('voice note', 600 * 1024), ('file', args.size_mb * 1024 * 1024)):
+            data = os.urandom(size)
+            sha256 = hashlib.sha256(data).hexdigest()
+            target = storage.object_path(sha256, 'webm' if name == 'voice note' else 'zip')
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            stored.append((name, storage.url_for(target), size))
+
+        try:
+            for sendfile in (True, False):
+                port = free_port()
+                command = ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'] + ([] if sendfile else ['--no-sendfile'])
+                server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                          env=dict(os.environ, DOCKTALK_DB=path, DOCKTALK_PORT=str(port)))
+                try:
+                    wait_for_port(port)
+                    time.sleep(1)
+                    for name, url, size in stored:
+                        for ranged in (False, True):
+                            if ranged and name == 'voice note':
+                                continue
+                            rate, throughput, cpu = measure(port, server.pid, url, size, args.clients,
+                                                            args.requests * (4 if ranged else 1), ranged)
+                            label = f"{name}{' ranges' if ranged else ''}"
+                            print(f"sendfile {'on ' if sendfile else 'off'}  {label:<12} {rate:8.1f} req/s "
+                                  f"{throughput:8.1f} MB/s  worker {cpu:5.2f} CPU s/GB")
+                finally:
+                    server.terminate()
+                    server.wait()
+        finally:
+            for _, url, _ in stored:
+                os.remove(storage.path_for(url))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Frames through the local message broker, with a worker that stops reading.
+
+    python benchmarks/message_queue.py [--frames 20000] [--size 2048]
+
+Starts broker.py's Broker in this process and connects two BrokerManager
+workers plus one listener that never reads its socket. One worker
+publishes --frames frames of --size bytes (far more than a socket buffer);
+checks that the other worker receives every one, that publishing is never
+held up by the stalled listener and that the broker drops it, then
+reports frames/sec.
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scale_out import free_port, wait_for_port
+
+import broker
+
+TIMEOUT = 60
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=2048)
+    args = parser.parse_args()
+
+    port = free_port()
+    server = broker.Broker('127.0.0.1', port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(port)
+    url = f'tcp://127.0.0.1:{port}'
+
+    # Subscribes and then never reads
+    stalled = socket.create_connection(('127.0.0.1', port))
+    broker.send_frame(stalled, broker.SUBSCRIBE + b' stalled')
+
+    publisher, listener = broker.BrokerManager(url), broker.BrokerManager(url)
+    received = []
+    done = threading.Event()
+
+    def listen():
+        for _ in listener._listen():
+            received.append(1)
+            if len(received) == args.frames:
+                done.set()
+                return
+
+    threading.Thread(target=listen, daemon=True).start()
+    while len(server._subscribers) < 2:
+        time.sleep(0.01)
+
+    message = {'method': 'emit', 'data': 'x' * args.size}
+    published = threading.Event()
+
+    def publish():
+        for _ in range(args.frames):
+            publisher._publish(message)
+        published.set()
+
+    started = time.perf_counter()
+    threading.Thread(target=publish, daemon=True).start()
+    if not published.wait(TIMEOUT):
+        sys.exit(f'publisher blocked after {len(received)} of {args.frames} frames')
+    if not done.wait(TIMEOUT):
+        sys.exit(f'listener received {len(received)} of {args.frames} frames')
+    elapsed = time.perf_counter() - started
+    if any(s.worker == b'stalled' for s in server._subscribers):
+        sys.exit('stalled listener was not dropped')
+    stalled.close()
+    print(f'{args.frames} frames of {args.size} bytes in {elapsed:5.2f}s '
+          f'({args.frames / elapsed:8.0f} frames/s, {args.frames * args.size / elapsed / 1024 / 1024:6.1f} MB/s), '
+          f'stalled listener dropped')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
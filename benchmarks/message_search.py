@@ -0,0 +1,79 @@
+"""Message search latency on a synthetic history.
+
+    python benchmarks/message_search.py [--messages 1000000]
+
+Builds a throwaway database with random text spread over direct chats and
+groups, then times /api/messages/search queries for one user.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from migrations import migrate
+from search import search_messages
+
+WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november '
+         'oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu budget '
+         'release deploy meeting invoice report lunch review roadmap incident ticket').split()
+
+
+def setup(path, messages, users, groups):
+    db.configure(path)
+    migrate()
+    rng = random.Random(1)
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO users (username, email, password_hash, full_name) VALUES (?, ?, ?, ?)',
+                           [(f'bench{i}', f'bench{i}@example.com', '-', f'Bench {i}') for i in range(users)])
+        cursor.executemany('INSERT INTO groups (name, created_by) VALUES (?, 1)', [(f'group {i}',) for i in range(groups)])
+        cursor.executemany('INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)',
+                           [(rng.randint(1, groups), rng.randint(1, users)) for _ in range(groups * 10)])
+
+        def rows():
+            for _ in range(messages):
+                content = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+                sender = rng.randint(1, users)
+                if rng.random() < 0.5:
+                    yield content, sender, 'user', rng.randint(1, users)
+                else:
+                    yield content, sender, 'group', rng.randint(1, groups)
+        cursor.executemany('''
+            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id)
+            VALUES (?, 'text', ?, ?, ?)
+        ''', rows())
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        setup(os.path.join(tmp, 'search.db'), args.messages, args.users, args.groups)
+        print(f'indexed {args.messages} messages in {time.perf_counter() - started:.1f}s')
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            for query in ('budget', 'budget review', 'inv', 'zulu yankee xray', 'nomatch'):
+                timings = []
+                for _ in range(args.rounds):
+                    t = time.perf_counter()
+                    rows = search_messages(cursor, 7, query)
+                    timings.append(time.perf_counter() - t)
+                timings.sort()
+                print(f'{query!r:<22} {len(rows):>3} rows  median {timings[len(timings) // 2] * 1000:7.1f} ms'
+                      f'  p90 {timings[int(len(timings) * 0.9)] * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
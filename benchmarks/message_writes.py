@@ -0,0 +1,106 @@
+"""Sustained message insert throughput: one commit per message vs the
+batched writer.
+
+    python benchmarks/message_writes.py [--threads 16] [--messages 4000]
+
+Runs against a throwaway database so it can be pointed at any checkout.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import metrics
+from conversations import record_message, increment_unread
+from migrations import migrate
+from writer import MessageWriter
+
+
+def setup(path, users):
+    db.configure(path)
+    migrate()
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        for i in range(users):
+            cursor.execute('INSERT INTO users (username, email, password_hash, full_name) VALUES (?, ?, ?, ?)',
+                           (f'bench{i}', f'bench{i}@example.com', '-', f'Bench {i}'))
+        cursor.execute("INSERT INTO groups (name, created_by) VALUES ('bench', 1)")
+        group_id = cursor.lastrowid
+        cursor.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                           [(group_id, i + 1) for i in range(users)])
+        conn.commit()
+    return group_id
+
+
+def send_direct(sender_id, chat_type, chat_id, content):
+    """The previous send path: one transaction and commit per message"""
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id)
+            VALUES (?, 'text', ?, ?, ?)
+        ''', (content, sender_id, chat_type, chat_id))
+        message_id = cursor.lastrowid
+        record_message(cursor, message_id, sender_id, chat_type, chat_id, content)
+        increment_unread(cursor, sender_id, chat_type, chat_id)
+        conn.commit()
+    return message_id
+
+
+def run(name, send, threads, messages, users, group_id):
+    per_thread = messages // threads
+
+    def worker(n):
+        sender_id = n % users + 1
+        for i in range(per_thread):
+            if i % 4 == 0:
+                send(sender_id, 'group', group_id, f'group message {i}')
+            else:
+                send(sender_id, 'user', (sender_id % users) + 1, f'direct message {i}')
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    total = per_thread * threads
+    print(f'{name:<22} {total:>6} msgs in {elapsed:6.2f}s  {total / elapsed:8.0f} msgs/sec')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--messages', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--synchronous', default='NORMAL', help='SQLite synchronous pragma (NORMAL or FULL)')
+    args = parser.parse_args()
+
+    db.PRAGMAS = tuple((k, args.synchronous if k == 'synchronous' else v) for k, v in db.PRAGMAS)
+    print(f'{args.threads} sender threads, synchronous={args.synchronous}')
+    with tempfile.TemporaryDirectory() as tmp:
+        group_id = setup(os.path.join(tmp, 'direct.db'), args.users)
+        run('commit per message', send_direct, args.threads, args.messages, args.users, group_id)
+
+        for durability in ('commit', 'assigned'):
+            group_id = setup(os.path.join(tmp, f'batched-{durability}.db'), args.users)
+            writer = MessageWriter()
+
+            def send_batched(sender_id, chat_type, chat_id, content):
+                return writer.submit(content, 'text', sender_id, chat_type, chat_id).wait(durability)
+            metrics.reset()
+            run(f'batched ({durability})', send_batched, args.threads, args.messages, args.users, group_id)
+            counters = metrics.snapshot()['counters']
+            print(f'{"":<22} avg batch {counters["writer.messages"] / counters["writer.batches"]:.1f} messages')
+            # Let the writer drain before the database goes away
+            writer.submit('', 'text', 1, 'user', 1).wait('commit')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Message throughput with 1..N worker processes sharing a message queue.
+
+    python benchmarks/scale_out.py [--workers 1,2,4] [--senders 8] [--messages 200]
+
+Starts the local broker and the requested number of `run.py` workers on
+one throwaway database, then connects real Socket.IO clients over
+websockets, --senders per worker (each client sticks to one worker like it
+would behind the load balancer). Every client sends direct messages to a
+user connected to the next worker, waiting for the echo of each one before
+sending the next, so every delivery crosses the queue. Reports end-to-end
+messages/sec and checks that every message reached its recipient.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import simple_websocket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db
+from broker import Broker
+from migrations import migrate
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'bench'
+
+
+def setup(path, users):
+    db.configure(path)
+    migrate()
+    # A single-iteration hash keeps hundreds of logins cheap
+    password_hash = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1')
+    with db.get_db() as conn:
+        conn.executemany('INSERT INTO users (username, email, password_hash, full_name) VALUES (?, ?, ?, ?)',
+                         [(f'bench{i}', f'bench{i}@example.com', password_hash, f'Bench {i}') for i in range(users)])
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT id FROM users WHERE username LIKE 'bench%' ORDER BY id")]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'worker on port {port} did not start')
+
+
+def login(port, username):
+    """Session cookie for username on the worker at port"""
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/login',
+                                     data=json.dumps({'username': username, 'password': PASSWORD}).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return response.headers['Set-Cookie'].split(';')[0]
+
+
+class Client:
+    """Just enough of the Socket.IO v5 protocol over a websocket"""
+
+    def __init__(self, port, username, user_id):
+        self.user_id = user_id
+        cookie = login(port, username)
+        self.ws = simple_websocket.Client.connect(f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket',
+                                                  headers={'Cookie': cookie})
+        self.ws.receive()           # engine.io open
+        self.ws.send('40')
+        while not self.ws.receive().startswith('40'):
+            pass
+        self.received = 0
+        self.echoes = threading.Semaphore(0)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                packet = self.ws.receive()
+                if packet == '2':
+                    self.ws.send('3')
+                elif packet.startswith('42'):
+                    event, data = json.loads(packet[2:])[:2]
+                    if event != 'new_message':
+                        continue
+                    if data['sender']['id'] == self.user_id:
+                        self.echoes.release()
+                    else:
+                        self.received += 1
+        except Exception:
+            # Closed, possibly while answering a ping
+            pass
+
+    def send_message(self, chat_id, content):
+        self.ws.send('42' + json.dumps(['send_message', {'content': content, 'chat_type': 'user',
+                                                         'chat_id': chat_id}]))
+        if not self.echoes.acquire(timeout=30):
+            raise RuntimeError('no echo for sent message')
+
+    def close(self):
+        try:
+            self.ws.close()
+        except simple_websocket.ConnectionClosed:
+            pass
+
+
+def run(count, senders, messages):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'scale.db')
+        user_ids = setup(path, count * senders)
+        broker_port = free_port()
+        broker = Broker('127.0.0.1', broker_port)
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+
+        ports = [free_port() for _ in range(count)]
+        workers = []
+        try:
+            # One at a time, so only the first creates the sample data
+            for port in ports:
+                workers.append(subprocess.Popen(
+                    [sys.executable, 'run.py'], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    env=dict(os.environ, DOCKTALK_DB=path, DOCKTALK_PORT=str(port),
+                             DOCKTALK_MESSAGE_QUEUE=f'tcp://127.0.0.1:{broker_port}')))
+                wait_for_port(port)
+            clients = [Client(ports[i // senders], f'bench{i}', user_ids[i]) for i in range(count * senders)]
+
+            def send(i):
+                # The same sender slot on the next worker (or the next sender
+                # when there is only one worker)
+                peer = (i + senders) % len(clients) if count > 1 else (i + 1) % senders
+                for n in range(messages):
+                    clients[i].send_message(user_ids[peer], f'message {n}')
+
+            threads = [threading.Thread(target=send, args=(i,)) for i in range(len(clients))]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            total = len(clients) * messages
+            deadline = time.time() + 30
+            while sum(c.received for c in clients) < total and time.time() < deadline:
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            delivered = sum(c.received for c in clients)
+            for client in clients:
+                client.close()
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+            broker.shutdown()
+            broker.server_close()
+
+    print(f'{count} worker(s) {total:>6} msgs in {elapsed:6.2f}s  {total / elapsed:8.0f} msgs/sec  '
+          f'delivered {delivered}/{total}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--senders', type=int, default=8, help='clients per worker')
+    parser.add_argument('--messages', type=int, default=200, help='messages per client')
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} CPUs, {args.senders} clients per worker, {args.messages} messages each')
+    for count in map(int, args.workers.split(',')):
+        run(count, args.senders, args.messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""A large attachment over a flaky link: chunked, resumable upload through
+/api/uploads against one `run.py` worker.
+
+    python benchmarks/uploads.py [--size-mb 200] [--drop-every 5]
+
+Every --drop-every'th chunk is cut off halfway and its connection closed,
+as a dropped mobile link would; the client then asks the server for the
+acknowledged offset and resumes. Reports throughput, how many bytes had to
+be re-sent, whether the stored file matches, and the worker's peak
+resident memory (which should not grow with --size-mb).
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scale_out import ROOT, free_port, login, setup, wait_for_port
+
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+class Uploader:
+    def __init__(self, port, cookie):
+        self.port = port
+        self.cookie = cookie
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            conn.request(method, path, body=body, headers=dict(headers or {}, Cookie=self.cookie))
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def drop(self, path, chunk):
+        """Send half of a chunk that claims its full length, then hang up"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        conn.putrequest('PUT', path)
+        conn.putheader('Cookie', self.cookie)
+        conn.putheader('Content-Length', str(len(chunk)))
+        conn.endheaders()
+        conn.send(chunk[:len(chunk) // 2])
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--drop-every', type=int, default=5, help='cut off every Nth chunk (0: never)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'attachment.zip')
+        digest = hashlib.sha256()
+        with open(source, 'wb') as f:
+            for _ in range(args.size_mb):
+                block = os.urandom(1024 * 1024)
+                f.write(block)
+                digest.update(block)
+        size = os.path.getsize(source)
+
+        path = os.path.join(tmp, 'uploads.db')
+        setup(path, 1)
+        port = free_port()
+        server = subprocess.Popen([sys.executable, 'run.py'], cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  env=dict(os.environ, DOCKTALK_DB=path, DOCKTALK_PORT=str(port),
+                                           DOCKTALK_UPLOAD_PARTIAL_DIR=os.path.join(tmp, 'partial')))
+        try:
+            wait_for_port(port)
+            uploader = Uploader(port, login(port, 'bench0'))
+            print(f'worker before upload: {peak_rss_mb(server.pid):6.1f} MB peak RSS')
+
+            started = time.perf_counter()
+            status, session = uploader.request('POST', '/api/uploads', json.dumps({
+                'file_name': 'attachment.zip', 'file_type': 'file', 'size': size, 'sha256': digest.hexdigest()
+            }), {'Content-Type': 'application/json'})
+            assert status == 200, session
+            url = f"/api/uploads/{session['upload_id']}"
+            offset, sent, chunks = 0, 0, 0
+            with open(source, 'rb') as f:
+                while offset < size:
+                    f.seek(offset)
+                    chunk = f.read(session['chunk_size'])
+                    chunks += 1
+                    sent += len(chunk)
+                    if args.drop_every and chunks % args.drop_every == 0:
+                        uploader.drop(f'{url}?offset={offset}', chunk)
+                        offset = uploader.request('GET', url)[1]['offset']
+                        continue
+                    status, result = uploader.request('PUT', f'{url}?offset={offset}', chunk, {
+                        'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+                    assert status == 200 or 'offset' in result, result
+                    offset = result['offset']
+            status, result = uploader.request('POST', f'{url}/finalize')
+            elapsed = time.perf_counter() - started
+            assert status == 200, result
+
+            stored = os.path.join(ROOT, result['file_url'].lstrip('/'))
+            with open(stored, 'rb') as f:
+                matches = hashlib.file_digest(f, 'sha256').hexdigest() == digest.hexdigest()
+            os.remove(stored)
+            print(f'{args.size_mb} MB in {elapsed:5.1f}s ({args.size_mb / elapsed:5.1f} MB/s), '
+                  f'{chunks} chunk requests, {(sent - size) / 1024 / 1024:5.1f} MB re-sent after drops')
+            print(f'stored file matches: {matches}')
+            print(f'worker after upload:  {peak_rss_mb(server.pid):6.1f} MB peak RSS')
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
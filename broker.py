@@ -0,0 +1,237 @@
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+import metrics
+
+# Socket.IO emits are shared between worker processes through a message
+# queue: every worker publishes what it emits and delivers what the others
+# publish to its own sockets. Production deployments can point
+# DOCKTALK_MESSAGE_QUEUE at Redis or RabbitMQ (redis://, amqp://, handled
+# by python-socketio); tcp:// uses the small broker below, which needs no
+# extra packages and is what tests and single-host deployments run.
+#
+#   python broker.py --port 7001
+#   DOCKTALK_MESSAGE_QUEUE=tcp://127.0.0.1:7001 DOCKTALK_PORT=6001 python run.py
+#   DOCKTALK_MESSAGE_QUEUE=tcp://127.0.0.1:7001 DOCKTALK_PORT=6002 python run.py
+#
+# The load balancer in front of the workers must use sticky sessions (e.g.
+# nginx `ip_hash`): a long-polling client has to reach the same worker on
+# every request.
+#
+# Each worker opens two connections and names its role (and itself) in the
+# first frame: one it only publishes on and one it only listens on, which
+# is not sent the worker's own frames back. The broker queues
+# frames per listener and writes them from that listener's own thread, so
+# publishing never waits on a socket; a listener that falls more than
+# SUBSCRIBER_BACKLOG frames behind is disconnected (and reconnects) rather
+# than holding up everyone else.
+
+DEFAULT_PORT = 7001
+RECONNECT_DELAY = 1.0
+SUBSCRIBER_BACKLOG = 10000
+
+PUBLISH = b'\x00publish'
+SUBSCRIBE = b'\x00subscribe'
+
+_HEADER = struct.Struct('!I')
+
+
+def send_frame(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Next length-prefixed frame, or None once the peer has gone"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    return _recv_exact(sock, _HEADER.unpack(header)[0])
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _Connection(socketserver.BaseRequestHandler):
+    """One worker connection: publishers' frames go to every subscriber,
+    subscribers are sent what is queued for them"""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.queue = queue.Queue(SUBSCRIBER_BACKLOG)
+        self.dropped = False
+        self.worker = None
+
+    def handle(self):
+        try:
+            hello = recv_frame(self.request)
+        except OSError:
+            return
+        role, _, self.worker = (hello or b'').partition(b' ')
+        if role == PUBLISH:
+            self._receive()
+        elif role == SUBSCRIBE:
+            self.server.subscribe(self)
+            self._send()
+
+    def _receive(self):
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except OSError:
+                return
+            if frame is None:
+                return
+            self.server.publish(self.worker, frame)
+
+    def _send(self):
+        while True:
+            frame = self.queue.get()
+            if self.dropped:
+                return
+            try:
+                send_frame(self.request, frame)
+            except OSError:
+                return
+
+    def finish(self):
+        self.server.unsubscribe(self)
+
+    def deliver(self, frame):
+        """Queue frame for this subscriber; False if it has fallen too far
+        behind and was dropped"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped = True
+            # Unblocks a send stuck on the full socket buffer
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    """In-process fan-out of frames between connected workers"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        super().__init__((host, port), _Connection)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, worker, frame):
+        with self._lock:
+            targets = [s for s in self._subscribers if s.worker != worker]
+        for subscriber in targets:
+            if not subscriber.deliver(frame):
+                self.unsubscribe(subscriber)
+                metrics.incr('broker.dropped_subscribers')
+        metrics.incr('broker.frames')
+        metrics.incr('broker.deliveries', len(targets))
+
+
+class BrokerManager(socketio.PubSubManager):
+    """python-socketio client manager that talks to a Broker over TCP"""
+
+    name = 'docktalk-broker'
+
+    def __init__(self, url=f'tcp://127.0.0.1:{DEFAULT_PORT}', channel='socketio',
+                 write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_PORT)
+        self._prefix = channel.encode() + b'\n'
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self, role):
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(sock, role + b' ' + self.host_id.encode())
+        return sock
+
+    def _publish(self, data):
+        frame = self._prefix + self.json.dumps(data).encode()
+        with self._publish_lock:
+            for retry in (False, True):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(PUBLISH)
+                    send_frame(self._publisher, frame)
+                    return
+                except OSError:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                    self._publisher = None
+                    if retry:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(SUBSCRIBE)
+            except OSError as e:
+                self._get_logger().error(f'Cannot reach message broker at {self.address}: {e}')
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                while True:
+                    frame = recv_frame(sock)
+                    if frame is None:
+                        break
+                    channel, _, payload = frame.partition(b'\n')
+                    if channel == self._prefix[:-1]:
+                        yield payload.decode()
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            self._get_logger().error('Lost connection to message broker, reconnecting')
+            time.sleep(RECONNECT_DELAY)
+
+
+def queue_options(url):
+    """SocketIO() keyword arguments for a DOCKTALK_MESSAGE_QUEUE URL"""
+    if not url:
+        return {}
+    if url.startswith('tcp://'):
+        return {'client_manager': BrokerManager(url)}
+    return {'message_queue': url}
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[sys.argv.index('--port') + 1]) if '--port' in sys.argv else DEFAULT_PORT
+    broker = Broker('127.0.0.1', port)
+    print(f"Message broker listening on 127.0.0.1:{port}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
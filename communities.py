@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from db import get_db
+
+# The community -> groups tree in the sidebar changes only when someone
+# creates or joins or leaves a group or community, so each user's tree
+# (names, avatars, member counts) is cached and built with two set-based
+# queries on a miss. Last message and unread counts change with every
+# message and are merged in per request (see with_activity).
+#
+# A membership change alters the member counts every other member sees, so
+# invalidation drops all trees rather than working out whose changed.
+# Other worker processes only see a change once their copy expires after
+# COMMUNITY_CACHE_TTL seconds.
+COMMUNITY_CACHE_SIZE = int(os.environ.get('DOCKTALK_COMMUNITY_CACHE_SIZE', 4096))
+COMMUNITY_CACHE_TTL = float(os.environ.get('DOCKTALK_COMMUNITY_CACHE_TTL', 60))
+
+
+def _load_tree(cursor, user_id):
+    """Communities of user_id, newest first, each with the groups of it
+    user_id belongs to, as tuples that are never mutated"""
+    cursor.execute('''
+        SELECT c.id, c.name, c.description, c.avatar_url, c.created_at, counts.members
+        FROM community_members mine
+        JOIN communities c ON c.id = mine.community_id
+        JOIN (
+            SELECT cm.community_id, COUNT(*) AS members
+            FROM community_members cm
+            WHERE cm.community_id IN (SELECT community_id FROM community_members WHERE user_id = ?)
+            GROUP BY cm.community_id
+        ) counts ON counts.community_id = c.id
+        WHERE mine.user_id = ?
+        ORDER BY c.created_at DESC
+    ''', (user_id, user_id))
+    community_rows = cursor.fetchall()
+
+    cursor.execute('''
+        SELECT g.id, g.name, g.description, g.avatar_url, g.expires_at, g.created_at,
+               g.community_id, counts.members
+        FROM group_members mine
+        JOIN groups g ON g.id = mine.group_id
+        JOIN (
+            SELECT gm.group_id, COUNT(*) AS members
+            FROM group_members gm
+            WHERE gm.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+            GROUP BY gm.group_id
+        ) counts ON counts.group_id = g.id
+        WHERE mine.user_id = ?
+    ''', (user_id, user_id))
+    groups = {}
+    for row in cursor.fetchall():
+        groups.setdefault(row[6], []).append(row)
+
+    return tuple((row, tuple(groups.get(row[0], ()))) for row in community_rows)
+
+
+class CommunityCache:
+    """Bounded LRU of per-user community trees with a time-to-live"""
+
+    def __init__(self, size=COMMUNITY_CACHE_SIZE, ttl=COMMUNITY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is not
+        # written back into the cache
+        self._generation = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._trees.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._trees.move_to_end(user_id)
+                metrics.incr('communities.hits')
+                return entry[1]
+            generation = self._generation
+        metrics.incr('communities.misses')
+
+        with get_db() as conn:
+            tree = _load_tree(conn.cursor(), user_id)
+        with self._lock:
+            if generation == self._generation:
+                self._trees[user_id] = (time.monotonic(), tree)
+                self._trees.move_to_end(user_id)
+                while len(self._trees) > self.size:
+                    self._trees.popitem(last=False)
+        return tree
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._trees.clear()
+        metrics.incr('communities.invalidations')
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._trees), 'max_size': self.size, 'ttl': self.ttl}
+
+
+_cache = CommunityCache()
+metrics.register_gauge('communities', lambda: _cache.stats())
+
+
+def group_activity(cursor, user_id):
+    """{group id: (last message preview, its time, unread)} for every group
+    user_id belongs to"""
+    cursor.execute('''
+        SELECT gm.group_id, cs.last_message_preview, cs.last_message_at, COALESCE(uc.unread, 0)
+        FROM group_members gm
+        LEFT JOIN conversation_summaries cs
+            ON cs.chat_type = 'group' AND cs.chat_id = gm.group_id AND cs.peer_id = 0
+        LEFT JOIN unread_counts uc
+            ON uc.user_id = gm.user_id AND uc.chat_type = 'group' AND uc.chat_id = gm.group_id AND uc.peer_id = 0
+        WHERE gm.user_id = ?
+    ''', (user_id,))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def community_tree(user_id, activity):
+    """The /api/communities payload for user_id. activity maps group ids to
+    (last message, last message time, unread) as from group_activity();
+    groups are ordered by their latest activity."""
+    communities = []
+    for row, group_rows in _cache.get(int(user_id)):
+        groups = []
+        for group in group_rows:
+            last_message, last_message_at, unread = activity.get(group[0], (None, None, 0))
+            groups.append({
+                'id': str(group[0]),
+                'name': group[1],
+                'description': group[2],
+                'avatar': group[3] or '/static/default-group.png',
+                'expiresAt': group[4],
+                'createdAt': group[5],
+                'members': group[7],
+                'lastMessage': last_message or 'No messages yet',
+                'timestamp': last_message_at or group[5],
+                'unread': unread
+            })
+        groups.sort(key=lambda group: group['timestamp'] or '', reverse=True)
+        communities.append({
+            'id': str(row[0]),
+            'name': row[1],
+            'description': row[2],
+            'avatar': row[3] or '/static/default-community.png',
+            'createdAt': row[4],
+            'members': row[5],
+            'groups': groups
+        })
+    return communities
+
+
+def invalidate_communities():
+    """Forget every cached tree after a community or group membership change"""
+    _cache.clear()
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import metrics
+
+
+class ConnectionRegistry:
+    """Live sockets of this process, indexed both by user and by sid.
+
+    A user is online while at least one of their sockets (tabs, devices) is
+    connected; only the first connect and the last disconnect change that.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> {sid: (connected_at, transport)}
+        self._by_user = {}
+        # sid -> user_id
+        self._by_sid = {}
+
+    def add(self, user_id, sid, transport=None):
+        """Register a socket; True if it is the user's first"""
+        with self._lock:
+            if sid in self._by_sid:
+                return False
+            sessions = self._by_user.setdefault(user_id, {})
+            sessions[sid] = (time.time(), transport or 'unknown')
+            self._by_sid[sid] = user_id
+            first = len(sessions) == 1
+        metrics.incr('connections.opened')
+        return first
+
+    def remove(self, sid):
+        """Forget a socket; returns (user_id, True if it was their last)"""
+        with self._lock:
+            user_id = self._by_sid.pop(sid, None)
+            if user_id is None:
+                return None, False
+            sessions = self._by_user.get(user_id, {})
+            sessions.pop(sid, None)
+            last = not sessions
+            if last:
+                self._by_user.pop(user_id, None)
+        metrics.incr('connections.closed')
+        return user_id, last
+
+    def is_online(self, user_id):
+        return int(user_id) in self._by_user
+
+    def sids(self, user_id):
+        with self._lock:
+            return list(self._by_user.get(int(user_id), ()))
+
+    def sessions(self, user_id):
+        """[(sid, connected_at, transport)] for one user"""
+        with self._lock:
+            return [(sid,) + info for sid, info in self._by_user.get(int(user_id), {}).items()]
+
+    def user_for(self, sid):
+        return self._by_sid.get(sid)
+
+    def stats(self):
+        with self._lock:
+            counts = [len(sessions) for sessions in self._by_user.values()]
+            transports = {}
+            for sessions in self._by_user.values():
+                for _, transport in sessions.values():
+                    transports[transport] = transports.get(transport, 0) + 1
+        return {
+            'sockets': sum(counts),
+            'users': len(counts),
+            'multi_session_users': sum(1 for count in counts if count > 1),
+            'max_sessions_per_user': max(counts, default=0),
+            'transports': transports
+        }
+
+
+connection_registry = ConnectionRegistry()
+metrics.register_gauge('connections', lambda: connection_registry.stats())
@@ -0,0 +1,285 @@
+# Per-conversation bookkeeping that is maintained on the write path so the
+# chat list endpoints never have to scan message history.
+#
+# A conversation is identified by (chat_type, chat_id, peer_id):
+#   group chats   -> ('group', group_id, 0)
+#   direct chats  -> ('user', lower user id, higher user id)
+
+PREVIEW_LENGTH = 100
+
+
+def conversation_key(chat_type, chat_id, user_id):
+    """Normalise a (chat_type, chat_id) pair as seen by user_id"""
+    chat_id = int(chat_id)
+    if chat_type == 'user':
+        user_id = int(user_id)
+        return ('user', min(user_id, chat_id), max(user_id, chat_id))
+    return ('group', chat_id, 0)
+
+
+def record_message(cursor, message_id, sender_id, chat_type, chat_id, content, count=1):
+    """Fold a newly inserted message into its conversation summary.
+
+    Must run on the same connection, before commit, as the INSERT into
+    messages so the summary and history never disagree. count lets a batch
+    of messages to one conversation be recorded at once, with message_id
+    and content taken from the newest.
+    """
+    key = conversation_key(chat_type, chat_id, sender_id)
+    cursor.execute('''
+        INSERT INTO conversation_summaries
+            (chat_type, chat_id, peer_id, last_message_id, last_message_preview,
+             last_message_at, last_sender_id, message_count)
+        VALUES (?, ?, ?, ?, ?, (SELECT created_at FROM messages WHERE id = ?), ?, ?)
+        ON CONFLICT (chat_type, chat_id, peer_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_message_preview = excluded.last_message_preview,
+            last_message_at = excluded.last_message_at,
+            last_sender_id = excluded.last_sender_id,
+            message_count = message_count + excluded.message_count
+    ''', key + (message_id, (content or '')[:PREVIEW_LENGTH], message_id, sender_id, count))
+
+
+def increment_unread(cursor, sender_id, chat_type, chat_id, amount=1):
+    """Bump the unread counter of every other participant by amount"""
+    chat_type, low_id, high_id = conversation_key(chat_type, chat_id, sender_id)
+    if chat_type == 'user':
+        if low_id == high_id:
+            return  # notes to self are never unread
+        recipient_id = high_id if low_id == int(sender_id) else low_id
+        cursor.execute('''
+            INSERT INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+            VALUES (?, 'user', ?, ?, ?)
+            ON CONFLICT (user_id, chat_type, chat_id, peer_id) DO UPDATE SET
+                unread = unread + excluded.unread
+        ''', (recipient_id, low_id, high_id, amount))
+    else:
+        cursor.execute('''
+            INSERT INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+            SELECT user_id, 'group', group_id, 0, ?
+            FROM group_members
+            WHERE group_id = ? AND user_id != ?
+            ON CONFLICT (user_id, chat_type, chat_id, peer_id) DO UPDATE SET
+                unread = unread + excluded.unread
+        ''', (amount, low_id, sender_id))
+
+
+def record_announcement(cursor, announcement_id, sender_id):
+    """Summary and unread bookkeeping for every group an announcement reached.
+
+    Set-based counterpart of record_message/increment_unread for the
+    message rows linked to announcement_id.
+    """
+    cursor.execute('''
+        INSERT INTO conversation_summaries
+            (chat_type, chat_id, peer_id, last_message_id, last_message_preview,
+             last_message_at, last_sender_id, message_count)
+        SELECT 'group', chat_id, 0, id, substr(content, 1, ?), created_at, sender_id, 1
+        FROM messages
+        WHERE announcement_id = ?
+        ON CONFLICT (chat_type, chat_id, peer_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_message_preview = excluded.last_message_preview,
+            last_message_at = excluded.last_message_at,
+            last_sender_id = excluded.last_sender_id,
+            message_count = message_count + 1
+    ''', (PREVIEW_LENGTH, announcement_id))
+    cursor.execute('''
+        INSERT INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+        SELECT gm.user_id, 'group', gm.group_id, 0, 1
+        FROM messages m
+        JOIN group_members gm ON gm.group_id = m.chat_id
+        WHERE m.announcement_id = ? AND gm.user_id != ?
+        ON CONFLICT (user_id, chat_type, chat_id, peer_id) DO UPDATE SET
+            unread = unread + 1
+    ''', (announcement_id, sender_id))
+
+
+def _others_watermark(cursor, user_id, key):
+    """Lowest (delivered_id, seen_id) among the other participants"""
+    chat_type, chat_id, peer_id = key
+    if chat_type == 'user':
+        other_id = peer_id if chat_id == int(user_id) else chat_id
+        cursor.execute('''
+            SELECT delivered_id, seen_id FROM read_watermarks
+            WHERE user_id = ? AND chat_type = 'user' AND chat_id = ? AND peer_id = ?
+        ''', (other_id, chat_id, peer_id))
+    else:
+        cursor.execute('''
+            SELECT MIN(COALESCE(w.delivered_id, 0)), MIN(COALESCE(w.seen_id, 0))
+            FROM group_members gm
+            LEFT JOIN read_watermarks w
+                ON w.user_id = gm.user_id AND w.chat_type = 'group' AND w.chat_id = gm.group_id AND w.peer_id = 0
+            WHERE gm.group_id = ? AND gm.user_id != ?
+        ''', (chat_id, user_id))
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return (row[0], row[1])
+
+
+def get_watermarks(cursor, user_id, chat_type, chat_id):
+    """Return ((delivered_id, seen_id) of user_id, lowest of everyone else)"""
+    key = conversation_key(chat_type, chat_id, user_id)
+    cursor.execute('''
+        SELECT delivered_id, seen_id FROM read_watermarks
+        WHERE user_id = ? AND chat_type = ? AND chat_id = ? AND peer_id = ?
+    ''', (user_id,) + key)
+    own = cursor.fetchone() or (0, 0)
+    others = _others_watermark(cursor, user_id, key) or (0, 0)
+    return tuple(own), others
+
+
+def message_status(message_id, sender_id, user_id, watermarks):
+    """Derive 'sent'/'delivered'/'seen' for one message from get_watermarks().
+
+    Your own messages report how far everyone else has got; messages from
+    others report your own position.
+    """
+    own, others = watermarks
+    delivered_id, seen_id = others if sender_id == int(user_id) else own
+    if message_id <= seen_id:
+        return 'seen'
+    if message_id <= delivered_id:
+        return 'delivered'
+    return 'sent'
+
+
+def advance_watermark(cursor, user_id, chat_type, chat_id, delivered_id=None, seen_id=None):
+    """Move user_id's delivery/read position in a conversation forward.
+
+    Watermarks never move backwards and are capped at the conversation's
+    last message. When the read position moves, the user's unread counter
+    is recomputed from it. Returns (sender_id, status, up_to) for every
+    sender whose ticks advanced, measured as message_status() does: the
+    reader's position in a direct chat, the lowest position over the
+    members other than the sender in a group.
+    """
+    key = conversation_key(chat_type, chat_id, user_id)
+    cursor.execute('''
+        SELECT last_message_id FROM conversation_summaries
+        WHERE chat_type = ? AND chat_id = ? AND peer_id = ?
+    ''', key)
+    summary = cursor.fetchone()
+    if not summary:
+        return []
+    last_id = summary[0]
+    seen_id = min(int(seen_id or 0), last_id)
+    delivered_id = min(max(int(delivered_id or 0), seen_id), last_id)
+
+    cursor.execute('''
+        SELECT delivered_id, seen_id FROM read_watermarks
+        WHERE user_id = ? AND chat_type = ? AND chat_id = ? AND peer_id = ?
+    ''', (user_id,) + key)
+    old_delivered, old_seen = cursor.fetchone() or (0, 0)
+    if delivered_id <= old_delivered and seen_id <= old_seen:
+        return []
+
+    cursor.execute('''
+        INSERT INTO read_watermarks (user_id, chat_type, chat_id, peer_id, delivered_id, seen_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, chat_type, chat_id, peer_id) DO UPDATE SET
+            delivered_id = MAX(delivered_id, excluded.delivered_id),
+            seen_id = MAX(seen_id, excluded.seen_id),
+            updated_at = CURRENT_TIMESTAMP
+    ''', (user_id,) + key + (delivered_id, seen_id))
+    new_delivered, new_seen = max(delivered_id, old_delivered), max(seen_id, old_seen)
+
+    if new_seen > old_seen:
+        _reset_unread(cursor, user_id, key, new_seen)
+
+    if key[0] == 'user':
+        # Only the other participant's messages are affected
+        other_id = key[2] if key[1] == int(user_id) else key[1]
+        return _ticks(other_id, (old_delivered, old_seen), (new_delivered, new_seen))
+
+    # A sender's ticks are the lowest position over the members other than
+    # them, so each sender with messages in the range this user moved over
+    # is measured on its own; it only moves if this user was holding it back
+    cursor.execute('''
+        SELECT DISTINCT sender_id FROM messages
+        WHERE chat_type = 'group' AND chat_id = ? AND id > ? AND id <= ? AND sender_id != ?
+    ''', (key[1], old_seen, new_delivered, user_id))
+    senders = [row[0] for row in cursor.fetchall()]
+    if not senders:
+        return []
+    cursor.execute('''
+        SELECT gm.user_id, COALESCE(w.delivered_id, 0), COALESCE(w.seen_id, 0)
+        FROM group_members gm
+        LEFT JOIN read_watermarks w
+            ON w.user_id = gm.user_id AND w.chat_type = 'group' AND w.chat_id = gm.group_id AND w.peer_id = 0
+        WHERE gm.group_id = ?
+    ''', (key[1],))
+    after = {row[0]: row[1:] for row in cursor.fetchall()}
+    before = dict(after)
+    before[int(user_id)] = (old_delivered, old_seen)
+    advanced = []
+    for sender_id in senders:
+        old = _lowest(before, sender_id)
+        if old is not None:
+            advanced += _ticks(sender_id, old, _lowest(after, sender_id))
+    return advanced
+
+
+def _lowest(positions, excluded_id):
+    """Lowest (delivered_id, seen_id) over the members other than excluded_id"""
+    others = [position for member_id, position in positions.items() if member_id != excluded_id]
+    if not others:
+        return None
+    return (min(p[0] for p in others), min(p[1] for p in others))
+
+
+def _ticks(sender_id, old, new):
+    """(sender_id, status, up_to) for the ticks that moved from old to new"""
+    advanced = []
+    seen_advanced = new[1] > old[1]
+    # "seen" implies "delivered", so only report delivery beyond the seen point
+    if new[0] > old[0] and not (seen_advanced and new[0] <= new[1]):
+        advanced.append((sender_id, 'delivered', new[0]))
+    if seen_advanced:
+        advanced.append((sender_id, 'seen', new[1]))
+    return advanced
+
+
+def _reset_unread(cursor, user_id, key, seen_id):
+    """Recount what user_id has not read yet after their read position moved"""
+    chat_type, chat_id, peer_id = key
+    if chat_type == 'user':
+        other_id = peer_id if chat_id == int(user_id) else chat_id
+        cursor.execute('''
+            SELECT COUNT(*) FROM messages
+            WHERE sender_id = ? AND chat_type = 'user' AND chat_id = ? AND id > ?
+        ''', (other_id, user_id, seen_id))
+    else:
+        cursor.execute('''
+            SELECT COUNT(*) FROM messages
+            WHERE chat_type = 'group' AND chat_id = ? AND id > ? AND sender_id != ?
+        ''', (chat_id, seen_id, user_id))
+    unread = cursor.fetchone()[0]
+    cursor.execute('''
+        INSERT INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, chat_type, chat_id, peer_id) DO UPDATE SET
+            unread = excluded.unread
+    ''', (user_id,) + key + (unread,))
+
+
+def get_unread(cursor, user_id, chat_type, chat_id):
+    key = conversation_key(chat_type, chat_id, user_id)
+    cursor.execute('''
+        SELECT unread FROM unread_counts
+        WHERE user_id = ? AND chat_type = ? AND chat_id = ? AND peer_id = ?
+    ''', (user_id,) + key)
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def forget_conversation(cursor, user_id, chat_type, chat_id):
+    """Drop user_id's unread counter and read position for a conversation
+    they are leaving (call in the same transaction as the membership change)"""
+    key = conversation_key(chat_type, chat_id, user_id)
+    for table in ('unread_counts', 'read_watermarks'):
+        cursor.execute(f'''
+            DELETE FROM {table}
+            WHERE user_id = ? AND chat_type = ? AND chat_id = ? AND peer_id = ?
+        ''', (user_id,) + key)
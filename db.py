@@ -0,0 +1,139 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# Database location and pool sizing; override through the environment
+DB_PATH = os.environ.get('DOCKTALK_DB', 'docktalk.db')
+POOL_SIZE = int(os.environ.get('DOCKTALK_DB_POOL_SIZE', 16))
+POOL_TIMEOUT = float(os.environ.get('DOCKTALK_DB_POOL_TIMEOUT', 10))
+
+# Applied to every new connection. WAL lets readers proceed while a writer
+# commits, and synchronous=NORMAL is durable across application crashes in
+# WAL mode (only an OS crash can lose the last transactions).
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', os.environ.get('DOCKTALK_DB_SYNCHRONOUS', 'NORMAL')),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),        # ~16MB page cache per connection
+    ('mmap_size', 268435456),      # 256MB memory-mapped I/O
+    ('temp_store', 'MEMORY'),
+)
+
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections shared by all request threads"""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        metrics.incr('db.connections_opened')
+        return conn
+
+    def acquire(self):
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                metrics.incr('db.pool_waits')
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    metrics.incr('db.pool_timeouts')
+                    raise RuntimeError('Timed out waiting for a database connection')
+
+        with self._lock:
+            self._in_use += 1
+        metrics.observe('db.checkout', time.perf_counter() - started)
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'size': self.size,
+                'open': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize()
+            }
+
+
+_pool = ConnectionPool(DB_PATH)
+metrics.register_gauge('db.pool', lambda: _pool.stats())
+
+
+def configure(path=None, pool_size=None):
+    """Point the pool at a different database file or resize it"""
+    global _pool
+    old_pool = _pool
+    _pool = ConnectionPool(path or old_pool.path, pool_size or old_pool.size)
+    old_pool.close()
+
+
+def get_path():
+    return _pool.path
+
+
+@contextmanager
+def get_db():
+    """Check out a pooled connection for the duration of a with-block.
+
+    Callers commit explicitly; anything left uncommitted when the block
+    exits is rolled back, just like closing a plain sqlite3 connection.
+    """
+    conn = _pool.acquire()
+    try:
+        yield conn
+    finally:
+        _pool.release(conn)
@@ -0,0 +1,73 @@
+import os
+import threading
+
+import metrics
+
+# How long receipts for the same room/conversation are merged before sending
+RECEIPT_WINDOW = 0.25
+# Counting a room's sockets walks the whole room, so only one emit in
+# RECIPIENT_SAMPLE per event is counted (0 turns counting off)
+RECIPIENT_SAMPLE = int(os.environ.get('DOCKTALK_FANOUT_SAMPLE', 100))
+
+
+class Fanout:
+    """Room-targeted emits that record how many sockets each event reaches.
+
+    Counters are exposed through /api/metrics as fanout.<event>.emits (emit
+    calls), and fanout.<event>.sampled_emits with .sampled_recipients
+    (sockets in this process reached by the emits that were counted); their
+    ratio is the average fan-out.
+    """
+
+    def __init__(self, socketio, namespace='/'):
+        self.socketio = socketio
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+        self._emits = {}
+
+    def room_size(self, room=None):
+        """Sockets connected to this process that are in room (None = everyone)"""
+        try:
+            return sum(1 for _ in self.socketio.server.manager.get_participants(self.namespace, room))
+        except (AttributeError, KeyError):
+            return 0
+
+    def emit(self, event, data, room=None):
+        """Emit to a room, or to every socket when room is None"""
+        metrics.incr(f'fanout.{event}.emits')
+        if RECIPIENT_SAMPLE:
+            with self._lock:
+                count = self._emits[event] = self._emits.get(event, 0) + 1
+            if (count - 1) % RECIPIENT_SAMPLE == 0:
+                metrics.incr(f'fanout.{event}.sampled_emits')
+                metrics.incr(f'fanout.{event}.sampled_recipients', self.room_size(room))
+        self.socketio.emit(event, data, to=room, namespace=self.namespace)
+
+    def emit_status(self, room, status_data):
+        """Queue a message_status_update, merging with any pending one.
+
+        Updates for the same room, conversation and status within
+        RECEIPT_WINDOW collapse into one event carrying the highest up_to.
+        """
+        key = (room, status_data['chat_type'], status_data['chat_id'], status_data['status'])
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or pending['up_to'] < status_data['up_to']:
+                if pending is not None:
+                    metrics.incr('fanout.message_status_update.coalesced')
+                self._pending[key] = dict(status_data)
+            else:
+                metrics.incr('fanout.message_status_update.coalesced')
+            if self._flusher is None:
+                self._flusher = self.socketio.start_background_task(self._flush_later)
+
+    def _flush_later(self):
+        self.socketio.sleep(RECEIPT_WINDOW)
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._flusher = None
+        for (room, _, _, _), status_data in pending.items():
+            self.emit('message_status_update', status_data, room=room)
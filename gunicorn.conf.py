@@ -0,0 +1,24 @@
+# Gunicorn settings for `gunicorn -c gunicorn.conf.py wsgi:app`
+import os
+
+from serving import ASYNC_MODE
+
+bind = f"0.0.0.0:{os.environ.get('DOCKTALK_PORT', 600)}"
+
+# Socket.IO keeps per-connection state in the process that accepted it, so
+# each gunicorn instance runs one worker. Run more instances on other ports
+# with DOCKTALK_MESSAGE_QUEUE set to use more cores (see broker.py).
+workers = 1
+
+if ASYNC_MODE == 'threading':
+    # Every open websocket holds one of these threads
+    worker_class = 'gthread'
+    threads = int(os.environ.get('DOCKTALK_THREADS', 1000))
+else:
+    worker_class = ASYNC_MODE
+    worker_connections = int(os.environ.get('DOCKTALK_WORKER_CONNECTIONS', 10000))
+
+# Websockets and long-polls stay open far longer than the default 30s
+timeout = 120
+graceful_timeout = 10
+accesslog = None
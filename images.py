@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+
+import metrics
+
+# Uploaded images are kept as sent; smaller renditions are rendered next to
+# them by a pool of worker processes, so a burst of photo uploads neither
+# holds request threads for the decode and resize nor competes with them
+# for the GIL. The renditions' URLs and sizes are worked out from the image
+# header when the upload is stored and travel with the message, so clients
+# can lay out and fetch the smallest image that fits before (or while) the
+# pool writes the files.
+RENDITIONS = (
+    ('preview', (800, 600)),   # shown in the conversation
+    ('thumb', (320, 320)),     # media panels and lists
+)
+IMAGE_WORKERS = int(os.environ.get('DOCKTALK_IMAGE_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+# Encode renditions as WebP instead of JPEG/PNG
+IMAGE_WEBP = os.environ.get('DOCKTALK_IMAGE_WEBP', '0') == '1'
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+# EXIF orientations that swap width and height
+_ROTATED = {5, 6, 7, 8}
+
+_pool = None
+
+
+def _fit(size, box):
+    """Size of an image scaled down (never up) to fit box, keeping its
+    aspect ratio"""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def plan(path, url):
+    """Rendition URLs and sizes for the image at path (served at url), or
+    None if it is not an image PIL can read. Only the header is parsed."""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in _ROTATED:
+                width, height = height, width
+            animated = getattr(img, 'is_animated', False)
+            transparent = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    except Exception:
+        return None
+
+    stem = url.rsplit('.', 1)[0]
+    extension = 'webp' if IMAGE_WEBP else 'png' if transparent else 'jpg'
+    renditions = {'original': {'url': url, 'width': width, 'height': height}}
+    for name, box in RENDITIONS:
+        size = _fit((width, height), box)
+        if animated or size == (width, height):
+            # Small enough already, and animations would lose their frames
+            renditions[name] = renditions['original']
+        else:
+            renditions[name] = {'url': f"{stem}.{name}.{extension}", 'width': size[0], 'height': size[1]}
+    return {'width': width, 'height': height, 'renditions': renditions}
+
+
+def render(path, outputs):
+    """Write each (path, width, height) in outputs, largest first, as a
+    scaled copy of the image at path. Runs in a pool process."""
+    with Image.open(path) as img:
+        # JPEG can decode straight to 1/2, 1/4 or 1/8 scale, which is most
+        # of the saving for camera photos. draft() works in stored
+        # orientation, before the EXIF rotation below.
+        width, height = max(outputs, key=lambda output: output[1])[1:]
+        if img.getexif().get(0x0112) in _ROTATED:
+            width, height = height, width
+        img.draft('RGB', (width, height))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+        for target, width, height in sorted(outputs, key=lambda output: -output[1]):
+            # Each rendition is scaled from the previous, larger one
+            img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            temp = f"{target}.{uuid.uuid4().hex}.tmp"
+            extension = target.rsplit('.', 1)[1]
+            if extension == 'webp':
+                img.save(temp, 'WEBP', quality=WEBP_QUALITY, method=4)
+            elif extension == 'png':
+                img.save(temp, 'PNG', optimize=True)
+            else:
+                img.convert('RGB').save(temp, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(temp, target)
+    return len(outputs)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn rather than fork: the server may be threaded or monkey
+        # patched, neither of which survives a fork safely. Workers import
+        # the main script again (without running its __main__ block).
+        _pool = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _discard_broken_pool(error):
+    global _pool
+    if isinstance(error, BrokenProcessPool):
+        # A worker died; the next upload starts a fresh pool
+        _pool = None
+
+
+def _done(future):
+    error = future.exception()
+    if error is not None:
+        metrics.incr('images.errors')
+        print(f"Error processing image: {error}")
+        _discard_broken_pool(error)
+    else:
+        metrics.incr('images.processed')
+
+
+def submit(path, media):
+    """Queue rendering of every rendition in media (from plan) that is not
+    the original; renditions are written next to the original at path.
+    Returns the future, or None if there is nothing to render or the pool
+    cannot take it (the upload stands; clients fall back to the original)."""
+    original = media['renditions']['original']['url']
+    directory = os.path.dirname(path)
+    outputs = [(os.path.join(directory, rendition['url'].rsplit('/', 1)[1]), rendition['width'], rendition['height'])
+               for rendition in media['renditions'].values() if rendition['url'] != original]
+    if not outputs:
+        return None
+    metrics.incr('images.submitted')
+    try:
+        future = _get_pool().submit(render, path, outputs)
+    except Exception as e:
+        metrics.incr('images.errors')
+        print(f"Error queueing image {path}: {e}")
+        _discard_broken_pool(e)
+        return None
+    future.add_done_callback(_done)
+    return future
+
+
+metrics.register_gauge('images', lambda: {'workers': IMAGE_WORKERS, 'webp': IMAGE_WEBP,
+                                          'started': _pool is not None})
@@ -0,0 +1,128 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+
+import metrics
+from storage import OBJECT_DIR, UPLOAD_ROOT
+
+# Uploaded files are served by this module rather than Flask's static view:
+#
+# - Content-addressed objects (storage.py) never change under their name,
+#   so they are cached as immutable and browsers stop revalidating them.
+#   Files from before that keep a shorter max-age.
+# - A single byte range is answered with 206, so seeking inside a voice
+#   note or resuming a download does not fetch the whole file again.
+# - The body goes out through the server's wsgi.file_wrapper, which
+#   gunicorn turns into sendfile(2) - also for ranges, since gunicorn stops
+#   at Content-Length.
+# - With DOCKTALK_MEDIA_ACCEL_REDIRECT set to an internal nginx location
+#   that maps onto static/uploads/, the app only checks the request and
+#   nginx sends the file (ranges included):
+#
+#       location /_uploads/ { internal; alias /srv/docktalk/static/uploads/; }
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+MEDIA_MAX_AGE = int(os.environ.get('DOCKTALK_MEDIA_MAX_AGE', 24 * 3600))
+ACCEL_REDIRECT = os.environ.get('DOCKTALK_MEDIA_ACCEL_REDIRECT')
+
+BUFFER = 64 * 1024
+
+
+def _read(file, length):
+    """Yield length bytes of file from its current position, then close it"""
+    try:
+        while length > 0:
+            buffer = file.read(min(BUFFER, length))
+            if not buffer:
+                break
+            length -= len(buffer)
+            yield buffer
+    finally:
+        file.close()
+
+
+def _body(path, start, length, size):
+    file = open(path, 'rb')
+    file.seek(start)
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    # Only gunicorn is known to stop a file_wrapper at Content-Length;
+    # elsewhere it is used for bodies that run to the end of the file
+    if wrapper is not None and (start + length == size
+                                or request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        return wrapper(file, BUFFER)
+    return _read(file, length)
+
+
+def _not_found():
+    metrics.incr('media.not_found')
+    # Image renditions appear shortly after their upload; don't let a
+    # cache remember the miss
+    response = Response('Not found', 404, mimetype='text/plain')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def send(filename):
+    """Response for GET/HEAD of filename under static/uploads"""
+    path = safe_join(UPLOAD_ROOT, filename)
+    if path is None or not os.path.isfile(path):
+        return _not_found()
+    stat = os.stat(path)
+    size = stat.st_size
+    immutable = path.startswith(OBJECT_DIR + os.sep)
+
+    response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                        direct_passthrough=True)
+    # An object's name is its hash (plus the rendition), a strong validator
+    etag = os.path.basename(path) if immutable else f"{stat.st_mtime_ns:x}-{size:x}"
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    last_modified = response.last_modified   # whole seconds, as the client sees it
+    response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE if immutable else MEDIA_MAX_AGE
+    if immutable:
+        response.cache_control.immutable = True
+
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        metrics.incr('media.not_modified')
+        response.status_code = 304
+        return response
+
+    if ACCEL_REDIRECT:
+        metrics.incr('media.accel')
+        relative = os.path.relpath(path, UPLOAD_ROOT).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{ACCEL_REDIRECT.rstrip('/')}/{quote(relative)}"
+        return response
+
+    start, length = 0, size
+    byte_range = request.range
+    # If-Range: a range is only valid against the copy the client has
+    if (byte_range is not None and len(byte_range.ranges) == 1
+            and ('HTTP_IF_RANGE' not in request.environ
+                 or not is_resource_modified(request.environ, etag, last_modified=last_modified,
+                                             ignore_if_range=False))):
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            metrics.incr('media.unsatisfiable')
+            response.status_code = 416
+            response.content_range = ContentRange('bytes', None, None, size)
+            del response.headers['Cache-Control']
+            return response
+        start, end = bounds
+        length = end - start
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, end, size)
+        metrics.incr('media.partial')
+    else:
+        metrics.incr('media.full')
+
+    response.content_length = length
+    if request.method != 'HEAD':
+        response.response = _body(path, start, length, size)
+        metrics.incr('media.bytes', length)
+    return response
@@ -0,0 +1,77 @@
+import threading
+import time
+
+# Lightweight in-process metrics shared by the database layer, socket
+# handlers and caches. Exposed through /api/metrics.
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_gauges = {}
+
+
+def incr(name, amount=1):
+    """Increment a named counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, seconds):
+    """Record a duration sample (in seconds) for a named timer"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        timing['count'] += 1
+        timing['total'] += seconds
+        if seconds > timing['max']:
+            timing['max'] = seconds
+
+
+class timer:
+    """Context manager that records the elapsed time of its block"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def register_gauge(name, func):
+    """Register a callable whose return value is reported on every snapshot"""
+    with _lock:
+        _gauges[name] = func
+
+
+def snapshot():
+    """Return a JSON-serialisable copy of all metrics"""
+    with _lock:
+        counters = dict(_counters)
+        timings = {}
+        for name, timing in _timings.items():
+            count = timing['count']
+            timings[name] = {
+                'count': count,
+                'avg_ms': round(timing['total'] / count * 1000, 3) if count else 0.0,
+                'max_ms': round(timing['max'] * 1000, 3)
+            }
+        gauges = dict(_gauges)
+
+    return {
+        'counters': counters,
+        'timings': timings,
+        'gauges': {name: func() for name, func in gauges.items()}
+    }
+
+
+def reset():
+    """Clear counters and timings (gauges stay registered)"""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
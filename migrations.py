@@ -0,0 +1,743 @@
+import sys
+import time
+
+from conversations import PREVIEW_LENGTH
+from db import get_db
+from response_cache import CACHED_TABLES
+from storage import dedupe_legacy
+
+# Versioned schema migrations. The applied version is stored in
+# PRAGMA user_version; every entry below runs exactly once, in order, inside
+# its own transaction. All DDL for the application lives here - request
+# handlers must not create tables or indexes.
+
+
+def _baseline(cursor):
+    """Tables that used to be created by init_db() and inside request handlers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            full_name TEXT NOT NULL,
+            department TEXT,
+            location TEXT,
+            phone TEXT,
+            bio TEXT,
+            avatar_url TEXT,
+            is_online BOOLEAN DEFAULT FALSE,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS communities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            avatar_url TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            avatar_url TEXT,
+            community_id INTEGER,
+            created_by INTEGER,
+            expires_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (community_id) REFERENCES communities (id),
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            sender_id INTEGER NOT NULL,
+            chat_type TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            file_url TEXT,
+            file_name TEXT,
+            file_size TEXT,
+            voice_duration INTEGER,
+            is_announcement BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(group_id, user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS community_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            community_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (community_id) REFERENCES communities (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(community_id, user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            call_id TEXT UNIQUE NOT NULL,
+            caller_id INTEGER NOT NULL,
+            target_type TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            call_type TEXT NOT NULL,
+            status TEXT DEFAULT 'initiated',
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ended_at TIMESTAMP,
+            duration INTEGER DEFAULT 0,
+            FOREIGN KEY (caller_id) REFERENCES users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_status (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(message_id, user_id),
+            FOREIGN KEY (message_id) REFERENCES messages(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_blocks (
+            blocker_id INTEGER,
+            blocked_id INTEGER,
+            PRIMARY KEY (blocker_id, blocked_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_reports (
+            reporter_id INTEGER,
+            reported_id INTEGER,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_join_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _hot_path_indexes(cursor):
+    """Secondary indexes for the message, chat list and membership queries"""
+    # Group history and "last message in group" lookups
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_chat
+        ON messages (chat_type, chat_id, id)
+    ''')
+    # Direct-message history: (sender, recipient) pairs walked by id
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_sender_chat
+        ON messages (sender_id, chat_type, chat_id, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_group_members_user
+        ON group_members (user_id, group_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_community_members_user
+        ON community_members (user_id, community_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_groups_community
+        ON groups (community_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_status_user
+        ON message_status (user_id, message_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_feed_created
+        ON feed (created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_join_requests_group
+        ON group_join_requests (group_id, status)
+    ''')
+
+
+def _group_member_admin_flag(cursor):
+    """/api/promote_to_admin and /api/group_members read group_members.is_admin"""
+    _add_column(cursor, 'group_members', 'is_admin', 'BOOLEAN DEFAULT 0')
+
+
+def _conversation_summaries(cursor):
+    """Last message and message count per conversation, see conversations.py"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            chat_type TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER,
+            last_message_preview TEXT,
+            last_message_at TIMESTAMP,
+            last_sender_id INTEGER,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_type, chat_id, peer_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversation_summaries_peer
+        ON conversation_summaries (chat_type, peer_id)
+    ''')
+
+    # Backfill from existing history
+    cursor.execute('''
+        INSERT OR REPLACE INTO conversation_summaries
+            (chat_type, chat_id, peer_id, last_message_id, last_message_preview,
+             last_message_at, last_sender_id, message_count)
+        SELECT 'group', m.chat_id, 0, m.id, substr(m.content, 1, ?), m.created_at,
+               m.sender_id, agg.message_count
+        FROM (
+            SELECT MAX(id) AS last_id, COUNT(*) AS message_count
+            FROM messages
+            WHERE chat_type = 'group'
+            GROUP BY chat_id
+        ) agg
+        JOIN messages m ON m.id = agg.last_id
+    ''', (PREVIEW_LENGTH,))
+    cursor.execute('''
+        INSERT OR REPLACE INTO conversation_summaries
+            (chat_type, chat_id, peer_id, last_message_id, last_message_preview,
+             last_message_at, last_sender_id, message_count)
+        SELECT 'user', agg.low_id, agg.high_id, m.id, substr(m.content, 1, ?), m.created_at,
+               m.sender_id, agg.message_count
+        FROM (
+            SELECT min(sender_id, chat_id) AS low_id, max(sender_id, chat_id) AS high_id,
+                   MAX(id) AS last_id, COUNT(*) AS message_count
+            FROM messages
+            WHERE chat_type = 'user'
+            GROUP BY low_id, high_id
+        ) agg
+        JOIN messages m ON m.id = agg.last_id
+    ''', (PREVIEW_LENGTH,))
+
+
+def _unread_counts(cursor):
+    """Per-user unread counter for each conversation, see conversations.py"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS unread_counts (
+            user_id INTEGER NOT NULL,
+            chat_type TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chat_type, chat_id, peer_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Backfill: everything from someone else that the user has not seen
+    cursor.execute('''
+        INSERT OR REPLACE INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+        SELECT gm.user_id, 'group', m.chat_id, 0, COUNT(*)
+        FROM messages m
+        JOIN group_members gm ON gm.group_id = m.chat_id
+        WHERE m.chat_type = 'group' AND m.sender_id != gm.user_id
+          AND NOT EXISTS (
+              SELECT 1 FROM message_status s
+              WHERE s.message_id = m.id AND s.user_id = gm.user_id AND s.status = 'seen'
+          )
+        GROUP BY gm.user_id, m.chat_id
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO unread_counts (user_id, chat_type, chat_id, peer_id, unread)
+        SELECT m.chat_id, 'user', min(m.sender_id, m.chat_id), max(m.sender_id, m.chat_id), COUNT(*)
+        FROM messages m
+        WHERE m.chat_type = 'user' AND m.sender_id != m.chat_id
+          AND NOT EXISTS (
+              SELECT 1 FROM message_status s
+              WHERE s.message_id = m.id AND s.user_id = m.chat_id AND s.status = 'seen'
+          )
+        GROUP BY m.chat_id, m.sender_id
+    ''')
+
+
+def _read_watermarks(cursor):
+    """Delivered/seen position per user and conversation, replacing message_status"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_watermarks (
+            user_id INTEGER NOT NULL,
+            chat_type TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL DEFAULT 0,
+            delivered_id INTEGER NOT NULL DEFAULT 0,
+            seen_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, chat_type, chat_id, peer_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Backfill from the old one-row-per-message receipts
+    cursor.execute('''
+        INSERT OR REPLACE INTO read_watermarks (user_id, chat_type, chat_id, peer_id, delivered_id, seen_id)
+        SELECT s.user_id, 'group', m.chat_id, 0, MAX(m.id),
+               MAX(CASE WHEN s.status = 'seen' THEN m.id ELSE 0 END)
+        FROM message_status s
+        JOIN messages m ON m.id = s.message_id
+        WHERE m.chat_type = 'group'
+        GROUP BY s.user_id, m.chat_id
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO read_watermarks (user_id, chat_type, chat_id, peer_id, delivered_id, seen_id)
+        SELECT s.user_id, 'user', min(m.sender_id, m.chat_id), max(m.sender_id, m.chat_id), MAX(m.id),
+               MAX(CASE WHEN s.status = 'seen' THEN m.id ELSE 0 END)
+        FROM message_status s
+        JOIN messages m ON m.id = s.message_id
+        WHERE m.chat_type = 'user'
+        GROUP BY s.user_id, min(m.sender_id, m.chat_id), max(m.sender_id, m.chat_id)
+    ''')
+
+
+def _announcements(cursor):
+    """Announcements stored once and linked to the per-group message rows"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS announcements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            community_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (community_id) REFERENCES communities (id),
+            FOREIGN KEY (sender_id) REFERENCES users (id)
+        )
+    ''')
+    _add_column(cursor, 'messages', 'announcement_id', 'INTEGER REFERENCES announcements (id)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_announcement
+        ON messages (announcement_id) WHERE announcement_id IS NOT NULL
+    ''')
+
+
+def _message_search(cursor):
+    """FTS5 index over message text and file names, synced by triggers.
+
+    The hidden conversation column holds g<group id> for group messages and
+    u<sender> u<recipient> for direct ones, so searches are scoped to the
+    caller's conversations inside the index instead of row by row.
+    """
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS messages_search_source AS
+        SELECT id, content, file_name,
+               CASE WHEN chat_type = 'group' THEN 'g' || chat_id
+                    ELSE 'u' || sender_id || ' u' || chat_id END AS conversation
+        FROM messages
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, file_name, conversation,
+            content = 'messages_search_source', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    # Matches in the text count for more than matches in a file name
+    cursor.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.5, 0.0)')")
+    conversation = '''CASE WHEN {row}.chat_type = 'group' THEN 'g' || {row}.chat_id
+                        ELSE 'u' || {row}.sender_id || ' u' || {row}.chat_id END'''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, file_name, conversation)
+            VALUES (new.id, new.content, new.file_name, {conversation.format(row='new')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, file_name, conversation)
+            VALUES ('delete', old.id, old.content, old.file_name, {conversation.format(row='old')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, file_name ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, file_name, conversation)
+            VALUES ('delete', old.id, old.content, old.file_name, {conversation.format(row='old')});
+            INSERT INTO messages_fts (rowid, content, file_name, conversation)
+            VALUES (new.id, new.content, new.file_name, {conversation.format(row='new')});
+        END
+    ''')
+    # Index the existing history; `python search.py --rebuild` does the same
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def _user_search(cursor):
+    """Trigram index for directory search, plus NOCASE indexes for short
+    prefix queries"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, full_name, department,
+            content = 'users', content_rowid = 'id',
+            tokenize = 'trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, full_name, department)
+            VALUES (new.id, new.username, new.full_name, new.department);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, full_name, department)
+            VALUES ('delete', old.id, old.username, old.full_name, old.department);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, full_name, department ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, full_name, department)
+            VALUES ('delete', old.id, old.username, old.full_name, old.department);
+            INSERT INTO users_fts (rowid, username, full_name, department)
+            VALUES (new.id, new.username, new.full_name, new.department);
+        END
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    for column in ('username', 'full_name', 'department'):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_users_{column}_nocase ON users ({column} COLLATE NOCASE)')
+
+
+def _covering_peer_index(cursor):
+    """Let direct-chat lookups by the higher user id stay inside the index"""
+    cursor.execute('DROP INDEX IF EXISTS idx_conversation_summaries_peer')
+    cursor.execute('''
+        CREATE INDEX idx_conversation_summaries_peer
+        ON conversation_summaries (chat_type, peer_id, chat_id)
+    ''')
+
+
+def _shared_state(cursor):
+    """Presence and call state shared by every worker process.
+
+    presence_sessions has a row per user and worker while that worker holds
+    at least one of the user's sockets; rows of workers that stop
+    heartbeating are removed by the others.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            started_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS presence_sessions (
+            user_id INTEGER NOT NULL,
+            worker_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, worker_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_presence_sessions_worker ON presence_sessions (worker_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS call_participants (
+            call_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (call_id, user_id),
+            FOREIGN KEY (call_id) REFERENCES calls (call_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _cache_versions(cursor):
+    """Per-table change counters behind the response cache (response_cache.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            tag TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            changed_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.executemany('INSERT OR IGNORE INTO cache_versions (tag, changed_at) VALUES (?, ?)',
+                       [(table, time.time()) for table in CACHED_TABLES])
+
+
+def _upload_sessions(cursor):
+    """Resumable chunked uploads (uploads.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            upload_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            sha256 TEXT,
+            status TEXT NOT NULL DEFAULT 'open',
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at)')
+
+
+def _attachments(cursor):
+    """Metadata of stored uploads (image renditions and sizes), copied onto
+    the messages that share them"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            url TEXT PRIMARY KEY,
+            uploader_id INTEGER,
+            file_type TEXT NOT NULL,
+            media TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (uploader_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    _add_column(cursor, 'messages', 'media', 'TEXT')
+
+
+def _content_addressed_attachments(cursor):
+    """One attachments row and one file per distinct content (storage.py);
+    existing uploads are hashed and deduplicated"""
+    _add_column(cursor, 'attachments', 'sha256', 'TEXT')
+    _add_column(cursor, 'attachments', 'size', 'INTEGER')
+    _add_column(cursor, 'attachments', 'ref_count', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(cursor, 'attachments', 'last_used_at', 'REAL NOT NULL DEFAULT 0')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (sha256)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_unused ON attachments (last_used_at) WHERE ref_count = 0')
+    dedupe_legacy(cursor)
+    # Rows whose file is gone
+    cursor.execute('DELETE FROM attachments WHERE sha256 IS NULL')
+
+
+def _message_file_index(cursor):
+    """Messages by attachment, for filling in voice note analysis"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_file_url ON messages (file_url) WHERE file_url IS NOT NULL')
+
+
+def _add_column(cursor, table, column, declaration):
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'hot path indexes', _hot_path_indexes),
+    (3, 'group member admin flag', _group_member_admin_flag),
+    (4, 'conversation summaries', _conversation_summaries),
+    (5, 'unread counters', _unread_counts),
+    (6, 'read watermarks', _read_watermarks),
+    (7, 'announcements', _announcements),
+    (8, 'message search index', _message_search),
+    (9, 'user directory search index', _user_search),
+    (10, 'covering conversation peer index', _covering_peer_index),
+    (11, 'shared presence and call state', _shared_state),
+    (12, 'response cache versions', _cache_versions),
+    (13, 'upload sessions', _upload_sessions),
+    (14, 'attachment metadata', _attachments),
+    (15, 'content-addressed attachments', _content_addressed_attachments),
+    (16, 'message attachment index', _message_file_index),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate():
+    """Apply every pending migration; safe to call from several processes"""
+    applied = []
+    with get_db() as conn:
+        for version, description, step in MIGRATIONS:
+            if current_version(conn) >= version:
+                continue
+            # IMMEDIATE takes the write lock up front so concurrent starters
+            # serialise here and re-check the version once they get it
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if current_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                step(conn.cursor())
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+            print(f"Applied migration {version}: {description}")
+    return applied
+
+
+# Hot queries checked by `python migrations.py --explain`. Parameters are
+# placeholders; only the plan matters.
+HOT_QUERIES = {
+    'get_messages (user)': ('''
+        SELECT id FROM (
+            SELECT id FROM messages
+            WHERE sender_id = ? AND chat_type = 'user' AND chat_id = ? AND id < ?
+            ORDER BY id DESC LIMIT ?
+        )
+        UNION
+        SELECT id FROM (
+            SELECT id FROM messages
+            WHERE sender_id = ? AND chat_type = 'user' AND chat_id = ? AND id < ?
+            ORDER BY id DESC LIMIT ?
+        )
+    ''', (1, 2, 1000, 51, 2, 1, 1000, 51)),
+    'get_messages (group)': ('''
+        SELECT id FROM messages
+        WHERE chat_type = 'group' AND chat_id = ? AND id < ?
+        ORDER BY id DESC LIMIT ?
+    ''', (1, 1000, 51)),
+    'get_chats': ('''
+        SELECT u.id, cs.last_message_preview
+        FROM (
+            SELECT peer_id AS other_id, last_message_id, last_message_preview
+            FROM conversation_summaries
+            WHERE chat_type = 'user' AND chat_id = ?
+            UNION ALL
+            SELECT chat_id AS other_id, last_message_id, last_message_preview
+            FROM conversation_summaries
+            WHERE chat_type = 'user' AND peer_id = ?
+        ) cs
+        JOIN users u ON u.id = cs.other_id
+        WHERE u.id != ?
+        ORDER BY cs.last_message_id DESC
+    ''', (1, 1, 1)),
+    'get_groups': ('''
+        SELECT g.id, cs.last_message_preview
+        FROM groups g
+        JOIN group_members gm ON g.id = gm.group_id
+        JOIN communities c ON g.community_id = c.id
+        LEFT JOIN conversation_summaries cs
+            ON cs.chat_type = 'group' AND cs.chat_id = g.id AND cs.peer_id = 0
+        WHERE gm.user_id = ?
+        ORDER BY COALESCE(cs.last_message_at, g.created_at) DESC
+    ''', (1,)),
+    'on_connect (group rooms)': ('''
+        SELECT g.id, g.community_id FROM groups g
+        JOIN group_members gm ON g.id = gm.group_id
+        WHERE gm.user_id = ?
+    ''', (1,)),
+    'announcement unread fanout': ('''
+        SELECT gm.user_id, gm.group_id
+        FROM messages m
+        JOIN group_members gm ON gm.group_id = m.chat_id
+        WHERE m.announcement_id = ? AND gm.user_id != ?
+    ''', (1, 1)),
+    'search_messages': ('''
+        SELECT m.id
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+        ORDER BY messages_fts.rank, m.id DESC
+        LIMIT ?
+    ''', ('{content file_name} : ("hello"*) AND conversation : (u1 OR g1)', 21)),
+    'search_users (trigram)': ('''
+        SELECT u.id FROM users_fts
+        JOIN users u ON u.id = users_fts.rowid
+        WHERE users_fts MATCH ?
+        LIMIT ?
+    ''', ('"smi"', 200)),
+    'search_users (short prefix)': ('''
+        SELECT u.id FROM users u
+        WHERE u.username LIKE :p OR u.full_name LIKE :p OR u.department LIKE :p
+        ORDER BY u.is_online DESC, u.full_name
+        LIMIT 200
+    ''', {'p': 'sm%'}),
+    'presence audience (direct peers)': ('''
+        SELECT peer_id FROM conversation_summaries WHERE chat_type = 'user' AND chat_id = ?
+        UNION
+        SELECT chat_id FROM conversation_summaries WHERE chat_type = 'user' AND peer_id = ?
+    ''', (1, 1)),
+    'presence sync (remote sessions)': ('''
+        SELECT DISTINCT user_id FROM presence_sessions WHERE worker_id != ?
+    ''', ('w1',)),
+    'presence sync (reap workers)': ('''
+        DELETE FROM presence_sessions
+        WHERE worker_id IN (SELECT worker_id FROM workers WHERE heartbeat_at < ?)
+    ''', (0,)),
+    'community tree (groups)': ('''
+        SELECT g.id, counts.members
+        FROM group_members mine
+        JOIN groups g ON g.id = mine.group_id
+        JOIN (
+            SELECT gm.group_id, COUNT(*) AS members
+            FROM group_members gm
+            WHERE gm.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+            GROUP BY gm.group_id
+        ) counts ON counts.group_id = g.id
+        WHERE mine.user_id = ?
+    ''', (1, 1)),
+    'voice note analysis (messages)': ('''
+        UPDATE messages SET media = ?, voice_duration = ?
+        WHERE file_url = ? AND media IS NULL
+        RETURNING id, sender_id, chat_type, chat_id
+    ''', ('{}', 1, '/static/uploads/x.wav')),
+    'read watermarks (group)': ('''
+        SELECT MIN(COALESCE(w.delivered_id, 0)), MIN(COALESCE(w.seen_id, 0))
+        FROM group_members gm
+        LEFT JOIN read_watermarks w
+            ON w.user_id = gm.user_id AND w.chat_type = 'group' AND w.chat_id = gm.group_id AND w.peer_id = 0
+        WHERE gm.group_id = ? AND gm.user_id != ?
+    ''', (1, 1)),
+}
+
+
+def explain():
+    """Print EXPLAIN QUERY PLAN output for every hot query"""
+    with get_db() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            print(f"== {name}")
+            for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+                print(f"   {row[-1]}")
+            print()
+
+
+if __name__ == '__main__':
+    migrate()
+    if '--explain' in sys.argv:
+        explain()
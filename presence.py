@@ -0,0 +1,187 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import metrics
+from db import get_db
+from profiles import invalidate_profile
+
+# Online state is shared by every worker process: each worker keeps a
+# presence_sessions row per user it holds sockets for and reads the rows of
+# the others every TICK, so all workers converge on the same view. A status
+# change is announced only after it has held for DEBOUNCE seconds (so a
+# flapping connection that drops and comes back is never announced) and
+# only to people who share a conversation or group with the user. Several
+# workers see the same change; the one whose UPDATE of users.is_online
+# actually changes the row is the one that announces it.
+DEBOUNCE = float(os.environ.get('DOCKTALK_PRESENCE_DEBOUNCE', 2))
+# Workers that miss heartbeats for WORKER_TIMEOUT seconds are presumed dead
+# and their sessions removed
+WORKER_TIMEOUT = float(os.environ.get('DOCKTALK_WORKER_TIMEOUT', 15))
+HEARTBEAT_INTERVAL = WORKER_TIMEOUT / 3
+TICK = 0.5
+
+
+class Presence:
+    """Registry of who is online, with debounced, scoped user_status fanout"""
+
+    def __init__(self, socketio, fanout, worker_id=None):
+        self.socketio = socketio
+        self.fanout = fanout
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        # user_id -> [online, last_seen (epoch seconds), changed_at (monotonic)]
+        self._state = {}
+        # user_id -> status last sent to other users
+        self._announced = {}
+        # Users with sockets on this worker and on the others, and local
+        # changes not yet written to presence_sessions
+        self._local = set()
+        self._remote = set()
+        self._pending = {}
+        self._worker = None
+        self._last_heartbeat = 0
+
+    def set_online(self, user_id, online):
+        """Record the first connect / last disconnect of user_id on this worker"""
+        with self._lock:
+            if online:
+                self._local.add(user_id)
+            else:
+                self._local.discard(user_id)
+            self._pending[user_id] = online
+            self._change(user_id, online or user_id in self._remote)
+            if self._worker is None:
+                self._worker = self.socketio.start_background_task(self._run)
+        metrics.incr('presence.online' if online else 'presence.offline')
+
+    def _change(self, user_id, online):
+        state = self._state.get(user_id)
+        if state is None or state[0] != online:
+            self._state[user_id] = [online, time.time(), time.monotonic()]
+
+    def is_online(self, user_id, default=False):
+        """Shared state, or default for users no worker has seen"""
+        state = self._state.get(int(user_id))
+        return default if state is None else state[0]
+
+    def lookup(self, user_ids):
+        """{user_id: (online, last_seen)} for users known to this process, with
+        last_seen formatted like CURRENT_TIMESTAMP"""
+        with self._lock:
+            return {user_id: (self._state[user_id][0], _timestamp(self._state[user_id][1]))
+                    for user_id in user_ids if user_id in self._state}
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(TICK)
+            try:
+                self.sync()
+                self._announce()
+            except Exception as e:
+                print(f"Presence update failed: {e}")
+
+    def sync(self):
+        """Write this worker's session changes and read everyone else's"""
+        now = time.time()
+        heartbeat = now - self._last_heartbeat >= HEARTBEAT_INTERVAL
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            local = list(self._local)
+        with get_db() as conn:
+            if pending or heartbeat:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                if heartbeat:
+                    self._heartbeat(cursor, now, local)
+                cursor.executemany('INSERT OR IGNORE INTO presence_sessions (user_id, worker_id) VALUES (?, ?)',
+                                   [(user_id, self.worker_id) for user_id, online in pending.items() if online])
+                cursor.executemany('DELETE FROM presence_sessions WHERE user_id = ? AND worker_id = ?',
+                                   [(user_id, self.worker_id) for user_id, online in pending.items() if not online])
+                conn.commit()
+            remote = {user_id for (user_id,) in conn.execute(
+                'SELECT DISTINCT user_id FROM presence_sessions WHERE worker_id != ?', (self.worker_id,))}
+        with self._lock:
+            self._remote = remote
+            for user_id in remote.union(self._state):
+                self._change(user_id, user_id in self._local or user_id in remote)
+
+    def _heartbeat(self, cursor, now, local):
+        cursor.execute('UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?', (now, self.worker_id))
+        if not cursor.rowcount:
+            # First heartbeat, or the other workers gave up on this one after
+            # a stall: (re)register along with every local session
+            cursor.execute('INSERT INTO workers (worker_id, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?)',
+                           (self.worker_id, os.getpid(), now, now))
+            cursor.executemany('INSERT OR IGNORE INTO presence_sessions (user_id, worker_id) VALUES (?, ?)',
+                               [(user_id, self.worker_id) for user_id in local])
+        expired = now - WORKER_TIMEOUT
+        cursor.execute('''
+            DELETE FROM presence_sessions
+            WHERE worker_id IN (SELECT worker_id FROM workers WHERE heartbeat_at < ?)
+        ''', (expired,))
+        cursor.execute('DELETE FROM workers WHERE heartbeat_at < ?', (expired,))
+        if cursor.rowcount:
+            metrics.incr('presence.workers_reaped', cursor.rowcount)
+        self._last_heartbeat = now
+
+    def _announce(self):
+        settled = time.monotonic() - DEBOUNCE
+        changes = []
+        with self._lock:
+            for user_id, (online, last_seen, changed_at) in self._state.items():
+                if changed_at <= settled and self._announced.get(user_id, False) != online:
+                    self._announced[user_id] = online
+                    changes.append((user_id, online, last_seen))
+        if not changes:
+            return
+        claimed = []
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for user_id, online, last_seen in changes:
+                cursor.execute('UPDATE users SET is_online = ?, last_seen = ? WHERE id = ? AND is_online IS NOT ?',
+                               (int(online), _timestamp(last_seen), user_id, int(online)))
+                if cursor.rowcount:
+                    claimed.append((user_id, online))
+            conn.commit()
+            for user_id, online in claimed:
+                rooms = audience_rooms(cursor, user_id)
+                if rooms:
+                    self.fanout.emit('user_status', {
+                        'user_id': user_id,
+                        'status': 'online' if online else 'offline'
+                    }, room=rooms)
+        for user_id, _, _ in changes:
+            invalidate_profile(user_id)
+        metrics.incr('presence.persisted', len(claimed))
+
+    def retire(self):
+        """Drop this worker's sessions at exit; the remaining workers see the
+        users go offline and announce it"""
+        with get_db() as conn:
+            conn.execute('DELETE FROM presence_sessions WHERE worker_id = ?', (self.worker_id,))
+            conn.execute('DELETE FROM workers WHERE worker_id = ?', (self.worker_id,))
+            conn.commit()
+
+
+def _timestamp(epoch):
+    # Same format as CURRENT_TIMESTAMP
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def audience_rooms(cursor, user_id):
+    """Rooms of everyone who should see user_id's status: the groups they
+    are in and the personal rooms of their direct chat partners"""
+    cursor.execute('SELECT group_id FROM group_members WHERE user_id = ?', (user_id,))
+    rooms = [f"group_{group_id}" for (group_id,) in cursor.fetchall()]
+    cursor.execute('''
+        SELECT peer_id FROM conversation_summaries WHERE chat_type = 'user' AND chat_id = ?
+        UNION
+        SELECT chat_id FROM conversation_summaries WHERE chat_type = 'user' AND peer_id = ?
+    ''', (user_id, user_id))
+    rooms += [f"user_{peer_id}" for (peer_id,) in cursor.fetchall() if peer_id != user_id]
+    return rooms
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from db import get_db
+
+# Profiles are read on every authenticated request and socket event (via
+# Flask-Login's user loader), so recently seen users are kept in memory.
+# Anything that changes a user row must call invalidate_profile().
+PROFILE_CACHE_SIZE = int(os.environ.get('DOCKTALK_PROFILE_CACHE_SIZE', 4096))
+PROFILE_CACHE_TTL = float(os.environ.get('DOCKTALK_PROFILE_CACHE_TTL', 300))
+
+PROFILE_COLUMNS = ('id', 'username', 'email', 'full_name', 'department', 'location', 'phone',
+                   'bio', 'avatar_url', 'is_online', 'last_seen')
+
+
+class ProfileCache:
+    """Bounded LRU of user rows with a time-to-live"""
+
+    def __init__(self, size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is not
+        # written back into the cache
+        self._generation = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._rows.move_to_end(user_id)
+                metrics.incr('profiles.hits')
+                return entry[1]
+            generation = self._generation
+        metrics.incr('profiles.misses')
+
+        with get_db() as conn:
+            row = conn.execute(f'SELECT {", ".join(PROFILE_COLUMNS)} FROM users WHERE id = ?',
+                               (user_id,)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            if generation == self._generation:
+                self._rows[user_id] = (time.monotonic(), row)
+                self._rows.move_to_end(user_id)
+                while len(self._rows) > self.size:
+                    self._rows.popitem(last=False)
+        return row
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._rows.pop(user_id, None)
+        metrics.incr('profiles.invalidations')
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._rows.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._rows), 'max_size': self.size, 'ttl': self.ttl}
+
+
+_cache = ProfileCache()
+metrics.register_gauge('profiles', lambda: _cache.stats())
+
+
+def get_profile(user_id):
+    """User row as a tuple in PROFILE_COLUMNS order, or None"""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    return _cache.get(user_id)
+
+
+def invalidate_profile(user_id):
+    """Forget a cached profile after its row changed"""
+    _cache.invalidate(int(user_id))
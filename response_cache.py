@@ -0,0 +1,143 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+from flask_login import current_user
+
+import metrics
+from db import get_db
+
+# Read-mostly listing endpoints (directory of communities and groups,
+# member lists, user lookup, feed) keep their JSON responses in memory,
+# keyed by endpoint, query parameters and, where the response depends on
+# who asks, the user id. Each response is tagged with the tables it reads.
+#
+# Every write to one of those tables calls touch(cursor, table) inside its
+# transaction, which bumps that table's row in cache_versions. A cached
+# response is served only while the versions it was built against are
+# still current, so a write on any worker process invalidates the copies
+# held by all of them; checking costs one small read per request instead
+# of the listing query.
+RESPONSE_CACHE_BYTES = int(os.environ.get('DOCKTALK_RESPONSE_CACHE_BYTES', 16 * 1024 * 1024))
+
+# Tables responses can be tagged with; each needs a cache_versions row,
+# seeded by a migration
+CACHED_TABLES = ('communities', 'community_members', 'groups', 'group_members', 'users', 'feed')
+
+# Statuses worth keeping; anything else is recomputed every time
+CACHED_STATUSES = (200, 404)
+
+
+def touch(cursor, *tables):
+    """Invalidate responses built from tables; call before the commit of
+    the transaction that wrote them"""
+    cursor.execute(f'''
+        UPDATE cache_versions SET version = version + 1, changed_at = ?
+        WHERE tag IN ({", ".join("?" * len(tables))})
+    ''', (time.time(),) + tables)
+
+
+def _versions():
+    """{table: (version, changed_at)}"""
+    with get_db() as conn:
+        return {row[0]: (row[1], row[2]) for row in conn.execute('SELECT tag, version, changed_at FROM cache_versions')}
+
+
+class ResponseCache:
+    """LRU of response bodies bounded by their total size"""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # endpoint -> [hits, misses]
+        self._counts = {}
+
+    def get(self, key, versions):
+        """(status, body, etag) if key is cached against versions"""
+        with self._lock:
+            entry = self._entries.get(key)
+            counts = self._counts.setdefault(key[0], [0, 0])
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                counts[0] += 1
+                return entry[1:]
+            counts[1] += 1
+            return None
+
+    def put(self, key, versions, status, body, etag):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[2])
+            if len(body) > self.max_bytes:
+                return
+            self._entries[key] = (versions, status, body, etag)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[2])
+                metrics.incr('response_cache.evictions')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'endpoints': {
+                    endpoint: {'hits': hits, 'misses': misses,
+                               'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None}
+                    for endpoint, (hits, misses) in self._counts.items()
+                }
+            }
+
+
+_cache = ResponseCache()
+metrics.register_gauge('response_cache', lambda: _cache.stats())
+
+
+def cached_response(tables, params=(), per_user=False):
+    """Cache a JSON view's response until one of tables is touched.
+
+    params are the query arguments that select the response; per_user
+    keeps a separate copy for every user. Responses carry an ETag and a
+    Last-Modified of the latest change to tables, so clients can
+    revalidate with a conditional GET.
+    """
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.endpoint, tuple(request.args.get(name) for name in params),
+                   current_user.id if per_user else None)
+            all_versions = _versions()
+            versions = tuple(all_versions[table][0] for table in tables)
+            entry = _cache.get(key, versions)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                status, body = response.status_code, response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                if status in CACHED_STATUSES:
+                    _cache.put(key, versions, status, body, etag)
+            else:
+                status, body, etag = entry
+            response = Response(body, status=status, mimetype='application/json')
+            # Always revalidate; the validators make that cheap
+            response.headers['Cache-Control'] = 'private, no-cache'
+            if status != 200:
+                return response
+            response.set_etag(etag)
+            response.last_modified = max(all_versions[table][1] for table in tables)
+            return response.make_conditional(request)
+        return wrapper
+    return decorate
@@ -0,0 +1,281 @@
+import html
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from db import get_db
+
+# Full-text search over message history. messages_fts is an external
+# content FTS5 index on messages (content and file_name) kept in sync by
+# triggers, so every write path - the batched writer, announcements, the
+# sample data - is covered without extra calls. See migrations for the
+# conversation column used to scope searches.
+
+SNIPPET_TOKENS = 12
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# snippet() marks matches with control characters, which are swapped for
+# <mark> only after the message text around them has been HTML-escaped
+_OPEN, _CLOSE = '\x02', '\x03'
+
+
+def match_expression(query):
+    """Turn free text into a safe FTS5 query.
+
+    Every word must appear (in either column) and the last one is treated
+    as a prefix so results show up while the user is still typing. FTS5
+    operators in the input are ignored rather than raising syntax errors.
+    """
+    tokens = _TOKEN.findall(query or '')
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def conversation_filter(cursor, user_id, chat_type=None, chat_id=None):
+    """FTS5 expression on the conversation column limiting a search to what
+    user_id can read, or None when they cannot read the requested chat"""
+    user_id = int(user_id)
+    if chat_type == 'user' and chat_id is not None:
+        return f'(u{user_id} AND u{int(chat_id)})'
+    if chat_type == 'group' and chat_id is not None:
+        cursor.execute('SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?', (chat_id, user_id))
+        return f'g{int(chat_id)}' if cursor.fetchone() else None
+    cursor.execute('SELECT group_id FROM group_members WHERE user_id = ?', (user_id,))
+    tokens = [f'u{user_id}'] + [f'g{group_id}' for (group_id,) in cursor.fetchall()]
+    return '(' + ' OR '.join(tokens) + ')'
+
+
+def search_messages(cursor, user_id, query, chat_type=None, chat_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Best matching messages from conversations user_id belongs to.
+
+    Returns up to limit + 1 rows so callers can tell whether another page
+    exists. Each row is (id, chat_type, chat_id, sender_id, sender_name,
+    created_at, message_type, file_name, content_snippet, file_snippet);
+    snippets are escaped HTML with matches in <mark>.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    scope = conversation_filter(cursor, user_id, chat_type, chat_id)
+    if scope is None:
+        return []
+
+    cursor.execute('''
+        SELECT m.id, m.chat_type, m.chat_id, m.sender_id, u.full_name, m.created_at,
+               m.message_type, m.file_name,
+               snippet(messages_fts, 0, ?, ?, '…', ?),
+               snippet(messages_fts, 1, ?, ?, '…', ?)
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN users u ON u.id = m.sender_id
+        WHERE messages_fts MATCH ?
+        ORDER BY messages_fts.rank, m.id DESC
+        LIMIT ? OFFSET ?
+    ''', (_OPEN, _CLOSE, SNIPPET_TOKENS, _OPEN, _CLOSE, SNIPPET_TOKENS,
+          f'{{content file_name}} : ({expression}) AND conversation : {scope}',
+          limit + 1, offset))
+    return [row[:8] + (_highlight(row[8]), _highlight(row[9])) for row in cursor.fetchall()]
+
+
+def _highlight(snippet):
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+# User directory search. users_fts is a trigram index over username,
+# full_name and department (see migrations), so any substring of three or
+# more characters is an index lookup. Shorter queries fall back to prefix
+# matches on the NOCASE indexes.
+
+USER_SEARCH_LIMIT = 20
+USER_CANDIDATE_LIMIT = 200
+USER_CACHE_SIZE = 256
+USER_CACHE_TTL = 60
+USER_COLUMNS = 'u.id, u.username, u.full_name, u.department, u.location, u.avatar_url, u.is_online'
+
+# Relevance tiers, best first
+EXACT, PREFIX, WORD_PREFIX, INFIX = range(4)
+
+
+def _normalise(query):
+    return ' '.join((query or '').lower().split())
+
+
+def _fields(row):
+    return [(field or '').lower() for field in row[1:4]]
+
+
+def _matches(row, words, prefix_mode):
+    fields = _fields(row)
+    for i, word in enumerate(words):
+        if prefix_mode and i == 0:
+            if not any(field.startswith(word) for field in fields):
+                return False
+        elif not any(word in field for field in fields):
+            return False
+    return True
+
+
+def _score(row, query, words):
+    username, full_name, department = _fields(row)
+    if query in (username, full_name, department):
+        return EXACT
+    if username.startswith(query) or full_name.startswith(query):
+        return PREFIX
+    field_words = f'{username} {full_name} {department}'.split()
+    if all(any(fw.startswith(word) for fw in field_words) for word in words):
+        return WORD_PREFIX
+    return INFIX
+
+
+class UserSearchCache:
+    """LRU of recent directory queries and their candidate rows.
+
+    A query that extends a cached one ("smi" -> "smit") is answered by
+    filtering the cached candidates when that list was complete, so typing
+    into the search box only hits the database for the first keystrokes.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query, prefix_mode):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(query)
+                metrics.incr('user_search.cache_hits')
+                return entry[1]
+            if not prefix_mode:
+                # Longest cached prefix whose candidate list was complete
+                for end in range(len(query) - 1, 2, -1):
+                    entry = self._entries.get(query[:end])
+                    if entry and now - entry[0] < self.ttl and entry[2] and not entry[3]:
+                        metrics.incr('user_search.cache_prefix_hits')
+                        return entry[1]
+        metrics.incr('user_search.cache_misses')
+        return None
+
+    def put(self, query, rows, complete, prefix_mode):
+        with self._lock:
+            self._entries[query] = (time.monotonic(), rows, complete, prefix_mode)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_search_cache = UserSearchCache()
+
+
+def invalidate_user_search():
+    """Drop cached directory results after a user is added or edited"""
+    user_search_cache.clear()
+
+
+def _prefix_candidates(cursor, prefix):
+    # Wildcards are dropped rather than escaped; LIKE ... ESCAPE cannot use
+    # the NOCASE indexes
+    prefix = prefix.replace('%', '').replace('_', '')
+    if not prefix:
+        return []
+    cursor.execute(f'''
+        SELECT {USER_COLUMNS} FROM users u
+        WHERE u.username LIKE :p OR u.full_name LIKE :p OR u.department LIKE :p
+        ORDER BY u.is_online DESC, u.full_name
+        LIMIT :limit
+    ''', {'p': prefix + '%', 'limit': USER_CANDIDATE_LIMIT})
+    return cursor.fetchall()
+
+
+def _user_candidates(cursor, query, words, prefix_mode):
+    """Rows that may match query, and whether that list is complete"""
+    if prefix_mode:
+        rows = _prefix_candidates(cursor, words[0])
+        complete = len(rows) < USER_CANDIDATE_LIMIT
+    else:
+        # Trigrams need three characters; shorter words are checked afterwards
+        expression = ' AND '.join('"' + word.replace('"', '""') + '"' for word in words if len(word) >= 3)
+        cursor.execute(f'''
+            SELECT {USER_COLUMNS} FROM users_fts
+            JOIN users u ON u.id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            LIMIT ?
+        ''', (expression, USER_CANDIDATE_LIMIT))
+        rows = cursor.fetchall()
+        complete = len(rows) < USER_CANDIDATE_LIMIT
+        if not complete:
+            # Too many substring hits to rank them all; make sure the exact
+            # and prefix matches are among the candidates
+            seen = {row[0] for row in rows}
+            rows += [row for row in _prefix_candidates(cursor, query) if row[0] not in seen]
+    return [row for row in rows if _matches(row, words, prefix_mode)], complete
+
+
+def search_users(cursor, query, exclude_id=None, is_online=None, limit=USER_SEARCH_LIMIT):
+    """Directory search ranked exact > prefix > word prefix > infix.
+
+    Ties go to users who are online (is_online(user_id, stored_flag), or the
+    stored flag when no callable is given), then by name. Rows are (id, username,
+    full_name, department, location, avatar_url, is_online).
+    """
+    query = _normalise(query)
+    words = query.split()
+    if not words:
+        return []
+    prefix_mode = all(len(word) < 3 for word in words)
+
+    candidates = user_search_cache.get(query, prefix_mode)
+    if candidates is None:
+        candidates, complete = _user_candidates(cursor, query, words, prefix_mode)
+        user_search_cache.put(query, candidates, complete, prefix_mode)
+    else:
+        candidates = [row for row in candidates if _matches(row, words, prefix_mode)]
+
+    results = []
+    for row in candidates:
+        if row[0] == exclude_id:
+            continue
+        online = is_online(row[0], bool(row[6])) if is_online else bool(row[6])
+        results.append((_score(row, query, words), not online, (row[2] or '').lower(), row[:6] + (online,)))
+    results.sort(key=lambda result: result[:3])
+    return [result[3] for result in results[:limit]]
+
+
+def rebuild():
+    """Re-index every message and user, e.g. after restoring a backup"""
+    with get_db() as conn:
+        for index in ('messages_fts', 'users_fts'):
+            conn.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+            conn.execute(f"INSERT INTO {index} ({index}) VALUES ('optimize')")
+        conn.commit()
+        messages = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    invalidate_user_search()
+    print(f"Rebuilt search indexes ({messages} messages, {users} users)")
+
+
+if __name__ == '__main__':
+    from migrations import migrate
+    migrate()
+    if '--rebuild' in sys.argv:
+        rebuild()
+    else:
+        print('usage: python search.py --rebuild')
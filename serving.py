@@ -0,0 +1,40 @@
+import os
+
+# How the Socket.IO server handles concurrency, chosen with
+# DOCKTALK_ASYNC_MODE:
+#   threading - an OS thread per connection; Werkzeug (`python run.py`) or
+#               gunicorn's gthread worker. Needs no extra packages.
+#   eventlet  - green threads; `pip install eventlet`
+#   gevent    - green threads; `pip install gevent`. Leave gevent-websocket
+#               uninstalled: without it websockets go through
+#               simple-websocket, which negotiates permessage-deflate.
+# Both green modes hold far more idle sockets per process than threading.
+# SQLite calls still block the process while they run in every mode.
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+ASYNC_MODE = os.environ.get('DOCKTALK_ASYNC_MODE', 'threading')
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"DOCKTALK_ASYNC_MODE must be one of {', '.join(ASYNC_MODES)}, not {ASYNC_MODE!r}")
+
+# Long-polling responses larger than this many bytes are gzip compressed;
+# websocket frames use permessage-deflate when the browser offers it
+COMPRESSION_THRESHOLD = int(os.environ.get('DOCKTALK_COMPRESSION_THRESHOLD', 1024))
+
+
+def patch():
+    """Monkey patch the standard library for the green modes. Must run
+    before anything else is imported (see run.py and wsgi.py)."""
+    if ASYNC_MODE == 'eventlet':
+        os.environ.setdefault('EVENTLET_NO_GREENDNS', 'yes')   # avoid dnspython headaches
+        import eventlet
+        eventlet.monkey_patch()
+    elif ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def run_options():
+    """Extra socketio.run() arguments for the current mode"""
+    if ASYNC_MODE == 'threading':
+        # The Werkzeug server; use gunicorn (wsgi.py) in production
+        return {'allow_unsafe_werkzeug': True}
+    return {}
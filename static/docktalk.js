@@ -6,6 +6,12 @@ class DockTalkApp {
     this.currentGroup = null
     this.currentCommunity = null
     this.messages = []
+    this.messagesCursor = null
+    this.hasMoreMessages = false
+    this.loadingOlderMessages = false
+    this.readWatermarks = {}
+    this.pendingDelivered = {}
+    this.deliveredTimer = null
     this.isRecording = false
     this.recordingTime = 0
     this.recordingInterval = null
@@ -33,6 +39,10 @@ class DockTalkApp {
     this.audioElements = {}
     this.typingTimer = null
     this.isTyping = false
+    this.typingSentAt = 0
+    // "chat_type:chat_id" -> {source: {users, count, expiresAt}}
+    this.typingSnapshots = {}
+    this.typingExpiryTimer = null
     this.currentModal = null
 
     // WebRTC configuration
@@ -53,6 +63,7 @@ class DockTalkApp {
   initializeSocketListeners() {
     this.socket.on("connect", () => {
       console.log("Connected to server")
+      this.refreshPresence()
     })
 
     this.socket.on("disconnect", () => {
@@ -63,16 +74,16 @@ class DockTalkApp {
       this.handleNewMessage(data)
     })
 
-    this.socket.on("user_status", (data) => {
-      this.updateUserStatus(data.user_id, data.status)
+    this.socket.on("new_announcement", (data) => {
+      this.handleAnnouncement(data)
     })
 
-    this.socket.on("user_typing", (data) => {
-      this.showTypingIndicator(data)
+    this.socket.on("user_status", (data) => {
+      this.updateUserStatus(data.user_id, data.status)
     })
 
-    this.socket.on("user_stop_typing", (data) => {
-      this.hideTypingIndicator(data)
+    this.socket.on("typing_snapshot", (data) => {
+      this.handleTypingSnapshot(data)
     })
 
     // WebRTC call event listeners
@@ -109,14 +120,21 @@ class DockTalkApp {
       this.endCall()
     })
 
+    this.socket.on("message_error", (data) => {
+      this.showNotification(data.message, "error")
+    })
+
     this.socket.on("message_status_update", (data) => {
-      const { message_id, status } = data;
-      const msgElement = document.querySelector(`[data-message-id="${message_id}"]`);
-      if (msgElement) {
-        const statusSpan = msgElement.querySelector(".message-status");
-        if (statusSpan) statusSpan.innerHTML = getStatusIcon(status);
-      }
-    });
+      this.applyStatusUpdate(data)
+    })
+
+    this.socket.on("message_media", (data) => {
+      this.applyMessageMedia(data)
+    })
+
+    this.socket.on("unread_update", (data) => {
+      this.applyUnreadUpdate(data)
+    })
 
   }
 
@@ -163,6 +181,13 @@ class DockTalkApp {
       this.style.height = Math.min(this.scrollHeight, 120) + "px"
     })
 
+    // Load older history when scrolled to the top
+    document.getElementById("messagesArea").addEventListener("scroll", (e) => {
+      if (e.target.scrollTop < 100 && this.hasMoreMessages && !this.loadingOlderMessages) {
+        this.loadOlderMessages()
+      }
+    })
+
     // Buttons
     document.getElementById("sendBtn").addEventListener("click", () => this.sendMessage())
     document.getElementById("voiceBtn").addEventListener("click", () => this.toggleVoiceRecording())
@@ -199,17 +224,18 @@ class DockTalkApp {
 
   async loadChatData() {
     try {
-      // Load individual chats
-      const chatsResponse = await fetch("/api/chats")
-      this.chats = await chatsResponse.json()
-
-      // Load groups
-      const groupsResponse = await fetch("/api/groups")
-      this.groups = await groupsResponse.json()
-
-      // Load communities
-      const communitiesResponse = await fetch("/api/communities")
-      this.communities = await communitiesResponse.json()
+      // Chats, groups, communities and presence in one request; the
+      // browser revalidates it with If-None-Match on reload
+      const response = await fetch("/api/bootstrap")
+      const data = await response.json()
+      this.chats = data.chats
+      this.groups = data.groups
+      this.communities = data.communities
+
+      Object.entries(data.presence).forEach(([userId, state]) => {
+        const chat = this.chats.find((c) => c.id == userId)
+        if (chat) chat.isOnline = state.online
+      })
 
       this.expandedCommunities = this.communities.map((c) => c.id)
     } catch (error) {
@@ -909,39 +935,130 @@ class DockTalkApp {
         sender: data.sender.id == window.currentUser.id ? "You" : data.sender.name,
         timestamp: new Date(data.timestamp),
         isAnnouncement: data.is_announcement,
+        status: "sent",
         fileData: data.file_data,
+        media: data.media,
       }
 
       this.messages.push(message)
       this.renderMessages()
       this.scrollToBottom()
     }
+  } else if (data.sender.id != window.currentUser.id) {
+    this.queueDeliveryReceipt(data.chat_type, this.chatIdFor(data), data.id)
   }
 
-  // Update chat list
-  this.loadChatData().then(() => {
+  // Update the chat list in place; only fetch it when the conversation is new to us
+  const entries = this.findChatListEntries(data.chat_type, this.chatIdFor(data))
+  if (entries.length) {
+    entries.forEach((entry) => {
+      entry.lastMessage = data.content
+      entry.timestamp = data.timestamp
+    })
     this.renderChatList()
-  })
+  } else {
+    this.loadChatData().then(() => {
+      this.renderChatList()
+    })
+  }
 }
 
+  // An announcement arrives once per community with the message id it was
+  // given in each group; only the groups we belong to are of interest
+  handleAnnouncement(data) {
+    const memberOf = new Set((this.groups || []).map((group) => String(group.id)))
+    data.groups.forEach(([groupId, messageId]) => {
+      const isOpen = this.currentGroup && this.currentGroup.id == groupId
+      if (!isOpen && !memberOf.has(String(groupId))) return
+      const message = { ...data, id: messageId, chat_type: "group", chat_id: groupId }
+      delete message.groups
+      this.handleNewMessage(message)
+      this.applyUnreadUpdate({ chat_type: "group", chat_id: groupId, sender_id: data.sender.id, delta: 1 })
+    })
+  }
+
+  // Direct chats are listed under the other participant's id
+  chatIdFor(data) {
+    if (data.chat_type !== "user") return data.chat_id
+    return data.sender.id == window.currentUser.id ? data.chat_id : data.sender.id
+  }
 
-  updateUserStatus(userId, status) {
-    // Update online status in UI
-    const indicators = document.querySelectorAll(`[data-user-id="${userId}"] .online-indicator`)
-    indicators.forEach((indicator) => {
-      if (status === "online") {
-        indicator.classList.remove("hidden")
+  findChatListEntries(chatType, chatId) {
+    if (chatType === "user") {
+      return (this.chats || []).filter((chat) => chat.id == chatId)
+    }
+    const communityGroups = (this.communities || []).flatMap((c) => c.groups || [])
+    return (this.groups || []).concat(communityGroups).filter((group) => group.id == chatId)
+  }
+
+  clearUnread(chatType, chatId) {
+    const entries = this.findChatListEntries(chatType, chatId)
+    if (entries.some((entry) => entry.unread > 0)) {
+      entries.forEach((entry) => (entry.unread = 0))
+      this.renderChatList()
+    }
+  }
+
+  applyUnreadUpdate(data) {
+    if (data.user_id && data.user_id != window.currentUser.id) return
+    if (data.sender_id && data.sender_id == window.currentUser.id) return
+
+    const entity = this.currentChat || this.currentGroup
+    const isOpen =
+      entity &&
+      entity.id == data.chat_id &&
+      (data.chat_type === "user" ? !!this.currentChat : !!this.currentGroup)
+
+    this.findChatListEntries(data.chat_type, data.chat_id).forEach((entry) => {
+      if (isOpen) {
+        entry.unread = 0
+      } else if (data.unread !== undefined) {
+        entry.unread = data.unread
       } else {
-        indicator.classList.add("hidden")
+        entry.unread = (entry.unread || 0) + data.delta
       }
     })
+    this.renderChatList()
+  }
+
+
+  updateUserStatus(userId, status) {
+    const isOnline = status === "online"
+    const entries = (this.chats || []).filter((chat) => chat.id == userId && chat.isOnline !== isOnline)
+    if (!entries.length) return
+    entries.forEach((chat) => (chat.isOnline = isOnline))
+    this.renderChatList()
+
+    if (this.currentChat && this.currentChat.id == userId) {
+      this.currentChat.isOnline = isOnline
+      this.updateChatHeader()
+    }
+  }
+
+  // Status pushes only cover changes while connected, so fetch the current
+  // state of everyone in the chat list after (re)connecting or reloading it
+  async refreshPresence() {
+    const ids = (this.chats || []).map((chat) => chat.id)
+    if (!ids.length) return
+    try {
+      const response = await fetch(`/api/presence?ids=${ids.join(",")}`)
+      const presence = await response.json()
+      Object.entries(presence).forEach(([userId, state]) => {
+        this.updateUserStatus(userId, state.online ? "online" : "offline")
+      })
+    } catch (error) {
+      console.error("Error loading presence:", error)
+    }
   }
 
   handleTyping() {
     if (!this.currentChat && !this.currentGroup) return
 
-    if (!this.isTyping) {
+    // The server forgets typists after a few seconds, so long bursts are
+    // refreshed every two seconds
+    if (!this.isTyping || Date.now() - this.typingSentAt > 2000) {
       this.isTyping = true
+      this.typingSentAt = Date.now()
       this.socket.emit("typing_start", {
         chat_type: this.currentChat ? "user" : "group",
         chat_id: this.currentChat ? this.currentChat.id : this.currentGroup.id,
@@ -958,20 +1075,76 @@ class DockTalkApp {
     }, 1000)
   }
 
-  showTypingIndicator(data) {
-    if (data.user.id === window.currentUser.id) return
+  // Each server worker sends its own snapshot of who is typing in a
+  // conversation; the indicator shows the union of the fresh ones.
+  handleTypingSnapshot(data) {
+    const key = `${data.chat_type}:${data.chat_id}`
+    const sources = this.typingSnapshots[key] || (this.typingSnapshots[key] = {})
+    if (data.count > 0) {
+      sources[data.source] = {
+        users: data.users,
+        count: data.count,
+        expiresAt: Date.now() + data.ttl * 1000,
+      }
+    } else {
+      delete sources[data.source]
+    }
+    this.renderTypingIndicator()
+  }
+
+  currentTypists() {
+    let key
+    if (this.currentGroup) {
+      key = `group:${this.currentGroup.id}`
+    } else if (this.currentChat) {
+      // Direct chat typing arrives keyed by our own id
+      key = `user:${window.currentUser.id}`
+    } else {
+      return { names: [], count: 0 }
+    }
 
+    const now = Date.now()
+    const names = []
+    let count = 0
+    Object.entries(this.typingSnapshots[key] || {}).forEach(([source, snapshot]) => {
+      if (snapshot.expiresAt <= now) {
+        delete this.typingSnapshots[key][source]
+        return
+      }
+      let users = snapshot.users.filter((user) => user.id !== window.currentUser.id)
+      if (this.currentChat) {
+        users = users.filter((user) => user.id == this.currentChat.id)
+        count += users.length
+      } else {
+        count += snapshot.count - (snapshot.users.length - users.length)
+      }
+      users.forEach((user) => names.push(user.name))
+    })
+    return { names, count }
+  }
+
+  renderTypingIndicator() {
     const indicator = document.getElementById("typingIndicator")
     const text = document.getElementById("typingText")
-    text.textContent = ``
-    indicator.classList.remove("hidden")
-  }
+    if (!indicator || !text) return
 
-  hideTypingIndicator(data) {
-    if (data.user.id === window.currentUser.id) return
+    const { names, count } = this.currentTypists()
+    clearTimeout(this.typingExpiryTimer)
+    if (count <= 0) {
+      indicator.classList.add("hidden")
+      return
+    }
 
-    const indicator = document.getElementById("typingIndicator")
-    indicator.classList.add("hidden")
+    if (this.currentChat || count === 1) {
+      text.textContent = `${names[0] || "Someone"} is typing...`
+    } else if (count === 2 && names.length === 2) {
+      text.textContent = `${names[0]} and ${names[1]} are typing...`
+    } else {
+      text.textContent = `${names[0] || "Someone"} and ${count - 1} others are typing...`
+    }
+    indicator.classList.remove("hidden")
+    // Re-check once snapshots may have expired (e.g. a worker went away)
+    this.typingExpiryTimer = setTimeout(() => this.renderTypingIndicator(), 1000)
   }
 
   checkMobile() {
@@ -1266,6 +1439,7 @@ class DockTalkApp {
     this.currentChat = this.chats.find((chat) => chat.id == chatId)
     this.currentGroup = null
     this.currentCommunity = null
+    this.clearUnread("user", chatId)
 
     // Join chat room
     this.socket.emit("join_chat", {
@@ -1275,19 +1449,10 @@ class DockTalkApp {
 
     this.loadMessages()
     this.showChatInterface()
+    this.renderTypingIndicator()
     if (this.isMobile) {
       this.hideMobileSidebar()
     }
-
-    const seenMessages = document.querySelectorAll(".message[data-message-id]");
-    seenMessages.forEach(msg => {
-      const id = msg.dataset.messageId;
-      this.socket.emit("message_seen", {
-        message_id: id,
-        user_id: window.currentUser.id
-      });
-    });
-
   }
 
 
@@ -1319,6 +1484,7 @@ class DockTalkApp {
     this.currentCommunity = this.communities.find((c) => c.id == communityId)
     this.currentGroup = this.currentCommunity?.groups.find((g) => g.id == groupId)
     this.currentChat = null
+    this.clearUnread("group", groupId)
 
     // Join group room
     this.socket.emit("join_chat", {
@@ -1328,6 +1494,7 @@ class DockTalkApp {
 
     this.loadMessages()
     this.showChatInterface()
+    this.renderTypingIndicator()
     if (this.isMobile) {
       this.hideMobileSidebar()
     }
@@ -1358,32 +1525,76 @@ class DockTalkApp {
       const chatType = this.currentChat ? "user" : "group"
       const chatId = entity.id
 
+      // Newest page first; older pages are fetched on scroll-up
       const response = await fetch(`/api/messages?chat_type=${chatType}&chat_id=${chatId}`)
-      const messagesData = await response.json()
-
-      this.messages = messagesData.map((msg) => ({
-        id: msg.id,
-        type: msg.message_type,
-        content: msg.content,
-        sender: msg.sender_id == window.currentUser.id ? "You" : msg.sender_name,
-        timestamp: new Date(msg.created_at),
-        isAnnouncement: msg.is_announcement,
-        fileData: {
-          url: msg.file_url,
-          name: msg.file_name,
-          size: msg.file_size,
-          duration: msg.voice_duration,
-        },
-      }))
+      const page = await response.json()
+
+      this.messages = page.messages.map((msg) => this.formatMessage(msg))
+      this.messagesCursor = page.next_cursor
+      this.hasMoreMessages = page.has_more
 
       this.renderMessages()
     } catch (error) {
       console.error("Error loading messages:", error)
       this.messages = []
+      this.messagesCursor = null
+      this.hasMoreMessages = false
       this.renderMessages()
     }
   }
 
+  async loadOlderMessages() {
+    const entity = this.currentChat || this.currentGroup
+    if (!entity || !this.messagesCursor) return
+
+    this.loadingOlderMessages = true
+    try {
+      const chatType = this.currentChat ? "user" : "group"
+      const response = await fetch(
+        `/api/messages?chat_type=${chatType}&chat_id=${entity.id}&before_id=${this.messagesCursor}`,
+      )
+      const page = await response.json()
+
+      // Ignore the page if the user switched chats while it was loading
+      if (entity !== (this.currentChat || this.currentGroup)) return
+
+      const messagesArea = document.getElementById("messagesArea")
+      const previousHeight = messagesArea.scrollHeight
+      const previousTop = messagesArea.scrollTop
+
+      this.messages = page.messages.map((msg) => this.formatMessage(msg)).concat(this.messages)
+      this.messagesCursor = page.next_cursor
+      this.hasMoreMessages = page.has_more
+      this.renderMessages()
+
+      // Keep the message the user was looking at in place
+      messagesArea.scrollTop = messagesArea.scrollHeight - previousHeight + previousTop
+    } catch (error) {
+      console.error("Error loading older messages:", error)
+    } finally {
+      this.loadingOlderMessages = false
+    }
+  }
+
+  formatMessage(msg) {
+    return {
+      id: msg.id,
+      type: msg.message_type,
+      content: msg.content,
+      sender: msg.sender_id == window.currentUser.id ? "You" : msg.sender_name,
+      timestamp: new Date(msg.created_at),
+      isAnnouncement: msg.is_announcement,
+      status: msg.status,
+      fileData: {
+        url: msg.file_url,
+        name: msg.file_name,
+        size: msg.file_size,
+        duration: msg.voice_duration,
+      },
+      media: msg.media,
+    }
+  }
+
   showWelcomeScreen() {
     document.getElementById("welcomeScreen").classList.remove("hidden")
     document.getElementById("chatInterface").classList.add("hidden")
@@ -1442,32 +1653,76 @@ class DockTalkApp {
 
   renderMessages() {
   const messagesList = document.getElementById("messagesList")
-  messagesList.innerHTML = this.messages
-    .map((message) => {
-      // Emit delivered if it's not from the current user
-      if (message.sender_id !== window.currentUser.id) {
-        this.socket.emit("message_delivered", {
-          message_id: message.id,
-          user_id: window.currentUser.id
-        })
-      }
+  messagesList.innerHTML = this.messages.map((message) => this.renderMessage(message)).join("")
+
+  this.scrollToBottom()
 
-      return this.renderMessage(message)
+  // One receipt for everything on screen
+  this.sendReadReceipt()
+}
+
+  sendReadReceipt() {
+    const entity = this.currentChat || this.currentGroup
+    if (!entity || !this.messages.length) return
+
+    const chatType = this.currentChat ? "user" : "group"
+    const key = `${chatType}_${entity.id}`
+    const upTo = Math.max(...this.messages.map((m) => m.id || 0))
+    if (upTo <= (this.readWatermarks[key] || 0)) return
+
+    this.readWatermarks[key] = upTo
+    delete this.pendingDelivered[key]
+    this.socket.emit("read_receipt", {
+      chat_type: chatType,
+      chat_id: entity.id,
+      seen_up_to: upTo,
     })
-    .join("")
+  }
 
-  this.scrollToBottom()
+  // Messages for conversations that are not open are acknowledged as
+  // delivered in one batch per conversation
+  queueDeliveryReceipt(chatType, chatId, messageId) {
+    const key = `${chatType}_${chatId}`
+    const pending = this.pendingDelivered[key]
+    if (!pending || pending.delivered_up_to < messageId) {
+      this.pendingDelivered[key] = { chat_type: chatType, chat_id: chatId, delivered_up_to: messageId }
+    }
+    if (this.deliveredTimer) return
 
-  // Emit seen after rendering all
-  const seenMessages = document.querySelectorAll(".message[data-message-id]")
-  seenMessages.forEach((msg) => {
-    const id = msg.dataset.messageId
-    this.socket.emit("message_seen", {
-      message_id: id,
-      user_id: window.currentUser.id
+    this.deliveredTimer = setTimeout(() => {
+      Object.values(this.pendingDelivered).forEach((receipt) => this.socket.emit("read_receipt", receipt))
+      this.pendingDelivered = {}
+      this.deliveredTimer = null
+    }, 1000)
+  }
+
+  applyStatusUpdate(data) {
+    if (data.user_id && data.user_id != window.currentUser.id) return
+
+    const entity = data.chat_type === "user" ? this.currentChat : this.currentGroup
+    if (!entity || entity.id != data.chat_id) return
+
+    const rank = { sent: 0, delivered: 1, seen: 2 }
+    this.messages.forEach((message) => {
+      if (message.sender !== "You" || message.id > data.up_to) return
+      if (rank[data.status] <= rank[message.status || "sent"]) return
+
+      message.status = data.status
+      const statusSpan = document.querySelector(`.message[data-message-id="${message.id}"] .message-status`)
+      if (statusSpan) statusSpan.innerHTML = this.getStatusIcon(data.status)
     })
-  })
-}
+  }
+
+  // A voice note's duration and waveform, when the server finished
+  // analysing it after the message went out
+  applyMessageMedia(data) {
+    const message = this.messages.find((msg) => msg.id == data.id)
+    if (!message) return
+
+    message.media = data.media
+    const voice = document.querySelector(`.message[data-message-id="${data.id}"] .voice-message`)
+    if (voice) voice.outerHTML = this.renderMessageContent(message).trim()
+  }
 
 
   renderMessage(message) {
@@ -1493,16 +1748,72 @@ class DockTalkApp {
 
     const isOwn = message.sender === "You"
     return `
-      <div class="message ${isOwn ? "own" : ""}">
+      <div class="message ${isOwn ? "own" : ""}" data-message-id="${message.id}">
         <div class="message-content">
           ${!isOwn ? `<div class="message-sender">${message.sender}</div>` : ""}
           ${this.renderMessageContent(message)}
-          <div class="message-time">${this.formatMessageTime(message.timestamp)}</div>
+          <div class="message-time">
+            ${this.formatMessageTime(message.timestamp)}
+            ${isOwn ? `<span class="message-status">${this.getStatusIcon(message.status || "sent")}</span>` : ""}
+          </div>
         </div>
       </div>
     `
   }
 
+  // An <img> for an uploaded image no larger than box CSS pixels. Its
+  // renditions (images.py) go in srcset so the browser fetches the
+  // smallest one that is sharp at the screen's pixel density, and the
+  // known size reserves the space before anything loads.
+  renderImage(media, url, box) {
+    const renditions = media?.renditions
+    if (!renditions) {
+      return `<img src="${url}" alt="Shared image" loading="lazy" onclick="window.open('${url}', '_blank')">`
+    }
+    const { original, preview, thumb } = renditions
+    const scale = Math.min(1, box / original.width, box / original.height)
+    const width = Math.round(original.width * scale)
+    const height = Math.round(original.height * scale)
+    const srcset = [thumb, preview, original]
+      .filter((r, i, all) => all.findIndex((other) => other.url === r.url) === i)
+      .map((r) => `${r.url} ${r.width}w`)
+      .join(", ")
+    return `<img src="${thumb.url}" srcset="${srcset}" sizes="${width}px" width="${width}" height="${height}"
+      alt="Shared image" loading="lazy" data-original="${original.url}" onerror="app.retryImage(this)"
+      onclick="window.open('${original.url}', '_blank')">`
+  }
+
+  // A rendition can be requested a moment before the server has written
+  // it; try again a few times, then settle for the original
+  retryImage(img) {
+    const attempts = Number(img.dataset.attempts || 0) + 1
+    img.dataset.attempts = attempts
+    if (attempts > 3) {
+      img.onerror = null
+      img.removeAttribute("srcset")
+      img.src = img.dataset.original
+      return
+    }
+    setTimeout(() => {
+      img.srcset = img.srcset.replace(/(\S+?)(\?retry=\d+)? (\d+w)/g, `$1?retry=${attempts} $3`)
+      img.src = `${img.src.split("?")[0]}?retry=${attempts}`
+    }, 500 * attempts)
+  }
+
+  // Bars of the waveform the server computed (voice.py), shaded by the
+  // progress bar as the note plays
+  renderVoiceWaveform(message) {
+    const bars = message.media?.waveform
+    const progress = `<div class="voice-progress" id="voice-progress-${message.id}"></div>`
+    if (!bars?.length) return `<div class="voice-waveform">${progress}</div>`
+    return `
+      <div class="voice-waveform bars">
+        ${bars.map((bar) => `<span style="height: ${Math.max(10, bar)}%"></span>`).join("")}
+        ${progress}
+      </div>
+    `
+  }
+
   renderMessageContent(message) {
     switch (message.type) {
       case "text":
@@ -1513,16 +1824,14 @@ class DockTalkApp {
             <button class="voice-play-btn" onclick="app.playVoiceMessage('${message.id}', '${message.fileData.url}')">
               <i class="fas fa-play" id="voice-icon-${message.id}"></i>
             </button>
-            <div class="voice-waveform">
-              <div class="voice-progress" id="voice-progress-${message.id}"></div>
-            </div>
-            <span class="voice-duration">${message.fileData.duration || 0}s</span>
+            ${this.renderVoiceWaveform(message)}
+            <span class="voice-duration">${Math.round(message.media?.duration ?? message.fileData.duration ?? 0)}s</span>
           </div>
         `
       case "image":
         return `
           <div class="image-message">
-            <img src="${message.fileData.url}" alt="Shared image" onclick="window.open('${message.fileData.url}', '_blank')">
+            ${this.renderImage(message.media, message.fileData.url, 300)}
           </div>
         `
       case "file":
@@ -1589,6 +1898,71 @@ class DockTalkApp {
     input.click()
   }
 
+  // Hex SHA-256 of a Blob, or null where WebCrypto is unavailable (plain
+  // http on anything but localhost)
+  async sha256(blob) {
+    if (!window.crypto?.subtle) return null
+    const digest = await crypto.subtle.digest("SHA-256", await blob.arrayBuffer())
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, "0")).join("")
+  }
+
+  // Upload in chunks through /api/uploads (see uploads.py). A dropped
+  // connection retries from the last offset the server acknowledged
+  // instead of starting over. Resolves to the same result as /api/upload.
+  async uploadFile(file, type, fileName = file.name) {
+    const fileHash = file.size <= 32 * 1024 * 1024 ? await this.sha256(file) : null
+    let response = await fetch("/api/uploads", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ file_name: fileName, file_type: type, size: file.size, sha256: fileHash }),
+    })
+    const session = await response.json()
+    // A file this user uploaded before comes back stored, with nothing to send
+    if (!response.ok || session.success) return session
+
+    const url = `/api/uploads/${session.upload_id}`
+    let offset = session.offset
+    let failures = 0
+    while (offset < file.size) {
+      const chunk = file.slice(offset, offset + session.chunk_size)
+      const headers = { "Content-Type": "application/octet-stream" }
+      const chunkHash = await this.sha256(chunk)
+      if (chunkHash) headers["X-Chunk-SHA256"] = chunkHash
+      try {
+        response = await fetch(`${url}?offset=${offset}`, { method: "PUT", headers, body: chunk })
+        const result = await response.json()
+        if (response.ok) {
+          offset = result.offset
+          failures = 0
+          continue
+        }
+        if (result.offset === undefined || response.status >= 500) throw new Error(result.error)
+        // Out of step with the server (an earlier attempt did land) or the
+        // chunk arrived damaged; go again from where the server is
+        if (++failures > 8) return result
+        offset = result.offset
+      } catch (error) {
+        if (++failures > 8) return { error: "Upload interrupted" }
+        await new Promise((resolve) => setTimeout(resolve, Math.min(1000 * 2 ** failures, 30000)))
+        try {
+          offset = (await (await fetch(url)).json()).offset ?? offset
+        } catch (statusError) {
+          // Still offline; the next attempt will ask again
+        }
+      }
+    }
+
+    for (let attempt = 0; ; attempt++) {
+      try {
+        response = await fetch(`${url}/finalize`, { method: "POST" })
+        return await response.json()
+      } catch (error) {
+        if (attempt >= 8) return { error: "Upload interrupted" }
+        await new Promise((resolve) => setTimeout(resolve, Math.min(1000 * 2 ** attempt, 30000)))
+      }
+    }
+  }
+
   async onFileSelect(event, type) {
     const file = event.target.files?.[0]
     if (!file) return
@@ -1596,18 +1970,8 @@ class DockTalkApp {
     const entity = this.currentChat || this.currentGroup
     if (!entity) return
 
-    // Upload file
-    const formData = new FormData()
-    formData.append("file", file)
-    formData.append("type", type)
-
     try {
-      const response = await fetch("/api/upload", {
-        method: "POST",
-        body: formData,
-      })
-
-      const result = await response.json()
+      const result = await this.uploadFile(file, type)
 
       if (result.success) {
         // Send file message via socket
@@ -1676,22 +2040,14 @@ class DockTalkApp {
         const audioBlob = new Blob(this.audioChunks, { type: this.mediaRecorder.mimeType })
 
         // Upload voice message with proper filename
-        const formData = new FormData()
         const extension = this.mediaRecorder.mimeType.includes("webm")
           ? "webm"
           : this.mediaRecorder.mimeType.includes("mp4")
             ? "mp4"
             : "wav"
-        formData.append("file", audioBlob, `voice-message-${Date.now()}.${extension}`)
-        formData.append("type", "voice")
 
         try {
-          const response = await fetch("/api/upload", {
-            method: "POST",
-            body: formData,
-          })
-
-          const result = await response.json()
+          const result = await this.uploadFile(audioBlob, "voice", `voice-message-${Date.now()}.${extension}`)
 
           if (result.success) {
             const entity = this.currentChat || this.currentGroup
@@ -1952,12 +2308,12 @@ class DockTalkApp {
     if (type === "media") {
       fetch(`/api/messages?chat_type=${this.currentChat ? 'user' : 'group'}&chat_id=${entity.id}`)
         .then(res => res.json())
-        .then(messages => {
-          const media = messages.filter(m => m.message_type === "image" || m.message_type === "file");
+        .then(page => {
+          const media = page.messages.filter(m => m.message_type === "image" || m.message_type === "file");
           infoContent.innerHTML = media.length
             ? media.map(m => `
               <div class="media-item">
-                ${m.message_type === "image" ? `<img src="${m.file_url}" onclick="window.open('${m.file_url}', '_blank')"/>` : `<a href="${m.file_url}" target="_blank">${m.file_name}</a>`}
+                ${m.message_type === "image" ? this.renderImage(m.media, m.file_url, 160) : `<a href="${m.file_url}" target="_blank">${m.file_name}</a>`}
               </div>`).join("")
             : "<p>No media shared yet.</p>";
         });
@@ -2030,12 +2386,12 @@ class DockTalkApp {
     if (type === "media") {
       fetch(`/api/messages?chat_type=${this.currentChat ? 'user' : 'group'}&chat_id=${entity.id}`)
         .then(res => res.json())
-        .then(messages => {
-          const media = messages.filter(m => m.message_type === "image" || m.message_type === "file");
+        .then(page => {
+          const media = page.messages.filter(m => m.message_type === "image" || m.message_type === "file");
           infoContent.innerHTML = media.length
             ? media.map(m => `
               <div class="media-item">
-                ${m.message_type === "image" ? `<img src="${m.file_url}" />` : `<a href="${m.file_url}">${m.file_name}</a>`}
+                ${m.message_type === "image" ? this.renderImage(m.media, m.file_url, 160) : `<a href="${m.file_url}">${m.file_name}</a>`}
               </div>`).join("")
             : "<p>No media shared yet.</p>";
         });
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import images
+import metrics
+from db import get_db
+
+# Attachments are stored once per content: the file's SHA-256 names it and
+# picks its directory (objects/ab/cd/abcd...), so the same circular
+# forwarded to forty groups is one file and one attachments row. An upload
+# whose hash is already stored is answered from the row without writing
+# or reprocessing anything. A resumable upload that declares the hash of a
+# file the same user uploaded before is answered before any bytes are
+# sent; anyone else has to send the bytes, so a hash alone neither hands
+# out someone else's file nor tells whether it is stored.
+#
+# ref_count is the number of messages pointing at the file (the message
+# writer increments it). Files nobody sent a message with are pruned once
+# they have gone unused for PRUNE_AFTER seconds.
+UPLOAD_ROOT = 'static/uploads'
+OBJECT_DIR = os.path.join(UPLOAD_ROOT, 'objects')
+PRUNE_AFTER = float(os.environ.get('DOCKTALK_ATTACHMENT_PRUNE_AFTER', 7 * 24 * 3600))
+PRUNE_INTERVAL = 3600
+
+_last_prune = 0.0
+
+
+def object_path(sha256, extension):
+    return os.path.join(OBJECT_DIR, sha256[:2], sha256[2:4], f"{sha256}.{extension}")
+
+
+def url_for(path):
+    return '/' + path.replace(os.sep, '/')
+
+
+def path_for(url):
+    return url.lstrip('/')
+
+
+def _place(temp_path, path):
+    """Move temp_path to path atomically (path may already exist with the
+    same content)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        # Different filesystem: copy beside the target, then rename
+        staging = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(temp_path, staging)
+        os.replace(staging, path)
+
+
+def lookup(sha256, file_type, uploader_id=None):
+    """The stored attachment with this hash as {url, size, media}, or None;
+    with uploader_id, only if that user uploaded it. Marks it used; an image
+    stored earlier as a plain file gets its renditions planned now."""
+    with get_db() as conn:
+        row = conn.execute('''
+            UPDATE attachments SET last_used_at = ?
+            WHERE sha256 = ? AND (? IS NULL OR uploader_id = ?)
+            RETURNING url, size, media
+        ''', (time.time(), sha256.lower(), uploader_id, uploader_id)).fetchone()
+        conn.commit()
+    if row is None:
+        return None
+    url, size, media = row
+    if media is None and file_type == 'image':
+        media = _plan(url)
+    elif media:
+        media = json.loads(media)
+        # Renditions whose render failed or was never queued are retried
+        renditions = media.get('renditions', {}).values()
+        if any(not os.path.exists(path_for(r['url'])) for r in renditions):
+            images.submit(path_for(url), media)
+    else:
+        media = None
+    return {'url': url, 'size': size, 'media': media}
+
+
+def _plan(url):
+    media = images.plan(path_for(url), url)
+    if media:
+        with get_db() as conn:
+            conn.execute('UPDATE attachments SET media = ? WHERE url = ? AND media IS NULL',
+                         (json.dumps(media), url))
+            conn.commit()
+        images.submit(path_for(url), media)
+    return media
+
+
+def store(temp_path, sha256, extension, file_type, uploader_id):
+    """Store the fully received file at temp_path, unless a file with the
+    same hash is stored already; returns {url, size, media}. temp_path is
+    consumed only when the file is new."""
+    _maybe_prune()
+    sha256 = sha256.lower()
+    found = lookup(sha256, file_type)
+    if found is not None:
+        metrics.incr('storage.hits')
+        return found
+
+    path = object_path(sha256, extension)
+    url = url_for(path)
+    size = os.path.getsize(temp_path)
+    _place(temp_path, path)
+    # The original is kept; smaller renditions are rendered in the
+    # background (images.py) and their sizes are known already
+    media = images.plan(path, url) if file_type == 'image' else None
+    now = time.time()
+    with get_db() as conn:
+        # Another upload of the same bytes may have got here first (under
+        # another extension); theirs wins
+        row = conn.execute('''
+            INSERT INTO attachments (url, sha256, size, uploader_id, file_type, media, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sha256) DO UPDATE SET last_used_at = excluded.last_used_at
+            RETURNING url, size, media
+        ''', (url, sha256, size, uploader_id, file_type, json.dumps(media) if media else None, now)).fetchone()
+        conn.commit()
+    if row[0] != url:
+        os.remove(path)
+        metrics.incr('storage.hits')
+        return {'url': row[0], 'size': row[1], 'media': json.loads(row[2]) if row[2] else None}
+    metrics.incr('storage.stored')
+    metrics.incr('storage.bytes', size)
+    if media:
+        images.submit(path, media)
+    return {'url': url, 'size': size, 'media': media}
+
+
+def _remove(url, media):
+    urls = {url}
+    if media:
+        # Voice notes keep their duration and waveform here, not renditions
+        urls.update(r['url'] for r in json.loads(media).get('renditions', {}).values())
+    for stale in urls:
+        try:
+            os.remove(path_for(stale))
+        except FileNotFoundError:
+            pass
+
+
+def prune(older_than=None):
+    """Delete attachments no message refers to that have not been uploaded
+    or looked up for older_than (default PRUNE_AFTER) seconds"""
+    cutoff = time.time() - (PRUNE_AFTER if older_than is None else older_than)
+    with get_db() as conn:
+        # Files are removed before the commit, while the write lock keeps
+        # a concurrent store() from reviving the row and re-placing them
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            pruned = conn.execute('''
+                DELETE FROM attachments WHERE ref_count = 0 AND last_used_at < ?
+                RETURNING url, media
+            ''', (cutoff,)).fetchall()
+            for url, media in pruned:
+                _remove(url, media)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    if pruned:
+        metrics.incr('storage.pruned', len(pruned))
+    return len(pruned)
+
+
+def _maybe_prune():
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    try:
+        prune()
+    except Exception as e:
+        print(f"Error pruning attachments: {e}")
+
+
+def add_references(cursor, urls):
+    """Count new messages referring to urls (called in their transaction)"""
+    counts = {}
+    for url in urls:
+        counts[url] = counts.get(url, 0) + 1
+    cursor.executemany('UPDATE attachments SET ref_count = ref_count + ? WHERE url = ?',
+                       [(count, url) for url, count in counts.items()])
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def _link(source, target):
+    """Make target a hard link to source, replacing it atomically; copies
+    where the filesystem cannot link"""
+    staging = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, staging)
+    except OSError:
+        shutil.copyfile(source, staging)
+    os.replace(staging, target)
+
+
+def dedupe_legacy(cursor, folders=('images', 'files', 'voice')):
+    """Move uploads stored under random names (static/uploads/<folder>/)
+    onto content-addressed objects, rewriting the attachments and messages
+    that point at them. Legacy files are left in place as hard links to
+    their object, so duplicates share one copy on disk and URLs already
+    handed out keep working. Safe to run again."""
+    moved = {}
+    for folder in folders:
+        directory = os.path.join(UPLOAD_ROOT, folder)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            legacy = os.path.join(directory, name)
+            # Renditions (name.preview.jpg) are carried over with their image
+            if name.startswith('.') or name.count('.') != 1 or not os.path.isfile(legacy):
+                continue
+            sha256 = _hash_file(legacy)
+            path = object_path(sha256, name.rsplit('.', 1)[1].lower())
+            row = cursor.execute('SELECT url FROM attachments WHERE sha256 = ?', (sha256,)).fetchone()
+            if row is not None:
+                path = path_for(row[0])
+            elif not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _link(legacy, path)
+            if not os.path.samefile(legacy, path):
+                _link(path, legacy)
+            moved[url_for(legacy)] = (url_for(path), sha256, os.path.getsize(path),
+                                      'image' if folder == 'images' else 'voice' if folder == 'voice' else 'file')
+
+    for old_url, (url, sha256, size, file_type) in moved.items():
+        row = cursor.execute('SELECT uploader_id, file_type, media, created_at FROM attachments WHERE url = ?',
+                             (old_url,)).fetchone()
+        media = None
+        if row is not None:
+            media = _move_renditions(row[2], old_url, url)
+            cursor.execute('DELETE FROM attachments WHERE url = ?', (old_url,))
+        cursor.execute('''
+            INSERT INTO attachments (url, sha256, size, uploader_id, file_type, media, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+            ON CONFLICT (sha256) DO UPDATE SET media = COALESCE(media, excluded.media)
+        ''', (url, sha256, size, row[0] if row else None, row[1] if row else file_type, media,
+              row[3] if row else None, time.time()))
+        cursor.execute('UPDATE messages SET file_url = ?, media = COALESCE(?, media) WHERE file_url = ?',
+                       (url, media, old_url))
+    cursor.execute('''
+        UPDATE attachments SET ref_count = (SELECT COUNT(*) FROM messages WHERE messages.file_url = attachments.url)
+    ''')
+    return len(moved)
+
+
+def _move_renditions(media, old_url, url):
+    """Link the renditions of a legacy image to its object's names; returns
+    the media JSON rewritten for url"""
+    if not media:
+        return None
+    media = json.loads(media)
+    old_stem, stem = old_url.rsplit('.', 1)[0], url.rsplit('.', 1)[0]
+    for rendition in media['renditions'].values():
+        if rendition['url'] == old_url:
+            rendition['url'] = url
+        elif rendition['url'].startswith(old_stem + '.'):
+            new_url = stem + rendition['url'][len(old_stem):]
+            if os.path.exists(path_for(rendition['url'])) and not os.path.exists(path_for(new_url)):
+                _link(path_for(rendition['url']), path_for(new_url))
+            rendition['url'] = new_url
+    return json.dumps(media)
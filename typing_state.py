@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+import metrics
+
+# Who is typing where. Clients report typing_start/typing_stop; rooms get a
+# typing_snapshot of everyone currently typing there, at most once every
+# SNAPSHOT_INTERVAL seconds and only when it changed (plus a keepalive
+# while someone keeps typing), so a room sees a bounded number of frames
+# however many members type at once. Entries expire after TTL seconds
+# without a refresh, e.g. when a tab goes away without sending typing_stop.
+SNAPSHOT_INTERVAL = float(os.environ.get('DOCKTALK_TYPING_INTERVAL', 0.3))
+TTL = float(os.environ.get('DOCKTALK_TYPING_TTL', 6))
+KEEPALIVE = TTL / 2
+# typing_start events from one user closer together than this are dropped
+MIN_EVENT_INTERVAL = float(os.environ.get('DOCKTALK_TYPING_MIN_EVENT_INTERVAL', 0.5))
+# Names included in a snapshot; the count covers the rest
+MAX_NAMES = 5
+
+
+def typing_room(chat_type, chat_id):
+    """Room whose members see typing in a conversation: the group, or the
+    personal room of the user being written to"""
+    if chat_type == 'user':
+        return f"user_{chat_id}"
+    if chat_type == 'group':
+        return f"group_{chat_id}"
+    return None
+
+
+class TypingState:
+    """Per-room typists with expiry and coalesced snapshots.
+
+    State is per process. Snapshots carry this worker's source id and
+    clients merge the snapshots of every source, so typists held by
+    different workers all show up.
+    """
+
+    def __init__(self, socketio, fanout, source):
+        self.socketio = socketio
+        self.fanout = fanout
+        self.source = source
+        self._lock = threading.Lock()
+        # (chat_type, chat_id) -> {user_id: [name, expires_at, started_at]}
+        self._rooms = {}
+        # conversations whose snapshot changed since the last flush
+        self._dirty = set()
+        # (chat_type, chat_id) -> when its last snapshot was sent
+        self._sent = {}
+        # user_id -> time of their last accepted typing_start
+        self._last_event = {}
+        self._worker = None
+
+    def start(self, user_id, name, chat_type, chat_id):
+        """Mark user_id as typing; False if the event was rate limited"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_event.get(user_id, float('-inf')) < MIN_EVENT_INTERVAL:
+                metrics.incr('typing.dropped')
+                return False
+            self._last_event[user_id] = now
+            typists = self._rooms.setdefault((chat_type, chat_id), {})
+            entry = typists.get(user_id)
+            if entry is None:
+                typists[user_id] = [name, now + TTL, now]
+                self._dirty.add((chat_type, chat_id))
+            else:
+                entry[1] = now + TTL
+            self._ensure_started()
+        metrics.incr('typing.events')
+        return True
+
+    def stop(self, user_id, chat_type, chat_id):
+        with self._lock:
+            typists = self._rooms.get((chat_type, chat_id))
+            if typists and typists.pop(user_id, None) is not None:
+                self._dirty.add((chat_type, chat_id))
+            # The next start is a new burst, not a refresh
+            self._last_event.pop(user_id, None)
+        metrics.incr('typing.events')
+
+    def clear_user(self, user_id):
+        """Forget everything user_id was typing, e.g. on their last disconnect"""
+        with self._lock:
+            for key, typists in self._rooms.items():
+                if typists.pop(user_id, None) is not None:
+                    self._dirty.add(key)
+            self._last_event.pop(user_id, None)
+
+    def _ensure_started(self):
+        if self._worker is None:
+            self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Typing update failed: {e}")
+
+    def flush(self):
+        """Expire stale typists and send every snapshot that is due"""
+        now = time.monotonic()
+        snapshots = []
+        with self._lock:
+            for key, typists in list(self._rooms.items()):
+                expired = [user_id for user_id, entry in typists.items() if entry[1] <= now]
+                for user_id in expired:
+                    del typists[user_id]
+                if expired:
+                    self._dirty.add(key)
+                    metrics.incr('typing.expired', len(expired))
+                if key in self._dirty or (typists and now - self._sent.get(key, now) >= KEEPALIVE):
+                    # Longest-running typists first, so names do not shuffle
+                    users = sorted(typists.items(), key=lambda item: item[1][2])
+                    snapshots.append((key, [{'id': user_id, 'name': entry[0]} for user_id, entry in users],
+                                      len(users)))
+                    self._sent[key] = now
+                if not typists:
+                    del self._rooms[key]
+                    self._sent.pop(key, None)
+            self._dirty.clear()
+        for (chat_type, chat_id), users, count in snapshots:
+            self.fanout.emit('typing_snapshot', {
+                'chat_type': chat_type,
+                'chat_id': chat_id,
+                'users': users[:MAX_NAMES],
+                'count': count,
+                'source': self.source,
+                'ttl': TTL
+            }, room=typing_room(chat_type, chat_id))
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'typists': sum(len(t) for t in self._rooms.values())}
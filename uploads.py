@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import metrics
+from db import get_db
+
+# Resumable uploads. A client opens a session with the file's name, type,
+# size and (optionally) SHA-256, then PUTs the bytes in chunks at explicit
+# offsets, and finally asks for the file to be finalized:
+#
+#   POST /api/uploads                        -> {upload_id, offset, chunk_size}
+#   PUT  /api/uploads/<id>?offset=N   body   -> {offset}
+#   GET  /api/uploads/<id>                   -> {offset, size, status}
+#   POST /api/uploads/<id>/finalize          -> same result as /api/upload
+#
+# Each chunk is streamed to its own file under PARTIAL_DIR, so memory per
+# request stays at one copy buffer whatever the size of the attachment.
+# The session row records how many bytes have been acknowledged; a client
+# whose connection dropped asks for the offset and carries on from there.
+# Chunks may carry an X-Chunk-SHA256 header and are rejected if the bytes
+# do not match; finalize checks the SHA-256 of the whole file.
+CHUNK_SIZE = int(os.environ.get('DOCKTALK_UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+MAX_UPLOAD_SIZE = int(os.environ.get('DOCKTALK_MAX_UPLOAD_SIZE', 512 * 1024 * 1024))
+# Sessions untouched for this many seconds are dropped with their chunks
+UPLOAD_EXPIRY = float(os.environ.get('DOCKTALK_UPLOAD_EXPIRY', 24 * 3600))
+# Outside static/ so half-uploaded files are never served
+PARTIAL_DIR = os.environ.get('DOCKTALK_UPLOAD_PARTIAL_DIR', 'uploads_partial')
+
+COPY_BUFFER = 64 * 1024
+
+
+class UploadError(Exception):
+    """A request the upload protocol refuses; offset is where the client
+    should resume, when that is the problem"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _session_dir(upload_id):
+    return os.path.join(PARTIAL_DIR, upload_id)
+
+
+def _new_partial_path():
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    return os.path.join(PARTIAL_DIR, f"{uuid.uuid4().hex}.tmp")
+
+
+def copy_stream(stream, target, length=None):
+    """Copy stream (up to length bytes) into the open file target, returning
+    (bytes copied, SHA-256 hex)"""
+    digest = hashlib.sha256()
+    copied = 0
+    while length is None or copied < length:
+        buffer = stream.read(COPY_BUFFER if length is None else min(COPY_BUFFER, length - copied))
+        if not buffer:
+            break
+        target.write(buffer)
+        digest.update(buffer)
+        copied += len(buffer)
+    return copied, digest.hexdigest()
+
+
+def save_stream(stream):
+    """Stream an uploaded body to a new file under PARTIAL_DIR; returns
+    (path, size, SHA-256 hex)"""
+    path = _new_partial_path()
+    try:
+        with open(path, 'wb') as f:
+            size, sha256 = copy_stream(stream, f)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, size, sha256
+
+
+def expire_sessions():
+    """Drop sessions nobody has touched for UPLOAD_EXPIRY seconds"""
+    cutoff = time.time() - UPLOAD_EXPIRY
+    with get_db() as conn:
+        expired = [row[0] for row in conn.execute(
+            'DELETE FROM upload_sessions WHERE updated_at < ? RETURNING upload_id', (cutoff,)).fetchall()]
+        conn.commit()
+    for upload_id in expired:
+        shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+    if expired:
+        metrics.incr('uploads.expired', len(expired))
+    return len(expired)
+
+
+def create_session(user_id, file_name, file_type, size, sha256=None):
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError('File size is required')
+    if size > MAX_UPLOAD_SIZE:
+        raise UploadError(f'Files are limited to {MAX_UPLOAD_SIZE} bytes', 413)
+    expire_sessions()
+    upload_id = uuid.uuid4().hex
+    now = time.time()
+    os.makedirs(_session_dir(upload_id))
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO upload_sessions (upload_id, user_id, file_name, file_type, size, sha256, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (upload_id, user_id, file_name, file_type, size, sha256.lower() if sha256 else None, now, now))
+        conn.commit()
+    metrics.incr('uploads.started')
+    return {'upload_id': upload_id, 'offset': 0, 'size': size, 'chunk_size': CHUNK_SIZE}
+
+
+def get_session(upload_id, user_id):
+    """The session as a dict; UploadError 404 if user_id has no such upload"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT upload_id, file_name, file_type, size, received, sha256, status, result
+            FROM upload_sessions WHERE upload_id = ? AND user_id = ?
+        ''', (upload_id, user_id)).fetchone()
+    if row is None:
+        raise UploadError('Upload not found', 404)
+    return dict(zip(('upload_id', 'file_name', 'file_type', 'size', 'received', 'sha256', 'status', 'result'), row))
+
+
+def write_chunk(upload_id, user_id, offset, stream, length, sha256=None):
+    """Store length bytes of stream at offset; returns the new offset"""
+    session = get_session(upload_id, user_id)
+    if session['status'] != 'open':
+        raise UploadError('Upload is already finalized', 409, session['received'])
+    if offset != session['received']:
+        raise UploadError('Offset does not match the bytes received', 409, session['received'])
+    if length is None:
+        raise UploadError('Content-Length is required', 411, offset)
+    if length <= 0 or length > CHUNK_SIZE:
+        raise UploadError(f'Chunks must be 1 to {CHUNK_SIZE} bytes', 413, offset)
+    if offset + length > session['size']:
+        raise UploadError('Chunk runs past the declared file size', 400, offset)
+
+    # Written under a private name first: a retry of the same chunk may be
+    # running at the same time, and only one of them is acknowledged below
+    chunk_path = os.path.join(_session_dir(upload_id), f"{offset:020d}")
+    temp_path = f"{chunk_path}.{uuid.uuid4().hex}"
+    try:
+        with open(temp_path, 'wb') as f:
+            copied, digest = copy_stream(stream, f, length)
+            f.flush()
+            os.fsync(f.fileno())
+        if copied != length:
+            raise UploadError('Chunk was cut short', 400, offset)
+        if sha256 and digest != sha256.lower():
+            metrics.incr('uploads.chunk_mismatches')
+            raise UploadError('Chunk checksum does not match', 400, offset)
+
+        with get_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute('''
+                UPDATE upload_sessions SET received = ?, updated_at = ?
+                WHERE upload_id = ? AND received = ? AND status = 'open'
+            ''', (offset + length, time.time(), upload_id, offset))
+            if cursor.rowcount == 1:
+                os.replace(temp_path, chunk_path)
+            conn.commit()
+        if cursor.rowcount != 1:
+            raise UploadError('Offset does not match the bytes received', 409,
+                              get_session(upload_id, user_id)['received'])
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    metrics.incr('uploads.chunks')
+    metrics.incr('uploads.bytes', length)
+    return offset + length
+
+
+def _assemble(upload_id):
+    """Concatenate the chunks of an upload into one file; returns
+    (path, SHA-256 hex)"""
+    directory = _session_dir(upload_id)
+    path = _new_partial_path()
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'wb') as target:
+            for name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, name), 'rb') as chunk:
+                    while True:
+                        buffer = chunk.read(COPY_BUFFER)
+                        if not buffer:
+                            break
+                        target.write(buffer)
+                        digest.update(buffer)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest()
+
+
+def finalize(upload_id, user_id, sha256, store):
+    """Assemble a complete upload and hand it to store(path, file_name,
+    file_type, sha256), whose result is returned. Finalizing again returns
+    the same result, so a client that lost the response can retry."""
+    session = get_session(upload_id, user_id)
+    if session['status'] == 'complete':
+        return json.loads(session['result'])
+    if session['received'] != session['size']:
+        raise UploadError('Upload is incomplete', 409, session['received'])
+    with get_db() as conn:
+        claimed = conn.execute('''
+            UPDATE upload_sessions SET status = 'finalizing', updated_at = ?
+            WHERE upload_id = ? AND status = 'open'
+        ''', (time.time(), upload_id)).rowcount
+        conn.commit()
+    if not claimed:
+        raise UploadError('Upload is being finalized', 409, session['received'])
+
+    try:
+        path, digest = _assemble(upload_id)
+        expected = (sha256 or session['sha256'] or '').lower()
+        if expected and digest != expected:
+            os.remove(path)
+            discard(upload_id)
+            metrics.incr('uploads.checksum_failures')
+            raise UploadError('File checksum does not match; upload it again', 422)
+        result = store(path, session['file_name'], session['file_type'], digest)
+    except BaseException:
+        with get_db() as conn:
+            conn.execute("UPDATE upload_sessions SET status = 'open' WHERE upload_id = ? AND status = 'finalizing'",
+                         (upload_id,))
+            conn.commit()
+        raise
+
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE upload_sessions SET status = 'complete', result = ?, updated_at = ?
+            WHERE upload_id = ?
+        ''', (json.dumps(result), time.time(), upload_id))
+        conn.commit()
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+    metrics.incr('uploads.completed')
+    return result
+
+
+def discard(upload_id):
+    with get_db() as conn:
+        conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (upload_id,))
+        conn.commit()
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
@@ -0,0 +1,154 @@
+import array
+import os
+import shutil
+import subprocess
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Voice notes are analysed once, after they are uploaded: their real length
+# and a short peak waveform are stored with the attachment and with the
+# messages that carry it, so history can draw voice bubbles without
+# fetching and decoding the audio.
+#
+# WAV is read with the standard library. Samples are thinned to about
+# ENVELOPE_RATE per second of one channel with a stride slice, and the
+# peak of every WINDOW is taken with max()/min() over array slices, all of
+# which run in C, so no NumPy is needed. Other formats (the webm/opus or
+# mp4 that MediaRecorder usually produces) are decoded by ffmpeg when it
+# is on PATH, and otherwise keep the duration the client reported.
+WAVEFORM_BARS = int(os.environ.get('DOCKTALK_VOICE_WAVEFORM_BARS', 64))
+VOICE_WORKERS = int(os.environ.get('DOCKTALK_VOICE_WORKERS', 2))
+FFMPEG = shutil.which('ffmpeg')
+# Samples per second the waveform is taken from; ample for an envelope
+ENVELOPE_RATE = 8000
+FFMPEG_TIMEOUT = 60
+# Peaks are taken per window, then merged into bars once the length is known
+WINDOW = 0.01
+WINDOWS_PER_READ = 100
+
+_TYPECODES = {1: 'b', 2: 'h', 4: 'i'}
+# 8-bit WAV samples are unsigned; this recentres them on zero
+_SIGNED = bytes((b + 128) % 256 for b in range(256))
+
+_pool = None
+
+
+def _samples(data, width):
+    """Signed samples of raw little-endian PCM data"""
+    if width == 1:
+        data = data.translate(_SIGNED)
+    elif width == 3:
+        # Keep the top 16 bits of each 24-bit sample
+        wide = bytearray(len(data) // 3 * 2)
+        wide[0::2] = data[1::3]
+        wide[1::2] = data[2::3]
+        data, width = wide, 2
+    samples = array.array(_TYPECODES[width])
+    samples.frombytes(data[:len(data) - len(data) % width])
+    return samples, 2 ** (8 * width - 1)
+
+
+def _peaks(samples, step, full_scale):
+    return [max(max(window), -min(window)) / full_scale
+            for window in (samples[i:i + step] for i in range(0, len(samples), step))]
+
+
+def _read_wav(path):
+    """(duration, window peaks) of a PCM WAV file"""
+    with wave.open(path, 'rb') as audio:
+        channels, width, rate = audio.getnchannels(), audio.getsampwidth(), audio.getframerate()
+        if width not in (1, 2, 3, 4):
+            raise wave.Error(f'unsupported sample width {width}')
+        stride = max(1, rate // ENVELOPE_RATE)
+        step = max(1, round(rate * WINDOW / stride))
+        peaks = []
+        while True:
+            data = audio.readframes(step * stride * WINDOWS_PER_READ)
+            if not data:
+                break
+            samples, full_scale = _samples(data, width)
+            # First channel only, every stride'th frame
+            peaks.extend(_peaks(samples[::channels * stride], step, full_scale))
+        return audio.getnframes() / rate, peaks
+
+
+def _read_ffmpeg(path):
+    """(duration, window peaks) of anything ffmpeg can decode"""
+    process = subprocess.Popen([FFMPEG, '-v', 'error', '-i', path, '-vn', '-ac', '1', '-ar', str(ENVELOPE_RATE),
+                                '-f', 's16le', '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    step = round(ENVELOPE_RATE * WINDOW)
+    peaks = []
+    frames = 0
+    try:
+        while True:
+            data = process.stdout.read(step * WINDOWS_PER_READ * 2)
+            if not data:
+                break
+            samples, full_scale = _samples(data, 2)
+            frames += len(samples)
+            peaks.extend(_peaks(samples, step, full_scale))
+    finally:
+        process.stdout.close()
+        if process.wait(timeout=FFMPEG_TIMEOUT) != 0:
+            raise RuntimeError(f'ffmpeg exited with status {process.returncode}')
+    return frames / ENVELOPE_RATE, peaks
+
+
+def _bars(peaks):
+    """Merge window peaks into at most WAVEFORM_BARS values from 0 to 100,
+    scaled to the loudest"""
+    count = min(WAVEFORM_BARS, len(peaks))
+    bars = [max(peaks[i * len(peaks) // count:(i + 1) * len(peaks) // count]) for i in range(count)]
+    loudest = max(bars, default=0) or 1
+    return [round(100 * bar / loudest) for bar in bars]
+
+
+def analyze(path):
+    """{duration, waveform} of the voice note at path, or None if it cannot
+    be decoded here"""
+    duration = peaks = None
+    if path.lower().endswith('.wav'):
+        try:
+            duration, peaks = _read_wav(path)
+        except (wave.Error, EOFError):
+            # Compressed or float WAV; ffmpeg may still manage
+            pass
+    if peaks is None and FFMPEG:
+        duration, peaks = _read_ffmpeg(path)
+    if peaks is None:
+        return None
+    return {'duration': round(duration, 2), 'waveform': _bars(peaks)}
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(VOICE_WORKERS, thread_name_prefix='voice')
+    return _pool
+
+
+def _process(path, done):
+    try:
+        with metrics.timer('voice.analyze'):
+            media = analyze(path)
+        if media is None:
+            metrics.incr('voice.unsupported')
+            return
+        done(media)
+        metrics.incr('voice.processed')
+    except Exception as e:
+        metrics.incr('voice.errors')
+        print(f"Error processing voice note {path}: {e}")
+
+
+def submit(path, done):
+    """Analyse the voice note at path in the background and call
+    done(media) with the result; done is not called if it cannot be
+    analysed"""
+    metrics.incr('voice.submitted')
+    return _get_pool().submit(_process, path, done)
+
+
+metrics.register_gauge('voice', lambda: {'workers': VOICE_WORKERS, 'ffmpeg': FFMPEG is not None})
@@ -0,0 +1,177 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+import storage
+from conversations import conversation_key, record_message, increment_unread
+from db import get_db
+
+# Group commit settings. Each batch takes whatever queued up while the
+# previous one was committing, up to BATCH_SIZE messages. A non-zero
+# window also lingers that long for more messages, which only pays off
+# when senders do not wait for their own write (durability 'assigned').
+BATCH_SIZE = int(os.environ.get('DOCKTALK_WRITE_BATCH', 64))
+BATCH_WINDOW = float(os.environ.get('DOCKTALK_WRITE_WINDOW_MS', 0)) / 1000
+
+# 'commit'   - send_message waits until its batch is committed (default)
+# 'assigned' - send_message continues as soon as the row has its id; a
+#              failed commit can then lose messages that were already sent
+DURABILITY = os.environ.get('DOCKTALK_WRITE_DURABILITY', 'commit')
+
+
+class PendingMessage:
+    """A queued message insert; wait() returns its id"""
+
+    __slots__ = ('values', 'id', 'key', 'error', '_assigned', '_committed')
+
+    def __init__(self, values):
+        self.values = values
+        self.id = None
+        self.key = None
+        self.error = None
+        self._assigned = threading.Event()
+        self._committed = threading.Event()
+
+    def wait(self, durability=None, timeout=30):
+        """Block until the message has an id (or is committed) and return it"""
+        durability = durability or DURABILITY
+        event = self._assigned if durability == 'assigned' else self._committed
+        if not event.wait(timeout):
+            raise RuntimeError('Timed out waiting for the message writer')
+        if self.error is not None:
+            raise self.error
+        return self.id
+
+    def _assign(self, message_id):
+        self.id = message_id
+        self._assigned.set()
+
+    def _finish(self, error=None):
+        if error is not None:
+            self.error = error
+        self._assigned.set()
+        self._committed.set()
+
+
+class MessageWriter:
+    """Single writer thread that commits queued messages in batches.
+
+    Messages update their conversation summaries and unread counters in
+    the same transaction as their INSERT, but one commit (and one fsync)
+    covers the whole batch and each conversation is updated only once.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, window=BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, content, message_type, sender_id, chat_type, chat_id,
+               file_url=None, file_name=None, file_size=None, voice_duration=None, media=None):
+        pending = PendingMessage((content, message_type, sender_id, chat_type, chat_id,
+                                  file_url, file_name, file_size, voice_duration, media))
+        self._ensure_started()
+        self._queue.put(pending)
+        return pending
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        """Everything queued so far, waiting up to window for stragglers"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with metrics.timer('writer.batch'):
+                self._write(batch)
+            metrics.incr('writer.batches')
+            metrics.incr('writer.messages', len(batch))
+
+    def _write(self, batch):
+        written = []
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                for pending in batch:
+                    # A savepoint per message keeps one bad row from failing
+                    # the whole batch
+                    cursor.execute('SAVEPOINT message')
+                    try:
+                        content, _, sender_id, chat_type, chat_id = pending.values[:5]
+                        pending.key = conversation_key(chat_type, chat_id, sender_id)
+                        cursor.execute('''
+                            INSERT INTO messages (content, message_type, sender_id, chat_type, chat_id, file_url, file_name, file_size, voice_duration, media)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT media FROM attachments WHERE url = ?)))
+                        ''', pending.values + (pending.values[5],))
+                    except (sqlite3.Error, TypeError, ValueError) as e:
+                        cursor.execute('ROLLBACK TO message')
+                        cursor.execute('RELEASE message')
+                        metrics.incr('writer.errors')
+                        pending._finish(e)
+                        continue
+                    cursor.execute('RELEASE message')
+                    pending._assign(cursor.lastrowid)
+                    written.append(pending)
+                self._update_conversations(cursor, written)
+                storage.add_references(cursor, [p.values[5] for p in written if p.values[5]])
+                conn.commit()
+        except Exception as e:
+            # Nothing in the batch was committed
+            unfinished = [p for p in batch if not p._committed.is_set()]
+            metrics.incr('writer.errors', len(unfinished))
+            for pending in unfinished:
+                pending._finish(e)
+            print(f"Message batch failed: {e}")
+            return
+        for pending in written:
+            pending._finish()
+
+    def _update_conversations(self, cursor, written):
+        """Update summaries and unread counters once per conversation"""
+        latest = {}
+        senders = {}
+        for pending in written:
+            content, _, sender_id, chat_type, chat_id = pending.values[:5]
+            key = pending.key
+            count = latest[key][-1] + 1 if key in latest else 1
+            latest[key] = (pending.id, sender_id, chat_type, chat_id, content, count)
+            sent = senders.setdefault((key, sender_id), [chat_type, chat_id, 0])
+            sent[2] += 1
+        for message_id, sender_id, chat_type, chat_id, content, count in latest.values():
+            record_message(cursor, message_id, sender_id, chat_type, chat_id, content, count)
+        for (_, sender_id), (chat_type, chat_id, count) in senders.items():
+            increment_unread(cursor, sender_id, chat_type, chat_id, count)
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'batch_size': self.batch_size,
+                'window_ms': self.window * 1000, 'durability': DURABILITY}
+
+
+message_writer = MessageWriter()
+metrics.register_gauge('writer', lambda: message_writer.stats())
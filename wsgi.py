@@ -0,0 +1,13 @@
+"""Gunicorn entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    DOCKTALK_ASYNC_MODE=eventlet gunicorn -c gunicorn.conf.py wsgi:app
+
+The worker class follows DOCKTALK_ASYNC_MODE (see gunicorn.conf.py).
+"""
+import serving
+serving.patch()  # before anything else, for the eventlet/gevent modes
+
+from app import app, init_db
+
+init_db()